@@ -0,0 +1,538 @@
+import asyncio
+import bisect
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from storage import Cursor, MessageStore, sort_key
+
+logger = logging.getLogger('archive')
+
+# Compression name -> archive segment file suffix
+SUFFIXES = {'gzip': 'gz', 'zstd': 'zst'}
+
+
+class MessageArchive:
+    """Compressed, immutable segments of old messages, kept per conversation.
+
+    Each segment is one file of JSON lines, oldest first, under a directory
+    per peer. `manifest.json` lists every peer's segments with their
+    (timestamp, id) range. Segments are never rewritten. They are archived
+    oldest first, so their ranges rarely overlap; one only does when a
+    message arrived late with an older timestamp. Reading a segment
+    decompresses it whole; the most recently read ones stay in memory.
+
+    write() compresses and syncs the segment and the manifest in a worker
+    thread, so the event loop keeps serving while a segment is archived.
+    The manifest itself only changes on the loop.
+
+    zstd needs the `zstandard` package; gzip is always available.
+    """
+
+    def __init__(self, path: str, compression: str = 'gzip', cached_segments: int = 4):
+        if compression not in SUFFIXES:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        if compression == 'zstd':
+            import zstandard  # noqa: F401
+        self.path = path
+        self.compression = compression
+        self.cached_segments = cached_segments
+        self.cache: OrderedDict = OrderedDict()
+        # Highest segment number handed out per peer, including ones still being written
+        self.numbers: Dict[str, int] = {}
+        # Bumped by trim and clear, so a write that overlapped one is dropped
+        self.generations: Dict[str, int] = {}
+        self.epoch = 0
+        # Manifest snapshots are numbered so an older one never replaces a newer one
+        self.manifest_lock = threading.Lock()
+        self.manifest_version = 0
+        self.saved_version = 0
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {'max_id': 0, 'peers': {}}
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def _directory(self, peer_id: str) -> str:
+        # Peer ids come from the network; keep them from naming other paths
+        return os.path.join(self.path, quote(peer_id, safe='').replace('.', '%2E'))
+
+    def _manifest_snapshot(self) -> Tuple[int, bytes]:
+        self.manifest_version += 1
+        return self.manifest_version, json.dumps(self.manifest, separators=(',', ':')).encode()
+
+    def _store_manifest(self, version: int, data: bytes):
+        path = os.path.join(self.path, 'manifest.json')
+        with self.manifest_lock:
+            if version < self.saved_version:
+                return
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{path}.tmp", path)
+            self.saved_version = version
+
+    def _save_manifest(self):
+        self._store_manifest(*self._manifest_snapshot())
+
+    def _changed(self, peer_id: str):
+        self.generations[peer_id] = self.generations.get(peer_id, 0) + 1
+
+    @staticmethod
+    def _compress(data: bytes, compression: str) -> bytes:
+        if compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    @staticmethod
+    def _decompress(data: bytes, name: str) -> bytes:
+        if name.endswith('.zst'):
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def segments(self, peer_id: str) -> List[dict]:
+        return self.manifest['peers'].get(peer_id, [])
+
+    def last_key(self, peer_id: str) -> Optional[Tuple[str, int]]:
+        """Position of a peer's newest archived message, or None if nothing is archived"""
+        return max((tuple(segment['last']) for segment in self.segments(peer_id)), default=None)
+
+    def contains(self, peer_id: str, message: dict) -> bool:
+        """True if the message is already archived"""
+        key = sort_key(message)
+        for segment in self.segments(peer_id):
+            if tuple(segment['first']) <= key <= tuple(segment['last']):
+                messages = self._load(peer_id, segment)
+                position = bisect.bisect_left(messages, key, key=sort_key)
+                if position < len(messages) and messages[position]['id'] == message['id']:
+                    return True
+        return False
+
+    async def write(self, peer_id: str, messages: List[dict]) -> bool:
+        """Archive a peer's messages, sorted oldest first, as a new segment.
+
+        Returns False, leaving the archive as it was, if the peer was trimmed
+        or cleared while the segment was being written.
+        """
+        number = self._next_number(peer_id)
+        started = (self.epoch, self.generations.get(peer_id, 0))
+        try:
+            segment = await asyncio.to_thread(self._write_file, peer_id, number, messages)
+        except OSError:
+            # A clear removing the directory under the write makes it fail
+            if (self.epoch, self.generations.get(peer_id, 0)) == started:
+                raise
+            return False
+        if (self.epoch, self.generations.get(peer_id, 0)) != started:
+            try:
+                os.remove(os.path.join(self._directory(peer_id), segment['name']))
+            except OSError:
+                pass
+            return False
+        self._add_segment(peer_id, segment)
+        await asyncio.to_thread(self._store_manifest, *self._manifest_snapshot())
+        return True
+
+    def _next_number(self, peer_id: str) -> int:
+        number = max([self.numbers.get(peer_id, 0), *(segment['number'] for segment in self.segments(peer_id))]) + 1
+        self.numbers[peer_id] = number
+        return number
+
+    def _add_segment(self, peer_id: str, segment: dict):
+        self.manifest['peers'].setdefault(peer_id, []).append(segment)
+        self.manifest['max_id'] = max(self.manifest['max_id'], segment['last_id'])
+
+    def _write_file(self, peer_id: str, number: int, messages: List[dict]) -> dict:
+        """Compress and sync a segment file; touches no shared state, so it can run in a thread"""
+        name = f"{number:08d}.jsonl.{SUFFIXES[self.compression]}"
+        directory = self._directory(peer_id)
+        os.makedirs(directory, exist_ok=True)
+        lines = ''.join(json.dumps(message, separators=(',', ':')) + '\n' for message in messages)
+        path = os.path.join(directory, name)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(self._compress(lines.encode(), self.compression))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        ids = [message['id'] for message in messages]
+        return {
+            'number': number,
+            'name': name,
+            'first': list(sort_key(messages[0])),
+            'last': list(sort_key(messages[-1])),
+            'first_id': min(ids),
+            'last_id': max(ids),
+            'count': len(messages),
+            'bytes': os.path.getsize(path)
+        }
+
+    async def trim(self, peer_id: str, upto: Tuple[str, int]) -> bool:
+        """Remove a peer's archived messages at or before a (timestamp, id) position.
+
+        Segments wholly before it are deleted; one straddling it is replaced
+        by a new segment holding the rest. Reading, writing and deleting the
+        files and saving the manifest run in a worker thread, like write().
+        Returns False, changing nothing, if the peer was trimmed or cleared
+        meanwhile.
+        """
+        plan = self._trim_plan(peer_id, upto)
+        if plan is None:
+            return True
+        started = (self.epoch, self.generations.get(peer_id, 0))
+        written = await asyncio.to_thread(self._rewrite_segments, peer_id, plan, upto)
+        if (self.epoch, self.generations.get(peer_id, 0)) != started:
+            await asyncio.to_thread(self._remove_files, peer_id, written.values())
+            return False
+        removed = self._commit_trim(peer_id, plan, written)
+        await asyncio.to_thread(self._store_manifest, *self._manifest_snapshot())
+        await asyncio.to_thread(self._remove_files, peer_id, removed)
+        return True
+
+    def trim_blocking(self, peer_id: str, upto: Tuple[str, int]):
+        """trim() for callers off the event loop, doing the file work on the calling thread"""
+        plan = self._trim_plan(peer_id, upto)
+        if plan is None:
+            return
+        removed = self._commit_trim(peer_id, plan, self._rewrite_segments(peer_id, plan, upto))
+        self._save_manifest()
+        self._remove_files(peer_id, removed)
+
+    def _trim_plan(self, peer_id: str, upto: Tuple[str, int]) -> Optional[Dict[str, Optional[int]]]:
+        """Segment names to remove, each with the number of its replacement (None if nothing is left)"""
+        plan = {}
+        for segment in self.segments(peer_id):
+            if tuple(segment['first']) > upto:
+                continue
+            plan[segment['name']] = self._next_number(peer_id) if tuple(segment['last']) > upto else None
+        return plan or None
+
+    def _rewrite_segments(self, peer_id: str, plan: Dict[str, Optional[int]], upto: Tuple[str, int]) -> Dict[str, dict]:
+        """Write the part of each straddling segment after `upto`; touches no shared state"""
+        written = {}
+        for name, number in plan.items():
+            if number is None:
+                continue
+            with open(os.path.join(self._directory(peer_id), name), 'rb') as f:
+                data = self._decompress(f.read(), name)
+            messages = [json.loads(line) for line in data.splitlines()]
+            written[name] = self._write_file(peer_id, number, [message for message in messages if sort_key(message) > upto])
+        return written
+
+    def _commit_trim(self, peer_id: str, plan: Dict[str, Optional[int]], written: Dict[str, dict]) -> List[dict]:
+        """Swap the trimmed segments in the manifest; returns the ones whose files can go"""
+        kept, removed = [], []
+        # Segments archived while the files were rewritten stay
+        for segment in self.segments(peer_id):
+            if segment['name'] not in plan:
+                kept.append(segment)
+                continue
+            removed.append(segment)
+            if segment['name'] in written:
+                kept.append(written[segment['name']])
+        self._changed(peer_id)
+        if kept:
+            self.manifest['peers'][peer_id] = kept
+        else:
+            self.manifest['peers'].pop(peer_id, None)
+        for segment in removed:
+            self.cache.pop((peer_id, segment['name']), None)
+        return removed
+
+    def _remove_files(self, peer_id: str, segments: Iterable[dict]):
+        for segment in segments:
+            try:
+                os.remove(os.path.join(self._directory(peer_id), segment['name']))
+            except FileNotFoundError:
+                pass
+
+    def messages(self, peer_id: str) -> List[dict]:
+        """Every archived message with a peer, oldest first"""
+        return [message for segment in self.segments(peer_id) for message in self._load(peer_id, segment)]
+
+    def _load(self, peer_id: str, segment: dict) -> List[dict]:
+        key = (peer_id, segment['name'])
+        messages = self.cache.get(key)
+        if messages is not None:
+            self.cache.move_to_end(key)
+            return messages
+        with open(os.path.join(self._directory(peer_id), segment['name']), 'rb') as f:
+            data = self._decompress(f.read(), segment['name'])
+        messages = [json.loads(line) for line in data.splitlines()]
+        self.cache[key] = messages
+        while len(self.cache) > self.cached_segments:
+            self.cache.popitem(last=False)
+        return messages
+
+    def page(self, peer_id: str, before: Optional[Tuple[str, int]], after: Optional[Tuple[str, int]],
+             limit: int) -> List[dict]:
+        """Archived messages strictly between two resolved positions, with MessageStore.page semantics"""
+        newest_first = after is None
+        segments = self.segments(peer_id)
+        selected: List[dict] = []
+        for segment in (reversed(segments) if newest_first else segments):
+            first, last = tuple(segment['first']), tuple(segment['last'])
+            if (before is not None and first >= before) or (after is not None and last <= after):
+                continue
+            # Once the page is full, only a segment reaching past its far end can change it
+            if len(selected) >= limit and (last < sort_key(selected[0]) if newest_first else first > sort_key(selected[-1])):
+                continue
+            messages = self._load(peer_id, segment)
+            start = 0 if after is None else bisect.bisect_right(messages, after, key=sort_key)
+            end = len(messages) if before is None else bisect.bisect_left(messages, before, key=sort_key)
+            selected += messages[max(start, end - limit):end] if newest_first else messages[start:min(end, start + limit)]
+            selected.sort(key=sort_key)
+            selected = selected[-limit:] if newest_first else selected[:limit]
+        return selected
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        candidates = sorted(
+            ((segment['first_id'], peer_id, segment)
+             for peer_id, segments in self.manifest['peers'].items()
+             for segment in segments if segment['last_id'] > message_id),
+            key=lambda candidate: candidate[0]
+        )
+        messages = []
+        for first_id, peer_id, segment in candidates:
+            # Segments starting past the first `limit` ids found cannot add to the result
+            if len(messages) >= limit and first_id > messages[limit - 1]['id']:
+                break
+            messages.extend(message for message in self._load(peer_id, segment) if message['id'] > message_id)
+            messages.sort(key=lambda message: message['id'])
+        return messages[:limit]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        for peer_id, segments in self.manifest['peers'].items():
+            for segment in segments:
+                if segment['first_id'] <= message_id <= segment['last_id']:
+                    for message in self._load(peer_id, segment):
+                        if message['id'] == message_id:
+                            return message
+        return None
+
+    def max_id(self) -> int:
+        return self.manifest['max_id']
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is not None:
+            return sum(segment['count'] for segment in self.segments(peer_id))
+        return sum(segment['count'] for segments in self.manifest['peers'].values() for segment in segments)
+
+    def peer_ids(self) -> List[str]:
+        return sorted(self.manifest['peers'])
+
+    def export(self, peer_id: str) -> Iterator[bytes]:
+        """A peer's archived messages as gzip members of JSON lines; gzip segments are copied as stored"""
+        for segment in self.segments(peer_id):
+            with open(os.path.join(self._directory(peer_id), segment['name']), 'rb') as f:
+                data = f.read()
+            yield data if segment['name'].endswith('.gz') else gzip.compress(self._decompress(data, segment['name']))
+
+    def clear(self, peer_id: str):
+        self._changed(peer_id)
+        self.manifest['peers'].pop(peer_id, None)
+        self._save_manifest()
+        self.cache.clear()
+        shutil.rmtree(self._directory(peer_id), ignore_errors=True)
+
+    def clear_all(self):
+        peer_ids = list(self.manifest['peers'])
+        self.epoch += 1
+        self.manifest['peers'] = {}
+        self._save_manifest()
+        self.cache.clear()
+        for peer_id in peer_ids:
+            shutil.rmtree(self._directory(peer_id), ignore_errors=True)
+
+    def stats(self) -> dict:
+        segments = [segment for segments in self.manifest['peers'].values() for segment in segments]
+        return {
+            'compression': self.compression,
+            'conversations': len(self.manifest['peers']),
+            'segments': len(segments),
+            'messages': sum(segment['count'] for segment in segments),
+            'bytes': sum(segment['bytes'] for segment in segments)
+        }
+
+
+class ArchivedStore(MessageStore):
+    """Hot store plus a compressed archive tier, with a retention policy.
+
+    archive_expired() moves each conversation's messages older than
+    `max_age_days`, or beyond its newest `max_messages`, from the hot store
+    into the archive, `segment_size` messages per archive segment. Zero
+    turns a limit off. Reads come from the hot store. The archive is only
+    opened when a page reaches past the oldest hot message.
+
+    A message is written to the archive before it is trimmed from the hot
+    store. A crash in between leaves it in both, so reads merge the tiers by
+    message id, and the next run trims it without archiving it again. Only
+    hot messages sorting before the newest archived one need that check.
+    """
+
+    def __init__(self, hot: MessageStore, archive: MessageArchive,
+                 max_age_days: float = 0, max_messages: int = 0, segment_size: int = 1000):
+        self.hot = hot
+        self.archive = archive
+        self.max_age_days = max_age_days
+        self.max_messages = max_messages
+        self.segment_size = segment_size
+        self.counters = {'runs': 0, 'archived': 0, 'run_ms_last': None, 'last_run': None}
+
+    def append(self, message: dict) -> dict:
+        return self.hot.append(message)
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        return self.hot.insert_many(messages)
+
+    @staticmethod
+    def _merge(archived: List[dict], hot: List[dict]) -> List[dict]:
+        merged = {message['id']: message for message in archived + hot}
+        return sorted(merged.values(), key=sort_key)
+
+    def history(self, peer_id: str) -> List[dict]:
+        if self.archive.last_key(peer_id) is None:
+            return self.hot.history(peer_id)
+        return self._merge(self.archive.messages(peer_id), self.hot.history(peer_id))
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        upper, lower = self.position(before), self.position(after)
+        if (before is not None and upper is None) or (after is not None and lower is None):
+            return []
+        messages = self.hot.page(peer_id, before=upper, after=lower, limit=limit)
+        archived_last = self.archive.last_key(peer_id)
+        if archived_last is None:
+            return messages
+        # Only open the archive when the page reaches back past the hot tier
+        if after is None and len(messages) == limit and sort_key(messages[0]) > archived_last:
+            return messages
+        if after is not None and lower >= archived_last:
+            return messages
+        merged = self._merge(self.archive.page(peer_id, upper, lower, limit), messages)
+        return merged[:limit] if after is not None else merged[-limit:]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        messages = self.hot.since(message_id, limit)
+        if self.archive.max_id() > message_id:
+            merged = {message['id']: message for message in self.archive.since(message_id, limit) + messages}
+            messages = [merged[message_id] for message_id in sorted(merged)][:limit]
+        return messages
+
+    def get(self, message_id: int) -> Optional[dict]:
+        return self.hot.get(message_id) or self.archive.get(message_id)
+
+    def max_id(self) -> int:
+        return max(self.hot.max_id(), self.archive.max_id())
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        return self.hot.count(peer_id) + self.archive.count(peer_id)
+
+    def peer_ids(self) -> List[str]:
+        return sorted(set(self.hot.peer_ids()) | set(self.archive.peer_ids()))
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        """Trim both tiers; rewrites archive files on the calling thread, so use trim_async() on the event loop"""
+        self.archive.trim_blocking(peer_id, upto)
+        self.hot.trim(peer_id, upto)
+
+    async def trim_async(self, peer_id: str, upto: Tuple[str, int]):
+        """trim() with the archive's file work in a worker thread"""
+        await self.archive.trim(peer_id, upto)
+        self.hot.trim(peer_id, upto)
+
+    def clear(self, peer_id: str):
+        self.hot.clear(peer_id)
+        self.archive.clear(peer_id)
+
+    def clear_all(self):
+        self.hot.clear_all()
+        self.archive.clear_all()
+
+    def _archived(self, peer_id: str, message: dict, archived_last: Optional[Tuple[str, int]]) -> bool:
+        return archived_last is not None and sort_key(message) <= archived_last and self.archive.contains(peer_id, message)
+
+    async def archive_expired(self) -> int:
+        """Apply the retention policy to every conversation; returns how many messages were archived.
+
+        Works one archive segment at a time. Compressing and syncing each
+        segment runs in a worker thread, so requests are served meanwhile;
+        the hot store is only read and trimmed on the event loop.
+        """
+        if not self.max_age_days and not self.max_messages:
+            return 0
+        started = time.perf_counter()
+        cutoff = None
+        if self.max_age_days:
+            cutoff = (datetime.utcnow() - timedelta(days=self.max_age_days)).isoformat()
+        archived = 0
+        for peer_id in self.hot.peer_ids():
+            archived_last = self.archive.last_key(peer_id)
+            excess = self.hot.count(peer_id) - self.max_messages if self.max_messages else 0
+            while True:
+                batch = self.hot.page(peer_id, after=('', 0), limit=self.segment_size)
+                expired = []
+                upto = None
+                for message in batch:
+                    if not self._archived(peer_id, message, archived_last):
+                        if excess <= 0 and (cutoff is None or message['timestamp'] >= cutoff):
+                            break
+                        expired.append(message)
+                    upto = sort_key(message)
+                    excess -= 1
+                if upto is None:
+                    break
+                if expired:
+                    if not await self.archive.write(peer_id, expired):
+                        # Trimmed or cleared meanwhile; the next run starts over
+                        break
+                    archived_last = self.archive.last_key(peer_id)
+                self.hot.trim(peer_id, upto)
+                archived += len(expired)
+                if upto != sort_key(batch[-1]) or len(batch) < self.segment_size:
+                    break
+        run_ms = (time.perf_counter() - started) * 1000
+        self.counters['runs'] += 1
+        self.counters['archived'] += archived
+        self.counters['run_ms_last'] = round(run_ms, 1)
+        self.counters['last_run'] = datetime.utcnow().isoformat()
+        if archived:
+            logger.info(f"Archived {archived} messages in {run_ms:.0f} ms")
+        return archived
+
+    def export(self, peer_id: str) -> Iterator[bytes]:
+        """A whole conversation as gzipped JSON lines: the archive segments, then the hot tier, each oldest first"""
+        yield from self.archive.export(peer_id)
+        archived_last = self.archive.last_key(peer_id)
+        position = ('', 0)
+        while True:
+            page = self.hot.page(peer_id, after=position, limit=self.segment_size)
+            if not page:
+                return
+            position = sort_key(page[-1])
+            messages = [message for message in page if not self._archived(peer_id, message, archived_last)]
+            if not messages:
+                continue
+            lines = ''.join(json.dumps(message, separators=(',', ':')) + '\n' for message in messages)
+            yield gzip.compress(lines.encode())
+
+    def stats(self) -> dict:
+        return {
+            **self.archive.stats(),
+            **self.counters,
+            'max_age_days': self.max_age_days,
+            'max_messages': self.max_messages
+        }
+
+    def close(self):
+        self.hot.close()
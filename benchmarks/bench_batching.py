@@ -0,0 +1,177 @@
+"""Proxy-to-proxy throughput with micro-batching on vs off.
+
+Starts a controller, the `behrooz` and `alice` proxies (ports 10000/10001) and a
+stub peer in place of alice's peer.py (port 5001), then pushes messages from
+behrooz to alice and measures how fast they arrive at the stub. Stop any
+running overlay before running this, since it uses the default ports.
+
+    python benchmarks/bench_batching.py --messages 5000 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, jsonify, request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTROLLER_PORT = 18000
+SENDER = {'instance_name': 'behrooz', 'proxy_port': 10000, 'client_port': 5000}
+RECEIVER = {'instance_name': 'alice', 'proxy_port': 10001, 'client_port': 5001}
+
+received = 0
+stub = Quart(__name__)
+
+
+@stub.route('/message', methods=['POST'])
+async def stub_message():
+    global received
+    # Read the body like peer.py does; an unread body makes the server drop the connection
+    await request.get_json()
+    received += 1
+    return jsonify({"status": "success"})
+
+
+@stub.route('/received', methods=['GET', 'DELETE'])
+async def stub_received():
+    global received
+    count = received
+    if request.method == 'DELETE':
+        received = 0
+    return jsonify(count)
+
+
+def run_stub():
+    """Serve the stub peer in its own process so it does not share a loop with the load generator"""
+    config = Config()
+    config.bind = [f"127.0.0.1:{RECEIVER['client_port']}"]
+    config.accesslog = None
+    config.keep_alive_timeout = 75.0
+    asyncio.run(serve(stub, config))
+
+
+def start_process(args, log_path):
+    log = open(log_path, 'w')
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_for(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def run_case(workdir, batch_window_ms, messages, concurrency):
+    stub_url = f"http://127.0.0.1:{RECEIVER['client_port']}/received"
+    async with httpx.AsyncClient() as client:
+        await client.delete(stub_url)
+    processes = []
+    try:
+        for instance in (SENDER, RECEIVER):
+            config_path = os.path.join(workdir, f"proxy_{instance['instance_name']}.json")
+            with open(config_path, 'w') as f:
+                json.dump({
+                    **instance,
+                    'controller_url': f"http://127.0.0.1:{CONTROLLER_PORT}",
+                    'batch_window_ms': batch_window_ms
+                }, f)
+            log_path = os.path.join(workdir, f"proxy_{instance['instance_name']}_{batch_window_ms}.log")
+            processes.append(start_process(['proxy.py', '--config', config_path], log_path))
+        for instance in (SENDER, RECEIVER):
+            await wait_for(f"http://127.0.0.1:{instance['proxy_port']}/peers")
+
+        headers = {'Host': RECEIVER['instance_name']}
+        url = f"http://127.0.0.1:{SENDER['proxy_port']}/"
+        pending = iter(range(messages))
+        rejected = 0
+
+        async def sender(client):
+            nonlocal rejected
+            for i in pending:
+                response = await client.post(url, headers=headers, json={
+                    "message": f"message {i}",
+                    "from": SENDER['instance_name']
+                })
+                if response.status_code != 200:
+                    rejected += 1
+
+        started = time.monotonic()
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+            await asyncio.gather(*(sender(client) for _ in range(concurrency)))
+        accepted = time.monotonic() - started
+
+        received = 0
+        deadline = time.monotonic() + 60
+        async with httpx.AsyncClient() as client:
+            while received < messages - rejected and time.monotonic() < deadline:
+                received = (await client.get(stub_url)).json()
+                await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        return {
+            'batch_window_ms': batch_window_ms,
+            'delivered': received,
+            'rejected': rejected,
+            'accept_s': round(accepted, 2),
+            'total_s': round(elapsed, 2),
+            'msgs_per_s': round(received / elapsed, 1)
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        helpers = [
+            start_process(
+                ['-c', f"import controller; controller.run_controller(port={CONTROLLER_PORT})"],
+                os.path.join(workdir, 'controller.log')
+            ),
+            start_process([os.path.abspath(__file__), '--stub'], os.path.join(workdir, 'stub.log'))
+        ]
+        try:
+            await wait_for(f"http://127.0.0.1:{CONTROLLER_PORT}/")
+            await wait_for(f"http://127.0.0.1:{RECEIVER['client_port']}/received")
+            results = []
+            for window in (0, args.window_ms):
+                results.append(await run_case(workdir, window, args.messages, args.concurrency))
+        finally:
+            for process in helpers:
+                process.terminate()
+                process.wait(timeout=10)
+
+    print(f"{'batching':<12}{'delivered':>10}{'rejected':>10}{'accept s':>10}{'total s':>10}{'msgs/s':>10}")
+    for result in results:
+        label = f"{result['batch_window_ms']:g} ms" if result['batch_window_ms'] else 'off'
+        print(f"{label:<12}{result['delivered']:>10}{result['rejected']:>10}"
+              f"{result['accept_s']:>10}{result['total_s']:>10}{result['msgs_per_s']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--window-ms', type=float, default=5.0)
+    parser.add_argument('--stub', action='store_true', help=argparse.SUPPRESS)
+    main_args = parser.parse_args()
+    if main_args.stub:
+        run_stub()
+    else:
+        asyncio.run(main(main_args))
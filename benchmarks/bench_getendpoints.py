@@ -0,0 +1,147 @@
+"""Requests per second on the controller's /api/getendpoints, before and after caching.
+
+Starts a controller with --proxies registered proxies, each given --endpoints
+endpoints shaped like the default BOT endpoint, then polls with --concurrency
+clients for --seconds per mode:
+
+  jsonify     what get_endpoints did before: jsonify the endpoint dict on every poll
+              (served from an extra route the benchmark adds to the controller)
+  cached      the full response, serialized once per revision
+  etag 304    polls sending the ETag of the revision they hold
+
+The load generator shares the machine with the controller, so requests/s is
+bounded by the client as well; controller CPU per request (read from /proc,
+so Linux only) shows the server side alone.
+
+    python benchmarks/bench_getendpoints.py --proxies 100 --endpoints 20
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the controller with a route reproducing the handler as it was before caching
+CONTROLLER = """
+import sys
+import controller
+from controller import app, jsonify, logger, registered_proxies, request
+
+@app.route('/bench/jsonify', methods=['GET'])
+async def bench_jsonify():
+    proxy_id = request.args.get('proxy_id')
+    proxy_info = registered_proxies[proxy_id]
+    controller.touch(proxy_id)
+    controller.ensure_endpoints(proxy_id)
+    logger.info(f"Returning endpoints for {proxy_id}: {list(proxy_info['endpoints'].keys())}")
+    return jsonify({
+        'status': 'success',
+        'revision': proxy_info['revision'],
+        'endpoints': proxy_info['endpoints']
+    })
+
+controller.run_controller(host='127.0.0.1', port=int(sys.argv[1]))
+"""
+
+
+async def wait_until_up(client: httpx.AsyncClient, base: str):
+    for _ in range(100):
+        try:
+            await client.get(f"{base}/api/liveness")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Controller did not start")
+
+
+async def setup(client: httpx.AsyncClient, base: str, proxies: int, endpoints: int) -> dict:
+    """Register the proxies and return their ids mapped to the ETag they hold"""
+    etags = {}
+    for i in range(proxies):
+        proxy_id = f'bench-{i}'
+        await client.post(f"{base}/api/register", json={
+            'proxy_id': proxy_id, 'instance_name': f'bench{i}', 'host': '127.0.0.1', 'port': 20000 + i
+        })
+        bot = (await client.get(f"{base}/api/getendpoints", params={'proxy_id': proxy_id})).json()['endpoints']['BOT']
+        extra = {f'API{n}': {**bot, 'path': f'/v1/chat/completions/{n}'} for n in range(endpoints - 1)}
+        await client.post(f"{base}/api/update_proxy_endpoints/{proxy_id}", json={'endpoints': extra})
+        response = await client.get(f"{base}/api/getendpoints", params={'proxy_id': proxy_id})
+        etags[proxy_id] = response.headers['ETag']
+    return etags
+
+
+def cpu_seconds(pid: int) -> float:
+    """User plus system CPU time of a process, or NaN where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return float('nan')
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def run_mode(client: httpx.AsyncClient, base: str, mode: str, etags: dict, concurrency: int, seconds: float):
+    proxy_ids = list(etags)
+    path = '/bench/jsonify' if mode == 'jsonify' else '/api/getendpoints'
+    deadline = time.perf_counter() + seconds
+    done = 0
+    body_bytes = 0
+
+    async def worker(n: int):
+        nonlocal done, body_bytes
+        while time.perf_counter() < deadline:
+            proxy_id = proxy_ids[(n + done) % len(proxy_ids)]
+            headers = {'If-None-Match': etags[proxy_id]} if mode == 'etag 304' else {}
+            response = await client.get(f"{base}{path}", params={'proxy_id': proxy_id}, headers=headers)
+            assert response.status_code == (304 if mode == 'etag 304' else 200), response.status_code
+            done += 1
+            body_bytes += len(response.content)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return done / elapsed, body_bytes / max(1, done)
+
+
+async def bench(args):
+    base = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, CONTROLLER_REGISTRY=os.path.join(workdir, 'registry.db'))
+        log = open(os.path.join(workdir, 'controller.log'), 'w')
+        process = subprocess.Popen([sys.executable, '-c', CONTROLLER, str(args.port)],
+                                   cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+                await wait_until_up(client, base)
+                etags = await setup(client, base, args.proxies, args.endpoints)
+                print(f"{'mode':<12}{'requests/s':>12}{'body bytes':>12}{'server cpu ms/req':>19}")
+                for mode in ('jsonify', 'cached', 'etag 304'):
+                    cpu_before = cpu_seconds(process.pid)
+                    rate, size = await run_mode(client, base, mode, etags, args.concurrency, args.seconds)
+                    cpu_ms = (cpu_seconds(process.pid) - cpu_before) * 1000 / (rate * args.seconds)
+                    print(f"{mode:<12}{rate:>12.1f}{size:>12.0f}{cpu_ms:>19.2f}", flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proxies', type=int, default=100)
+    parser.add_argument('--endpoints', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=18001)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Query latency of the peer's full-text search index.
+
+Indexes --messages synthetic chat messages spread over --peers conversations.
+Words are drawn from a Zipf-like vocabulary, so some query words are rare
+and some appear in a large share of the history. Each query is then timed
+the way /search runs it, with one extra result fetched for paging.
+
+    python benchmarks/bench_search.py --messages 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search import SearchIndex  # noqa: E402
+
+VOCABULARY = [f'word{i}' for i in range(20000)]
+# Weight of the word at rank r is 1 / (r + 1), roughly the shape of real text
+CUMULATIVE_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+def make_messages(count: int, peers: int):
+    rng = random.Random(1)
+    base = datetime(2024, 1, 1)
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'peer_id': f'peer{i % peers}',
+            'sender': f'peer{i % peers}' if i % 2 else 'me',
+            'message': ' '.join(rng.choices(VOCABULARY, cum_weights=CUMULATIVE_WEIGHTS, k=rng.randint(4, 16))),
+            'status': 'success',
+            'timestamp': (base + timedelta(seconds=i)).isoformat(),
+            'auto_reply': i % 10 == 0
+        }
+
+
+# Label -> search() arguments; word0 is in about a third of all messages
+QUERIES = {
+    'rare word': {'query': 'word15000'},
+    'medium word': {'query': 'word300'},
+    'common word': {'query': 'word0'},
+    'two words': {'query': 'word0 word1'},
+    'prefix': {'query': 'word123*'},
+    'common + peer': {'query': 'word0', 'peer_id': 'peer3'},
+    'common + sender': {'query': 'word0', 'sender': 'me'},
+    'medium + range': {'query': 'word300', 'since': '2024-01-02', 'until': '2024-01-05'},
+    'medium + auto': {'query': 'word300', 'auto_reply': True},
+    'medium, page 5': {'query': 'word300', 'offset': 80}
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        index = SearchIndex(os.path.join(workdir, 'search.db'), batch_size=10000)
+        started = time.perf_counter()
+        for message in make_messages(args.messages, args.peers):
+            index.add(message)
+        index.flush()
+        print(f"Indexed {args.messages} messages in {time.perf_counter() - started:.1f} s")
+
+        print(f"{'query':<18}{'results':>9}{'median ms':>11}{'p95 ms':>9}")
+        for label, arguments in QUERIES.items():
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                results = index.search(**arguments, limit=21)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            print(f"{label:<18}{len(results):>9}{statistics.median(timings):>11.2f}{p95:>9.2f}", flush=True)
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Chat history insert and read throughput for the peer's storage backends.
+
+For each history size, the store is bulk-loaded with that many messages spread
+over --peers conversations. Then we time individual appends (what
+store_message does), full history reads for one conversation, and reads of
+its newest 50-message page (what /get_chat_history serves). Then the store
+is closed and reopened, which is what a peer restart pays before serving.
+Finally one conversation is cleared, then all of them.
+
+TinyDB rewrites its whole file on every insert, so its sample counts shrink
+as the history grows, to keep the run short.
+
+    python benchmarks/bench_storage.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import LogStore, PartitionedStore, SQLiteStore, TinyDBStore  # noqa: E402
+
+# Backend name -> (store class, file extension; None for a directory)
+BACKENDS = {
+    'partitioned': (PartitionedStore, None),
+    'sqlite': (SQLiteStore, 'db'),
+    'log': (LogStore, None),
+    'tinydb': (TinyDBStore, 'json')
+}
+
+
+def make_messages(count: int, peers: int, start: int = 0):
+    base = datetime(2024, 1, 1)
+    for i in range(start, start + count):
+        yield {
+            'peer_id': f'peer{i % peers}',
+            'sender': f'peer{i % peers}' if i % 2 else 'me',
+            'message': f'message number {i} with some ordinary chat text in it',
+            'status': 'success',
+            'timestamp': (base + timedelta(seconds=i)).isoformat(),
+            'auto_reply': False
+        }
+
+
+def run_case(backend: str, size: int, peers: int, workdir: str) -> dict:
+    store_class, extension = BACKENDS[backend]
+    path = os.path.join(workdir, f'{backend}_{size}' + (f'.{extension}' if extension else ''))
+    store = store_class(path)
+    try:
+        started = time.perf_counter()
+        store.insert_many(make_messages(size, peers))
+        load_s = time.perf_counter() - started
+
+        inserts = 2000 if backend != 'tinydb' else max(3, min(200, 2_000_000 // size))
+        started = time.perf_counter()
+        for message in make_messages(inserts, peers, start=size):
+            store.append(message)
+        insert_s = time.perf_counter() - started
+
+        reads = 50 if backend != 'tinydb' else max(3, min(50, 1_000_000 // size))
+        started = time.perf_counter()
+        for _ in range(reads):
+            conversation = store.history('peer0')
+        read_s = time.perf_counter() - started
+
+        pages = 2000 if backend != 'tinydb' else reads
+        started = time.perf_counter()
+        for _ in range(pages):
+            store.page('peer0', limit=50)
+        page_s = time.perf_counter() - started
+
+        store.close()
+        started = time.perf_counter()
+        store = store_class(path)
+        reopen_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.clear('peer1')
+        clear_s = time.perf_counter() - started
+        started = time.perf_counter()
+        store.clear_all()
+        clear_all_s = time.perf_counter() - started
+    finally:
+        store.close()
+
+    return {
+        'backend': backend,
+        'size': size,
+        'load_s': round(load_s, 2),
+        'inserts_per_s': round(inserts / insert_s, 1),
+        'history_len': len(conversation),
+        'reads_per_s': round(reads / read_s, 1),
+        'pages_per_s': round(pages / page_s, 1),
+        'reopen_s': round(reopen_s, 3),
+        'clear_ms': round(clear_s * 1000, 1),
+        'clear_all_ms': round(clear_all_s * 1000, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    args = parser.parse_args()
+
+    print(f"{'backend':<12}{'messages':>10}{'load s':>9}{'inserts/s':>11}{'history':>9}{'reads/s':>9}{'pages/s':>10}"
+          f"{'reopen s':>10}{'clear ms':>10}{'clear all ms':>14}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            for backend in args.backends:
+                result = run_case(backend, size, args.peers, workdir)
+                print(f"{result['backend']:<12}{result['size']:>10}{result['load_s']:>9}"
+                      f"{result['inserts_per_s']:>11}{result['history_len']:>9}{result['reads_per_s']:>9}{result['pages_per_s']:>10}"
+                      f"{result['reopen_s']:>10}{result['clear_ms']:>10}{result['clear_all_ms']:>14}",
+                      flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,22 @@
-from quart import Quart, jsonify, request, render_template, redirect, url_for
+from quart import Quart, Response, jsonify, request, render_template, redirect, url_for
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
+import copy
 import json
-from typing import Dict
+import time
+from collections import deque
+from typing import Dict, Optional
 import os
+from liveness import LivenessTracker
+from registry import ProxyRegistry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -20,8 +30,52 @@ app.secret_key = os.urandom(24)
 
 # Store registered proxies and their information
 registered_proxies: Dict = {}
+# Registrations and endpoint sets survive restarts in this database, opened at startup
+REGISTRY_PATH = os.environ.get('CONTROLLER_REGISTRY', 'controller_registry.db')
+registry: Optional[ProxyRegistry] = None
+
+# A proxy silent for longer than its instance's TTL is removed; PROXY_TTLS holds
+# per-instance overrides as JSON, e.g. '{"BOT-farm": 300}'
+DEFAULT_PROXY_TTL = float(os.environ.get('PROXY_TTL', 120.0))
+PROXY_TTLS: Dict[str, float] = json.loads(os.environ.get('PROXY_TTLS', '{}'))
+liveness = LivenessTracker(DEFAULT_PROXY_TTL, PROXY_TTLS)
+# Set when a deadline earlier than every other is added, so the expiry task wakes for it
+liveness_wakeup = asyncio.Event()
+liveness_task = None
+
+# Every change to a proxy's endpoints gets the next controller-wide revision,
+# so a proxy that re-registers never holds a revision newer than its new entry
+endpoint_revision = 0
+# Proxy id -> event set on that proxy's next endpoint change, waited on by watches
+endpoint_watchers: Dict[str, asyncio.Event] = {}
+WATCH_TIMEOUT = 30.0
+MAX_WATCH_TIMEOUT = 120.0
+# Endpoint changes remembered per proxy; a proxy further behind gets a full snapshot
+CHANGE_LOG_SIZE = 100
+# Proxy id -> (revision, serialized full endpoints response), dropped when the endpoints change
+endpoint_bodies: Dict[str, tuple] = {}
 
 # Configuration for endpoints
+# Timeouts, connection pool, concurrency and rate limits shared by every AI endpoint
+DEFAULT_UPSTREAM_SETTINGS = {
+    'timeout': {
+        'connect': 5.0,
+        'read': 30.0,
+        'write': 10.0,
+        'pool': 5.0
+    },
+    'pool': {
+        'max_connections': 20,
+        'max_keepalive_connections': 10,
+        'keepalive_expiry': 60.0,
+        'http2': True
+    },
+    'max_concurrency': 10,
+    'rate_limit': {
+        'requests_per_minute': 60,
+        'burst': 10
+    }
+}
 # Define default BOT endpoint separately
 DEFAULT_BOT_ENDPOINT = {
     'BOT': {
@@ -35,7 +89,7 @@ DEFAULT_BOT_ENDPOINT = {
         },
         'transform_request': 'openai_chat',
         'transform_response': 'openai_chat',
-        'timeout': 30.0,
+        **DEFAULT_UPSTREAM_SETTINGS,
         'model_config': {
             'model': 'gpt-3.5-turbo',
             'temperature': 0.7,
@@ -64,7 +118,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'openai_chat',
                 'transform_response': 'openai_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'model': 'gpt-4o',
                     'temperature': 0.7,
@@ -87,7 +141,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'anthropic_chat',
                 'transform_response': 'anthropic_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'model': 'claude-3-opus-20240229',
                     'max_tokens': 1024,
@@ -109,7 +163,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'gemini_chat',
                 'transform_response': 'gemini_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'temperature': 0.7,
                     'top_p': 1,
@@ -128,7 +182,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'openai_chat',  # Mistral uses OpenAI-compatible API
                 'transform_response': 'openai_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'model': 'mistral-large-latest',
                     'temperature': 0.7,
@@ -154,7 +208,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'openai_chat',
                 'transform_response': 'openai_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'model': 'gpt-3.5-turbo',  # Different model for Alice
                     'temperature': 0.9,        # Different temperature
@@ -182,7 +236,7 @@ DEFAULT_ENDPOINTS = {
                 },
                 'transform_request': 'openai_chat',
                 'transform_response': 'openai_chat',
-                'timeout': 30.0,
+                **DEFAULT_UPSTREAM_SETTINGS,
                 'model_config': {
                     'model': 'gpt-4-turbo-preview',  # Different model for Bob
                     'temperature': 0.5,              # Different temperature
@@ -204,25 +258,203 @@ DEFAULT_ENDPOINTS = {
     }
 }
 
-async def cleanup_stale_proxies():
-    """Remove proxies that haven't checked in for more than 2 minutes"""
-    while True:
-        try:
-            current_time = datetime.utcnow()
-            stale_proxies = []
+def merge_patch(original: dict, updated: dict) -> dict:
+    """JSON merge patch (RFC 7386) that turns `original` into `updated`; removed keys map to None"""
+    patch = {key: None for key in original if key not in updated}
+    for key, value in updated.items():
+        if key not in original:
+            patch[key] = value
+        elif original[key] != value:
+            if isinstance(original[key], dict) and isinstance(value, dict):
+                patch[key] = merge_patch(original[key], value)
+            else:
+                patch[key] = value
+    return patch
+
+
+def contains_none(value) -> bool:
+    if isinstance(value, dict):
+        return any(contains_none(item) for item in value.values())
+    return value is None
+
+
+def diff_endpoints(original: dict, updated: dict) -> dict:
+    """Endpoints added (sent whole), removed and patched between two endpoint sets"""
+    added = {name: config for name, config in updated.items() if name not in original}
+    removed = [name for name in original if name not in updated]
+    patched = {}
+    for name, config in updated.items():
+        if name in original and original[name] != config:
+            if isinstance(original[name], dict) and isinstance(config, dict) and not contains_none(config):
+                patched[name] = merge_patch(original[name], config)
+            else:
+                # A merge patch reads null as "remove", so such endpoints are replaced whole
+                added[name] = config
+    return {'added': added, 'removed': removed, 'patched': patched}
+
+
+class ChangeLog:
+    """The recent endpoint changes of one proxy, for serving diffs since a revision.
+
+    `published` is a private copy of the endpoint set as of the newest entry.
+    The log covers every change after revision `base`.
+    """
+
+    def __init__(self, endpoints: dict, revision: int, size: int = CHANGE_LOG_SIZE):
+        self.published = copy.deepcopy(endpoints)
+        self.base = revision
+        self.revision = revision
+        self.entries = deque(maxlen=size)
+
+    def record(self, endpoints: dict, revision: int) -> bool:
+        """Log the difference to the last published set; False if there is none"""
+        change = diff_endpoints(self.published, endpoints)
+        if not any(change.values()):
+            return False
+        if len(self.entries) == self.entries.maxlen:
+            self.base = self.entries[0]['revision']
+        self.entries.append({'revision': revision, **change})
+        self.published = copy.deepcopy(endpoints)
+        self.revision = revision
+        return True
+
+    def since(self, revision: int) -> Optional[list]:
+        """Changes after `revision`, oldest first, or None if the log does not reach back that far"""
+        if revision < self.base or revision > self.revision:
+            return None
+        return [entry for entry in self.entries if entry['revision'] > revision]
+
+
+# Proxy id -> ChangeLog of its endpoint set
+change_logs: Dict[str, ChangeLog] = {}
+
+
+def endpoints_changed(proxy_id: str):
+    """Give a proxy's changed endpoint set a new revision, log and persist the change and wake its watchers"""
+    global endpoint_revision
+    proxy_info = registered_proxies.get(proxy_id)
+    endpoint_bodies.pop(proxy_id, None)
+    if proxy_info is None:
+        change_logs.pop(proxy_id, None)
+        if registry:
+            registry.delete(proxy_id, endpoint_revision)
+    else:
+        log = change_logs.get(proxy_id)
+        if log is not None and not log.record(proxy_info['endpoints'], endpoint_revision + 1):
+            return
+        endpoint_revision += 1
+        proxy_info['revision'] = endpoint_revision
+        if log is None:
+            change_logs[proxy_id] = ChangeLog(proxy_info['endpoints'], endpoint_revision)
+        if registry:
+            registry.save(proxy_id, proxy_info, endpoint_revision)
+    event = endpoint_watchers.pop(proxy_id, None)
+    if event:
+        event.set()
+
+
+def load_registry():
+    """Restore the registered proxies saved before the last shutdown"""
+    global endpoint_revision
+    proxies, endpoint_revision = registry.load()
+    for proxy_id, proxy_info in proxies.items():
+        registered_proxies[proxy_id] = proxy_info
+        change_logs[proxy_id] = ChangeLog(proxy_info['endpoints'], proxy_info['revision'])
+        # Count reloaded proxies as just seen, so they get a full TTL to check in
+        touch(proxy_id)
+    logger.info(f"Restored {len(proxies)} proxies from {REGISTRY_PATH} at revision {endpoint_revision}")
+
+
+@app.before_serving
+async def startup():
+    global liveness_task, registry
+    registry = ProxyRegistry(REGISTRY_PATH)
+    load_registry()
+    liveness_task = asyncio.create_task(expire_stale_proxies())
+
+
+@app.after_serving
+async def shutdown():
+    if liveness_task:
+        liveness_task.cancel()
+    if registry:
+        registry.close()
+
+
+def dump_json(data) -> bytes:
+    """Serialize a response body, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def endpoints_body(proxy_id: str) -> bytes:
+    """The full endpoints response for a proxy, serialized once per revision"""
+    proxy_info = registered_proxies[proxy_id]
+    cached = endpoint_bodies.get(proxy_id)
+    if cached is None or cached[0] != proxy_info['revision']:
+        cached = (proxy_info['revision'], dump_json({
+            'status': 'success',
+            'revision': proxy_info['revision'],
+            'endpoints': proxy_info['endpoints']
+        }))
+        endpoint_bodies[proxy_id] = cached
+    return cached[1]
+
+
+def endpoints_response(proxy_id: str, revision: Optional[int]) -> Response:
+    """The changes since a client's revision if they are still logged, otherwise a full snapshot.
+
+    Snapshots carry the revision as their ETag.
+    """
+    proxy_info = registered_proxies[proxy_id]
+    log = change_logs.get(proxy_id)
+    changes = log.since(revision) if log is not None and revision else None
+    if changes is not None:
+        return jsonify({'status': 'success', 'revision': proxy_info['revision'], 'changes': changes})
+    return Response(
+        endpoints_body(proxy_id),
+        content_type='application/json',
+        headers={'ETag': f'"{proxy_info["revision"]}"'}
+    )
+
+
+def touch(proxy_id: str):
+    """Record that a proxy was heard from and push out its expiry"""
+    proxy_info = registered_proxies[proxy_id]
+    proxy_info['last_seen'] = datetime.now()
+    if liveness.renew(proxy_id, proxy_info['instance_name']):
+        liveness_wakeup.set()
 
-            for proxy_id, info in registered_proxies.items():
-                if current_time - info['last_seen'] > timedelta(minutes=2):
-                    stale_proxies.append(proxy_id)
 
-            for proxy_id in stale_proxies:
-                logger.info(f"Removing stale proxy: {proxy_id}")
-                del registered_proxies[proxy_id]
+async def expire_stale_proxies():
+    """Remove each proxy as soon as its TTL passes without word from it"""
+    while True:
+        try:
+            for proxy_id in liveness.expire():
+                proxy_info = registered_proxies.pop(proxy_id, None)
+                if proxy_info is None:
+                    continue
+                logger.info(f"Removing stale proxy: {proxy_id} ({proxy_info['instance_name']})")
+                liveness.expiries.append({
+                    'proxy_id': proxy_id,
+                    'instance_name': proxy_info['instance_name'],
+                    'last_seen': proxy_info['last_seen'].isoformat(),
+                    'expired_at': datetime.now().isoformat(),
+                    'ttl': liveness.ttl(proxy_info['instance_name'])
+                })
+                endpoints_changed(proxy_id)
 
-            await asyncio.sleep(60)
+            deadline = liveness.next_deadline()
+            liveness_wakeup.clear()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(liveness_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
         except Exception as e:
-            logger.error(f"Error in cleanup task: {e}")
-            await asyncio.sleep(60)
+            logger.error(f"Error in expiry task: {e}")
+            await asyncio.sleep(1)
 
 
 # API Routes
@@ -246,7 +478,11 @@ async def register_proxy():
             }), 400
 
         # Initialize endpoints based on instance type
-        if instance_name in DEFAULT_ENDPOINTS:
+        if proxy_id in registered_proxies:
+            # Re-registration (e.g. after a lost heartbeat) keeps any customized endpoints
+            initial_endpoints = registered_proxies[proxy_id]['endpoints']
+            logger.info(f"Proxy {proxy_id} ({instance_name}) registered again; keeping its endpoints")
+        elif instance_name in DEFAULT_ENDPOINTS:
             # Known instance gets full default configuration
             initial_endpoints = DEFAULT_ENDPOINTS[instance_name]['endpoints'].copy()
             logger.info(f"Using predefined endpoints for {instance_name}")
@@ -259,15 +495,19 @@ async def register_proxy():
             'instance_name': instance_name,
             'host': host,
             'port': port,
-            'last_seen': datetime.now(),
             'endpoints': initial_endpoints
         }
+        touch(proxy_id)
+        # A new registration starts a new change log
+        change_logs.pop(proxy_id, None)
+        endpoints_changed(proxy_id)
 
         logger.info(f"Registering {instance_name} with endpoints: {list(initial_endpoints.keys())}")
 
         return jsonify({
             'status': 'success',
             'message': 'Successfully registered',
+            'revision': registered_proxies[proxy_id]['revision'],
             'endpoints': initial_endpoints
         })
 
@@ -281,9 +521,15 @@ async def register_proxy():
 
 @app.route('/api/getendpoints', methods=['GET'])
 async def get_endpoints():
-    """Return proxy-specific endpoint configuration"""
+    """Return proxy-specific endpoint configuration.
+
+    With a `revision` query parameter, returns only the changes since that
+    revision when they are still logged. A poll whose If-None-Match holds
+    the current revision's ETag gets 304.
+    """
     try:
         proxy_id = request.args.get('proxy_id')
+        revision = request.args.get('revision', type=int)
 
         if not proxy_id or proxy_id not in registered_proxies:
             return jsonify({
@@ -291,29 +537,19 @@ async def get_endpoints():
                 'message': 'Unknown proxy'
             }), 404
 
-        # Update last seen timestamp
-        registered_proxies[proxy_id]['last_seen'] = datetime.now()
+        touch(proxy_id)
 
         proxy_info = registered_proxies[proxy_id]
         instance_name = proxy_info['instance_name']
 
-        # If no endpoints exist yet, initialize them
-        if 'endpoints' not in proxy_info:
-            if instance_name in DEFAULT_ENDPOINTS:
-                proxy_info['endpoints'] = DEFAULT_ENDPOINTS[instance_name]['endpoints'].copy()
-            else:
-                proxy_info['endpoints'] = DEFAULT_BOT_ENDPOINT.copy()
+        ensure_endpoints(proxy_id)
 
-        # Ensure BOT endpoint is always present, but don't overwrite if exists
-        if 'BOT' not in proxy_info['endpoints']:
-            proxy_info['endpoints']['BOT'] = DEFAULT_BOT_ENDPOINT['BOT']
+        if request.if_none_match.contains(str(proxy_info['revision'])):
+            return Response(status=304, headers={'ETag': f'"{proxy_info["revision"]}"'})
 
-        logger.info(f"Returning endpoints for {proxy_id} ({instance_name}): {list(proxy_info['endpoints'].keys())}")
+        logger.debug(f"Returning endpoints for {proxy_id} ({instance_name}): {list(proxy_info['endpoints'].keys())}")
 
-        return jsonify({
-            'status': 'success',
-            'endpoints': proxy_info['endpoints']
-        })
+        return endpoints_response(proxy_id, revision)
 
     except Exception as e:
         logger.error(f"Error getting endpoints: {e}")
@@ -323,6 +559,71 @@ async def get_endpoints():
         }), 500
 
 
+def ensure_endpoints(proxy_id: str):
+    """Fill in a proxy's default endpoints and BOT endpoint if they are missing"""
+    proxy_info = registered_proxies[proxy_id]
+    instance_name = proxy_info['instance_name']
+    changed = False
+
+    # If no endpoints exist yet, initialize them
+    if 'endpoints' not in proxy_info:
+        if instance_name in DEFAULT_ENDPOINTS:
+            proxy_info['endpoints'] = DEFAULT_ENDPOINTS[instance_name]['endpoints'].copy()
+        else:
+            proxy_info['endpoints'] = DEFAULT_BOT_ENDPOINT.copy()
+        changed = True
+
+    # Ensure BOT endpoint is always present, but don't overwrite if exists
+    if 'BOT' not in proxy_info['endpoints']:
+        proxy_info['endpoints']['BOT'] = DEFAULT_BOT_ENDPOINT['BOT']
+        changed = True
+
+    if changed:
+        endpoints_changed(proxy_id)
+
+
+@app.route('/api/watchendpoints', methods=['GET'])
+async def watch_endpoints():
+    """Long-poll for a proxy's endpoint configuration.
+
+    Answers as soon as the proxy's endpoints have a revision newer than the
+    `revision` query parameter, or with 304 once `timeout` seconds pass
+    without a change. The answer lists the changes since `revision`, or
+    holds the full endpoint set when the change log no longer covers it.
+    """
+    proxy_id = request.args.get('proxy_id')
+    try:
+        revision = int(request.args.get('revision', 0))
+        timeout = min(float(request.args.get('timeout', WATCH_TIMEOUT)), MAX_WATCH_TIMEOUT)
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'revision and timeout must be numbers'
+        }), 400
+
+    deadline = time.monotonic() + timeout
+    while True:
+        # Checked again after every wake-up, since the proxy may have been removed
+        if not proxy_id or proxy_id not in registered_proxies:
+            return jsonify({
+                'status': 'error',
+                'message': 'Unknown proxy'
+            }), 404
+
+        proxy_info = registered_proxies[proxy_id]
+        touch(proxy_id)
+        ensure_endpoints(proxy_id)
+        if proxy_info['revision'] > revision:
+            logger.info(f"Sending revision {proxy_info['revision']} of endpoints to {proxy_id}")
+            return endpoints_response(proxy_id, revision)
+
+        event = endpoint_watchers.setdefault(proxy_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return '', 304
+
+
 # Add this helper function to controller.py
 def deep_merge(original, update):
     """
@@ -409,13 +710,14 @@ async def update_proxy_endpoints(proxy_id):
 
         # Store the updated configuration
         proxy_info['endpoints'] = current_endpoints
+        endpoints_changed(proxy_id)
 
         logger.info(f"Updated endpoints for {proxy_id}: {list(current_endpoints.keys())}")
-        logger.debug(f"Full endpoint configuration: {json.dumps(current_endpoints, indent=2)}")
 
         return jsonify({
             'status': 'success',
             'message': f'Updated endpoints for proxy {proxy_id}',
+            'revision': proxy_info['revision'],
             'endpoints': current_endpoints
         })
 
@@ -440,7 +742,7 @@ async def heartbeat():
                 'message': 'Unknown proxy'
             }), 404
 
-        registered_proxies[proxy_id]['last_seen'] = datetime.utcnow()
+        touch(proxy_id)
 
         return jsonify({
             'status': 'success',
@@ -463,15 +765,23 @@ async def index():
     return await render_template(
         'controller.html',
         proxies=registered_proxies,
-        current_time=datetime.now()  # Changed from utcnow
+        liveness=liveness
     )
 
+
+@app.route('/api/liveness', methods=['GET'])
+async def liveness_stats():
+    """Liveness tracker counters, TTLs and the most recent expiries"""
+    return jsonify(liveness.stats())
+
 @app.route('/api/remove_proxy/<proxy_id>', methods=['POST'])
 async def remove_proxy(proxy_id):
     """Remove a proxy from the registered list"""
     try:
         if proxy_id in registered_proxies:
             del registered_proxies[proxy_id]
+            liveness.forget(proxy_id)
+            endpoints_changed(proxy_id)
             return jsonify({
                 'status': 'success',
                 'message': f'Removed proxy {proxy_id}'
@@ -565,10 +875,10 @@ CONTROLLER_TEMPLATE = """
                             <div class="text-sm text-gray-600">
                                 Host: {{ info.host }} | Port: {{ info.port }} | 
                                 Last Seen: {{ (info.last_seen).strftime('%Y-%m-%d %H:%M:%S') }}
-                                {% set time_diff = (current_time - info.last_seen).total_seconds() %}
-                                {% if time_diff < 60 %}
+                                {% set remaining = liveness.remaining(proxy_id) or 0 %}
+                                {% if remaining > liveness.ttl(info.instance_name) / 2 %}
                                     <span class="px-2 py-1 bg-green-100 text-green-800 rounded">Active</span>
-                                {% elif time_diff < 120 %}
+                                {% elif remaining > 0 %}
                                     <span class="px-2 py-1 bg-yellow-100 text-yellow-800 rounded">Warning</span>
                                 {% else %}
                                     <span class="px-2 py-1 bg-red-100 text-red-800 rounded">Stale</span>
@@ -599,6 +909,19 @@ CONTROLLER_TEMPLATE = """
                 {% endfor %}
             </div>
         </div>
+
+        <!-- Recently Expired Section -->
+        <div class="bg-white rounded-lg shadow-md p-6 mb-8">
+            <h2 class="text-2xl font-bold mb-4">Recently Expired</h2>
+            {% for event in liveness.expiries | reverse %}
+            <div class="text-sm text-gray-600">
+                {{ event.instance_name }} ({{ event.proxy_id[:8] }}...) |
+                Last Seen: {{ event.last_seen[:19] }} | Expired: {{ event.expired_at[:19] }} | TTL: {{ event.ttl }}s
+            </div>
+            {% else %}
+            <div class="text-sm text-gray-600">No proxies have expired.</div>
+            {% endfor %}
+        </div>
     </div>
 </body>
 </html>
@@ -608,8 +931,11 @@ with open(os.path.join(app.template_folder, 'controller.html'), 'w') as f:
     f.write(CONTROLLER_TEMPLATE)
 
 
-def run_controller(host='0.0.0.0', port=8000):
-    """Run the controller service"""
+def run_controller(host='0.0.0.0', port=8000, registry_path: Optional[str] = None):
+    """Run the controller service, keeping its registry at `registry_path` (default REGISTRY_PATH)"""
+    global REGISTRY_PATH
+    if registry_path:
+        REGISTRY_PATH = registry_path
     config = Config()
     config.bind = [f"{host}:{port}"]
 
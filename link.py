@@ -0,0 +1,365 @@
+import asyncio
+import json
+import logging
+import random
+import ssl
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+from urllib.parse import urlencode, urlsplit
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection, CloseConnection, Ping, RejectConnection, Request, TextMessage
+)
+
+logger = logging.getLogger('link')
+
+
+class WebSocketClient:
+    """Client side of a WebSocket over asyncio streams.
+
+    Uses wsproto, which hypercorn already depends on, so links need no extra
+    package. Only text frames are used.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: WSConnection):
+        self.reader = reader
+        self.writer = writer
+        self.connection = connection
+        self.events = []
+        self.fragments = []
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, url: str, timeout: float) -> 'WebSocketClient':
+        """Open a WebSocket to an http(s):// URL; raises ConnectionError if refused"""
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        port = parts.port or (443 if secure else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                parts.hostname, port,
+                ssl=ssl.create_default_context() if secure else None
+            ),
+            timeout
+        )
+        connection = WSConnection(ConnectionType.CLIENT)
+        target = parts.path + (f"?{parts.query}" if parts.query else '')
+        writer.write(connection.send(Request(host=parts.netloc, target=target)))
+        client = cls(reader, writer, connection)
+        try:
+            await asyncio.wait_for(client._handshake(), timeout)
+        except BaseException:
+            writer.close()
+            raise
+        return client
+
+    async def _handshake(self):
+        while True:
+            await self._read_events()
+            while self.events:
+                event = self.events.pop(0)
+                if isinstance(event, AcceptConnection):
+                    return
+                if isinstance(event, RejectConnection):
+                    raise ConnectionError(f"Link rejected with status {event.status_code}")
+
+    async def _read_events(self):
+        data = await self.reader.read(65536)
+        if not data:
+            raise ConnectionError("Connection closed by remote")
+        self.connection.receive_data(data)
+        self.events.extend(self.connection.events())
+
+    async def _write(self, data: bytes):
+        async with self.lock:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def send(self, text: str):
+        await self._write(self.connection.send(TextMessage(data=text)))
+
+    async def receive(self) -> str:
+        """Return the next text message; raises ConnectionError once the link closes"""
+        while True:
+            while self.events:
+                event = self.events.pop(0)
+                if isinstance(event, TextMessage):
+                    self.fragments.append(event.data)
+                    if event.message_finished:
+                        text = ''.join(self.fragments)
+                        self.fragments = []
+                        return text
+                elif isinstance(event, Ping):
+                    await self._write(self.connection.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    await self._write(self.connection.send(event.response()))
+                    raise ConnectionError(f"Link closed by remote ({event.code})")
+            await self._read_events()
+
+    async def close(self):
+        try:
+            await self._write(self.connection.send(CloseConnection(code=1000)))
+        except Exception:
+            pass
+        self.writer.close()
+
+
+class QuartWebSocket:
+    """Adapts an accepted Quart websocket to the WebSocketClient interface"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    async def send(self, text: str):
+        await self.websocket.send(text)
+
+    async def receive(self) -> str:
+        return await self.websocket.receive()
+
+    async def close(self):
+        await self.websocket.close(1000)
+
+
+class ProxyLink:
+    """A long-lived, multiplexed channel to one remote proxy.
+
+    Frames are JSON text messages:
+        {"type": "batch", "id": n, "source": name, "messages": [{target, data}]}
+        {"type": "ack", "id": n}
+        {"type": "ping"} / {"type": "pong"}
+
+    Outgoing batches wait in a bounded per-link queue and are written by one
+    task, so they arrive in order. Each batch stays in `unacked` until the
+    remote proxy has queued it for delivery. When the link drops, or a
+    write on it fails, unacked and queued batches are handed to the
+    `undelivered` callback, which resends them over HTTP. Delivery is
+    therefore at-least-once across a reconnect.
+
+    Only connections this proxy dialed carry outgoing batches. Anyone can
+    open an accepted connection and claim to be a given proxy, so those
+    only receive.
+    """
+
+    def __init__(self, manager: 'LinkManager', origin: str):
+        self.manager = manager
+        self.origin = origin
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=manager.queue_size)
+        self.unacked: OrderedDict = OrderedDict()
+        self.next_id = 0
+        self.transport = None
+        self.direction = None
+        self.dial_task: Optional[asyncio.Task] = None
+        self.counters = {
+            'connects': 0,
+            'disconnects': 0,
+            'frames_sent': 0,
+            'messages_sent': 0,
+            'frames_received': 0,
+            'messages_received': 0,
+            'redelivered': 0,
+            'queue_full': 0
+        }
+
+    @property
+    def connected(self) -> bool:
+        return self.transport is not None
+
+    def send(self, messages: list) -> bool:
+        """Queue a batch on the link; False if it is down or backed up, so the caller falls back"""
+        if self.transport is None:
+            self.dial()
+            return False
+        try:
+            self.outbox.put_nowait(messages)
+        except asyncio.QueueFull:
+            self.counters['queue_full'] += 1
+            return False
+        return True
+
+    def dial(self):
+        """Start connecting to the remote proxy in the background, if not already"""
+        if self.dial_task is None or self.dial_task.done():
+            self.dial_task = asyncio.create_task(self._dial_loop())
+
+    async def _dial_loop(self):
+        backoff = self.manager.backoff_min
+        url = f"{self.origin}/_link?{urlencode({'source': self.manager.instance_name})}"
+        while True:
+            try:
+                transport = await WebSocketClient.connect(url, self.manager.connect_timeout)
+            except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                delay = backoff * random.uniform(0.5, 1.5)
+                logger.warning(f"Link to {self.origin} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.manager.backoff_max)
+                continue
+            backoff = self.manager.backoff_min
+            await self.serve(transport, 'dialed')
+
+    async def serve(self, transport, direction: str):
+        """Run a connection until it closes; a dialed one carries outgoing batches"""
+        attached = direction == 'dialed' and self.transport is None
+        if attached:
+            self.transport = transport
+            self.direction = direction
+            self.counters['connects'] += 1
+            logger.info(f"Link to {self.origin} up ({direction})")
+
+        self.last_seen = time.monotonic()
+        tasks = [asyncio.create_task(self._keepalive(transport))]
+        if attached:
+            tasks.append(asyncio.create_task(self._writer(transport)))
+        try:
+            while True:
+                frame = json.loads(await transport.receive())
+                self.last_seen = time.monotonic()
+                await self._handle(transport, frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Link to {self.origin} closed: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            if attached:
+                self._detach()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await transport.close()
+            except Exception:
+                pass
+
+    async def _handle(self, transport, frame: dict):
+        kind = frame.get('type')
+        if kind == 'batch':
+            messages = frame.get('messages') or []
+            self.counters['frames_received'] += 1
+            self.counters['messages_received'] += len(messages)
+            # Blocks until the messages are queued, which pushes back on the sender.
+            # The frame's own `source` is unverified; the link's origin was resolved on connect
+            await self.manager.receive(self.origin, messages)
+            await transport.send(json.dumps({'type': 'ack', 'id': frame.get('id')}))
+        elif kind == 'ack':
+            self.unacked.pop(frame.get('id'), None)
+        elif kind == 'ping':
+            await transport.send(json.dumps({'type': 'pong'}))
+
+    async def _writer(self, transport):
+        try:
+            while True:
+                messages = await self.outbox.get()
+                self.next_id += 1
+                self.unacked[self.next_id] = messages
+                await transport.send(json.dumps({
+                    'type': 'batch',
+                    'id': self.next_id,
+                    'source': self.manager.instance_name,
+                    'messages': messages
+                }))
+                self.counters['frames_sent'] += 1
+                self.counters['messages_sent'] += len(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Closing ends the receive loop in serve(), which detaches the link
+            # and resends everything unacked, including this batch
+            logger.warning(f"Link to {self.origin} failed to send, reconnecting: {e}")
+            await transport.close()
+
+    async def _keepalive(self, transport):
+        interval = self.manager.ping_interval
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_seen > interval * 3:
+                logger.warning(f"Link to {self.origin} missed keep-alives, reconnecting")
+                await transport.close()
+                return
+            await transport.send(json.dumps({'type': 'ping'}))
+
+    def _detach(self):
+        """Mark the link down and hand everything not yet acknowledged to the fallback path"""
+        self.transport = None
+        self.direction = None
+        self.counters['disconnects'] += 1
+        pending = list(self.unacked.values())
+        self.unacked.clear()
+        while not self.outbox.empty():
+            pending.append(self.outbox.get_nowait())
+        for messages in pending:
+            self.counters['redelivered'] += len(messages)
+            self.manager.undelivered(self.origin, messages)
+
+    def stats(self) -> dict:
+        return {
+            'connected': self.connected,
+            'direction': self.direction,
+            'queued': self.outbox.qsize(),
+            'unacked': len(self.unacked),
+            **self.counters
+        }
+
+    async def close(self):
+        if self.dial_task:
+            self.dial_task.cancel()
+            await asyncio.gather(self.dial_task, return_exceptions=True)
+        if self.transport:
+            await self.transport.close()
+
+
+class LinkManager:
+    """Owns the ProxyLink to each remote proxy origin.
+
+    `receive(source, messages)` is awaited for every batch that arrives
+    on any link, with the origin the link was dialed to or accepted as;
+    `undelivered(origin, messages)` is called for batches a dropped link
+    could not confirm.
+    """
+
+    def __init__(self, instance_name: str,
+                 receive: Callable[[str, list], Awaitable],
+                 undelivered: Callable[[str, list], None],
+                 queue_size: int = 1000,
+                 ping_interval: float = 20.0,
+                 connect_timeout: float = 5.0,
+                 backoff_min: float = 0.5,
+                 backoff_max: float = 30.0):
+        self.instance_name = instance_name
+        self.receive = receive
+        self.undelivered = undelivered
+        self.queue_size = queue_size
+        self.ping_interval = ping_interval
+        self.connect_timeout = connect_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.links: Dict[str, ProxyLink] = {}
+        # Receive-only links opened by remote proxies, by the origin they were accepted as
+        self.accepted: Dict[str, ProxyLink] = {}
+
+    def link_for(self, origin: str) -> ProxyLink:
+        link = self.links.get(origin)
+        if link is None:
+            link = self.links[origin] = ProxyLink(self, origin)
+        return link
+
+    def send(self, origin: str, messages: list) -> bool:
+        """Send a batch over the link to `origin`, dialing it if needed; False means use HTTP"""
+        return self.link_for(origin).send(messages)
+
+    async def accept(self, origin: str, websocket):
+        """Serve a link opened by a remote proxy until it closes; it only carries batches to us"""
+        link = self.accepted.get(origin)
+        if link is None:
+            link = self.accepted[origin] = ProxyLink(self, origin)
+        await link.serve(QuartWebSocket(websocket), 'accepted')
+
+    def stats(self) -> dict:
+        return {
+            **{origin: link.stats() for origin, link in self.links.items()},
+            **{f"accepted:{origin}": link.stats() for origin, link in self.accepted.items()}
+        }
+
+    async def close(self):
+        for link in list(self.links.values()):
+            await link.close()
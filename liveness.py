@@ -0,0 +1,82 @@
+import heapq
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+class LivenessTracker:
+    """Expiry deadlines for registered proxies on the monotonic clock.
+
+    Each renewal pushes a new (deadline, proxy_id) entry onto a heap, in
+    O(log n), and leaves the entry it replaces in place; stale entries are
+    skipped when they reach the top. The heap is rebuilt when stale entries
+    outnumber live ones, so it stays within a small multiple of the proxy
+    count. Finding what has expired only looks at the top of the heap.
+    """
+
+    def __init__(self, default_ttl: float, ttls: Optional[Dict[str, float]] = None, history: int = 100):
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})
+        self.deadlines: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        # Most recent expiries, newest last, for the dashboard
+        self.expiries = deque(maxlen=history)
+        self.counters = {'renewals': 0, 'expired': 0, 'forgotten': 0, 'compactions': 0}
+
+    def ttl(self, instance_name: str) -> float:
+        """Seconds a proxy of this instance may stay silent before it expires"""
+        return self.ttls.get(instance_name, self.default_ttl)
+
+    def renew(self, proxy_id: str, instance_name: str) -> bool:
+        """Push a proxy's deadline out by its TTL; True if it is now the earliest deadline"""
+        deadline = time.monotonic() + self.ttl(instance_name)
+        self.deadlines[proxy_id] = deadline
+        heapq.heappush(self.heap, (deadline, proxy_id))
+        self.counters['renewals'] += 1
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, pid) for pid, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+            self.counters['compactions'] += 1
+        return self.heap[0] == (deadline, proxy_id)
+
+    def forget(self, proxy_id: str):
+        """Stop tracking a proxy that was removed; its heap entries go stale"""
+        if self.deadlines.pop(proxy_id, None) is not None:
+            self.counters['forgotten'] += 1
+
+    def next_deadline(self) -> Optional[float]:
+        """Monotonic time of the earliest live deadline, or None if nothing is tracked"""
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        """Stop tracking and return the proxies whose deadline has passed"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, proxy_id = heapq.heappop(self.heap)
+            del self.deadlines[proxy_id]
+            expired.append(proxy_id)
+        self.counters['expired'] += len(expired)
+        return expired
+
+    def remaining(self, proxy_id: str) -> Optional[float]:
+        """Seconds until a proxy expires, or None if it is not tracked"""
+        deadline = self.deadlines.get(proxy_id)
+        return None if deadline is None else deadline - time.monotonic()
+
+    def stats(self) -> dict:
+        deadline = self.next_deadline()
+        return {
+            **self.counters,
+            'tracked': len(self.deadlines),
+            'heap_size': len(self.heap),
+            'default_ttl': self.default_ttl,
+            'ttls': self.ttls,
+            'next_expiry_in': round(deadline - time.monotonic(), 3) if deadline is not None else None,
+            'recent_expiries': list(self.expiries)
+        }
@@ -1,6 +1,5 @@
 from quart import Quart, render_template, jsonify, request, make_response
 import httpx
-from tinydb import TinyDB, Query
 from datetime import datetime
 import logging
 import os
@@ -11,8 +10,14 @@ from hypercorn.config import Config
 from hypercorn.asyncio import serve
 import json
 import random
+from collections import deque
+from typing import Optional
 from quart import Response
-from asyncio import create_task
+from scheduler import SendScheduler, SchedulerFull
+from storage import open_store, JournalUnavailable, RecentMessagesCache, WriteBehindStore
+from archive import ArchivedStore, MessageArchive
+from search import SearchIndex, fts5_available
+from urllib.parse import quote
 
 # Configure logging
 logging.basicConfig(
@@ -26,13 +31,153 @@ PEER_PORT = int(os.environ.get('CLIENT_PORT', 5000))
 PROXY_PORT = int(os.environ.get('PROXY_PORT', 10000))
 INSTANCE_NAME = os.environ.get('INSTANCE_NAME', 'main')
 AUTO_MODE = os.environ.get('AUTO_MODE', 'false').lower() == 'true'
-
-# Initialize TinyDB with instance-specific database
-db = TinyDB(f'chat_history_{INSTANCE_NAME}.json')
-messages_table = db.table('messages')
+SEND_QUEUE_SIZE = int(os.environ.get('SEND_QUEUE_SIZE', 100))
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 4))
+SHUTDOWN_DEADLINE = float(os.environ.get('SHUTDOWN_DEADLINE', 10.0))
+MESSAGE_STORE = os.environ.get('MESSAGE_STORE', 'partitioned')
+LOG_COMPACT_INTERVAL = float(os.environ.get('LOG_COMPACT_INTERVAL', 60))
+JOURNAL_BATCH_SIZE = int(os.environ.get('JOURNAL_BATCH_SIZE', 100))
+JOURNAL_FLUSH_MS = float(os.environ.get('JOURNAL_FLUSH_MS', 50))
+JOURNAL_MAX_PENDING = int(os.environ.get('JOURNAL_MAX_PENDING', 10000))
+DURABLE_WRITES = os.environ.get('DURABLE_WRITES', 'false').lower() == 'true'
+HISTORY_CACHE_PER_PEER = int(os.environ.get('HISTORY_CACHE_PER_PEER', 200))
+HISTORY_CACHE_BUDGET = int(os.environ.get('HISTORY_CACHE_BUDGET', 10000))
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+RETENTION_MAX_MESSAGES = int(os.environ.get('RETENTION_MAX_MESSAGES', 10000))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 300))
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'gzip')
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 256))
+SSE_BACKLOG_SIZE = int(os.environ.get('SSE_BACKLOG_SIZE', 1000))
+SSE_REPLAY_LIMIT = 1000
+SSE_KEEPALIVE = 15.0
+
+# Open the instance-specific chat history (an existing TinyDB file is migrated once).
+# Writes go through a group-commit journal; see WriteBehindStore for the crash-loss bound.
+# Messages past the retention limits move to compressed archive segments.
+# Recent messages of each conversation are served from memory.
+message_backend = open_store(MESSAGE_STORE, INSTANCE_NAME)
+message_archive = MessageArchive(f'chat_archive_{INSTANCE_NAME}', compression=ARCHIVE_COMPRESSION)
+message_journal = WriteBehindStore(
+    message_backend,
+    batch_size=JOURNAL_BATCH_SIZE,
+    flush_interval=JOURNAL_FLUSH_MS / 1000,
+    max_pending=JOURNAL_MAX_PENDING,
+    min_id=message_archive.max_id()
+)
+archived_store = ArchivedStore(
+    message_journal,
+    message_archive,
+    max_age_days=RETENTION_MAX_AGE_DAYS,
+    max_messages=RETENTION_MAX_MESSAGES
+)
+message_store = RecentMessagesCache(
+    archived_store,
+    per_peer=HISTORY_CACHE_PER_PEER,
+    budget=HISTORY_CACHE_BUDGET
+)
+# Full-text search over every stored message, archived ones included
+search_index = SearchIndex(f'chat_search_{INSTANCE_NAME}.db') if fts5_available() else None
 
 app = Quart(__name__)
 http_client = None
+send_scheduler = None
+compaction_task = None
+retention_task = None
+index_task = None
+
+
+class Broadcaster:
+    """In-process pub/sub feeding the /message_updates SSE streams.
+
+    Every subscriber gets a bounded queue. When a subscriber falls behind on
+    stored messages, its backlog is replaced by one `resync` event telling the
+    UI to reload, so a slow tab neither holds unbounded memory nor slows the
+    others. Partial AI replies are just skipped for a full queue.
+
+    The last `backlog_size` messages are kept so a reconnecting client can be
+    sent what it missed. `floor` is the newest id that is *not* in the
+    backlog; gaps reaching back past it have to be read from the store.
+    """
+
+    def __init__(self, queue_size: int, backlog_size: int, floor: int = 0):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.backlog = deque()
+        self.backlog_size = backlog_size
+        self.floor = floor
+        self.counters = {
+            'published': 0,
+            'resyncs': 0,
+            'dropped_partials': 0,
+            'backlog_replays': 0,
+            'store_replays': 0,
+            'replayed_messages': 0
+        }
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event: str, data: dict):
+        """Hand an event to every subscriber without waiting on any of them"""
+        self.counters['published'] += 1
+        if event == 'message':
+            self.backlog.append(data)
+            if len(self.backlog) > self.backlog_size:
+                self.floor = self.backlog.popleft()['id']
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                if event == 'partial':
+                    # The final message is stored anyway; a slow tab only loses partial text
+                    self.counters['dropped_partials'] += 1
+                    continue
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(('resync', {}))
+                self.counters['resyncs'] += 1
+
+    def missed(self, last_id: int) -> list:
+        """Messages stored after `last_id`, from the backlog or else the store.
+
+        Returns at most SSE_REPLAY_LIMIT + 1 messages; more than the limit means
+        the client should reload instead.
+        """
+        if last_id >= self.floor:
+            self.counters['backlog_replays'] += 1
+            missed = [message for message in self.backlog if message['id'] > last_id]
+            missed = missed[:SSE_REPLAY_LIMIT + 1]
+        else:
+            self.counters['store_replays'] += 1
+            missed = message_store.since(last_id, SSE_REPLAY_LIMIT + 1)
+        self.counters['replayed_messages'] += min(len(missed), SSE_REPLAY_LIMIT)
+        return missed
+
+    def forget(self, peer_id: Optional[str] = None):
+        """Drop a cleared conversation (or every one) from the backlog so it is never replayed"""
+        self.backlog = deque(message for message in self.backlog if peer_id is not None and message['peer_id'] != peer_id)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'subscribers': len(self.subscribers),
+            'queue_size': self.queue_size,
+            'backlog': len(self.backlog),
+            'backlog_floor': self.floor
+        }
+
+
+# Messages already on disk at startup are only reachable through the store
+broadcaster = Broadcaster(SSE_QUEUE_SIZE, SSE_BACKLOG_SIZE, floor=message_store.max_id())
 
 # Auto-response messages
 AUTO_RESPONSES = {
@@ -55,9 +200,14 @@ def get_auto_response():
     responses = AUTO_RESPONSES.get(INSTANCE_NAME, [f"Auto response from {INSTANCE_NAME}"])
     return random.choice(responses)
 
-def store_message(peer_id, sender, message, status="success", auto_reply=False):
-    """Store a message in the local database"""
-    messages_table.insert({
+async def store_message(peer_id, sender, message, status="success", auto_reply=False):
+    """Store a message in the local database and push it to open chat tabs.
+
+    The write is committed in the background; with DURABLE_WRITES this waits
+    for the commit before returning. Raises JournalUnavailable when the
+    history cannot be written.
+    """
+    stored = message_store.append({
         "peer_id": peer_id,
         "sender": sender,
         "message": message,
@@ -65,6 +215,12 @@ def store_message(peer_id, sender, message, status="success", auto_reply=False):
         "timestamp": datetime.utcnow().isoformat(),
         "auto_reply": auto_reply
     })
+    broadcaster.publish('message', stored)
+    if search_index:
+        search_index.add(stored)
+    if DURABLE_WRITES:
+        await message_journal.committed(stored['id'])
+    return stored
 
 async def setup_client():
     """Initialize global HTTP/2 client to communicate with proxy"""
@@ -78,21 +234,87 @@ async def setup_client():
     )
     return http_client
 
+def queue_send(peer_id, message):
+    """Queue a message for delivery through the local proxy; raises SchedulerFull when backed up"""
+    proxy_url = f"http://localhost:{PROXY_PORT}/"
+    headers = {
+        'Host': peer_id,
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        "message": message,
+        "from": INSTANCE_NAME,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+    async def send():
+        response = await http_client.post(proxy_url, headers=headers, json=payload)
+        response.raise_for_status()
+
+    send_scheduler.submit('proxy', send)
+
+async def compact_log():
+    """Reclaim cleared messages from the log backend, one segment at a time"""
+    while True:
+        await asyncio.sleep(LOG_COMPACT_INTERVAL)
+        try:
+            while message_backend.compact():
+                # Let requests run between segment rewrites
+                await asyncio.sleep(0)
+        except Exception as e:
+            logger.error(f"Log compaction failed: {e}")
+
+async def apply_retention():
+    """Move messages past the retention limits to the archive, one segment at a time"""
+    while True:
+        try:
+            await archived_store.archive_expired()
+        except Exception as e:
+            logger.error(f"Archiving failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def build_search_index(after, upto):
+    """Index messages stored while the search index was missing or behind, a chunk at a time"""
+    try:
+        for _ in search_index.catch_up(message_store, after, upto):
+            await asyncio.sleep(0)
+    except Exception as e:
+        logger.error(f"Search indexing failed: {e}")
+
 @app.before_serving
 async def startup():
-    """Initialize HTTP/2 client before serving"""
-    global http_client
+    """Initialize HTTP/2 client, send scheduler, write journal, history cache, retention and search before serving"""
+    global http_client, send_scheduler, compaction_task, retention_task, index_task
     http_client = await setup_client()
+    send_scheduler = SendScheduler('peer', queue_size=SEND_QUEUE_SIZE, workers=SEND_WORKERS)
+    message_journal.start()
+    message_store.warm()
+    if hasattr(message_backend, 'compact'):
+        compaction_task = asyncio.create_task(compact_log())
+    retention_task = asyncio.create_task(apply_retention())
+    if search_index:
+        upto = message_store.max_id()
+        index_task = asyncio.create_task(build_search_index(search_index.resume(upto), upto))
     logger.info(f"Starting peer {INSTANCE_NAME} on port {PEER_PORT}")
     logger.info(f"Connected to proxy on port {PROXY_PORT}")
     logger.info(f"Auto mode: {AUTO_MODE}")
 
 @app.after_serving
 async def shutdown():
-    """Close HTTP/2 client after serving"""
+    """Drain queued sends, close HTTP/2 client and flush the write journal after serving"""
     global http_client
+    if send_scheduler:
+        await send_scheduler.shutdown(SHUTDOWN_DEADLINE)
     if http_client:
         await http_client.aclose()
+    for task in (compaction_task, retention_task, index_task):
+        if task:
+            task.cancel()
+    # Commit whatever the journal still holds before closing the database
+    await message_journal.aclose()
+    message_store.close()
+    if search_index:
+        search_index.close()
 
 @app.before_request
 async def handle_cors():
@@ -126,28 +348,104 @@ async def get_peer_name():
 async def get_peers():
     """Get list of available peers from proxy"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"http://localhost:{PROXY_PORT}/peers")
-            peers_data = response.json()
-            #TODO: name is also a field that might not match with peerid
-            #name is shown for chat  peerid is for backend things. everything is based on peer id
-            peers_list = [
-                {"name": peer_id.capitalize(), "id": peer_id}
-                for peer_id in peers_data["peers"].keys()
-            ]
-            return jsonify(peers_list)
+        response = await http_client.get(f"http://localhost:{PROXY_PORT}/peers")
+        peers_data = response.json()
+        #TODO: name is also a field that might not match with peerid
+        #name is shown for chat  peerid is for backend things. everything is based on peer id
+        peers_list = [
+            {"name": peer_id.capitalize(), "id": peer_id}
+            for peer_id in peers_data["peers"].keys()
+        ]
+        return jsonify(peers_list)
     except Exception as e:
         logger.error(f"Failed to get peers list: {e}")
         return jsonify([])
 
+@app.route("/stats")
+async def get_stats():
+    """Return send queue, SSE fan-out, write journal, history cache, store, archive and search statistics"""
+    return jsonify({
+        "instance": INSTANCE_NAME,
+        "scheduler": send_scheduler.stats() if send_scheduler else {},
+        "sse": broadcaster.stats(),
+        "journal": {**message_journal.stats(), "durable": DURABLE_WRITES},
+        "history_cache": message_store.stats(),
+        "archive": archived_store.stats(),
+        "search": search_index.stats() if search_index else None,
+        "store": {
+            "backend": MESSAGE_STORE,
+            **(message_backend.stats() if hasattr(message_backend, 'stats') else {})
+        }
+    })
+
+def parse_cursor(value):
+    """A history cursor is a message id (all digits) or an ISO timestamp"""
+    if not value:
+        return None
+    return int(value) if value.isdigit() else value
+
 @app.route("/get_chat_history/<peer_id>")
 async def get_chat_history(peer_id):
-    """Get chat history with specific peer"""
-    Message = Query()
-    messages = messages_table.search(Message.peer_id == peer_id)
-    messages.sort(key=lambda x: x.get('timestamp', '0'))
+    """Get one page of chat history with a specific peer, oldest message first.
+
+    Query parameters: `before` / `after` cursors (message id or timestamp) and
+    `limit`. Without cursors the newest page is returned.
+    """
+    try:
+        limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"status": "failed", "error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    messages = message_store.page(
+        peer_id,
+        before=parse_cursor(request.args.get("before")),
+        after=parse_cursor(request.args.get("after")),
+        limit=limit
+    )
     return jsonify(messages)
 
+@app.route("/search")
+async def search_messages():
+    """Full-text search over chat history, best match first.
+
+    Query parameters: `q` (every word must match; `word*` matches a prefix),
+    optional `peer_id`, `sender`, `since` / `until` ISO timestamps and
+    `auto_reply` (true/false) filters, and `limit` / `offset` for paging.
+    `truncated` is true when the query matched so many messages that only
+    the newest ones were ranked.
+    """
+    if search_index is None:
+        return jsonify({"status": "failed", "error": "Search needs SQLite with FTS5"}), 501
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"status": "failed", "error": "Missing query parameter q"}), 400
+    try:
+        limit = int(request.args.get("limit", SEARCH_PAGE_SIZE))
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"status": "failed", "error": "limit and offset must be integers"}), 400
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, offset)
+    auto_reply = request.args.get("auto_reply")
+    # Fetch one extra result to tell whether another page exists
+    page = search_index.search_page(
+        query,
+        peer_id=request.args.get("peer_id") or None,
+        sender=request.args.get("sender") or None,
+        since=request.args.get("since") or None,
+        until=request.args.get("until") or None,
+        auto_reply=None if not auto_reply else auto_reply.lower() == 'true',
+        limit=limit + 1,
+        offset=offset
+    )
+    results = page['results']
+    return jsonify({
+        "query": query,
+        "results": results[:limit],
+        "next_offset": offset + limit if len(results) > limit else None,
+        "truncated": page['truncated']
+    })
+
 
 @app.route("/send_message", methods=["POST"])
 async def send_message():
@@ -163,32 +461,24 @@ async def send_message():
         if not all([peer_id, message]):
             return jsonify({"status": "failed", "error": "Missing required fields"}), 400
 
-        # 1. Store outgoing message
-        store_message(peer_id, INSTANCE_NAME, message)
-
-        # 2. Send message to proxy
-        proxy_url = f"http://localhost:{PROXY_PORT}/"
-        headers = {
-            'Host': peer_id,
-            'Content-Type': 'application/json'
-        }
+        # 1. Queue message for the proxy - don't wait for delivery
+        try:
+            queue_send(peer_id, message)
+        except SchedulerFull as e:
+            # 2. Store outgoing message, marked failed so the UI shows it was not sent
+            await store_message(peer_id, INSTANCE_NAME, message, status="failed")
+            return jsonify({"status": "failed", "error": str(e)}), 503, {'Retry-After': str(e.retry_after)}
 
-        # Create task for sending - don't wait for response
-        create_task(
-            httpx.AsyncClient().post(
-                proxy_url,
-                headers=headers,
-                json={
-                    "message": message,
-                    "from": INSTANCE_NAME,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-            )
-        )
+        # 2. Store outgoing message
+        await store_message(peer_id, INSTANCE_NAME, message)
 
         # 3. Return immediately
         return jsonify({"status": "success"})
 
+    except JournalUnavailable as e:
+        logger.error(f"Error in send_message: {e}")
+        return jsonify({"status": "failed", "error": str(e)}), 503
+
     except Exception as e:
         logger.error(f"Error in send_message: {str(e)}")
         return jsonify({"status": "failed", "error": str(e)}), 500
@@ -209,32 +499,22 @@ async def receive_message():
             return jsonify({"status": "failed", "error": "Missing required fields"}), 400
 
         # 1. Store received message
-        store_message(from_peer, from_peer, message)
+        await store_message(from_peer, from_peer, message)
 
         # 2. If in auto mode, handle auto-response
         if AUTO_MODE:
             auto_response = get_auto_response()
+
+            # Queue auto-response - don't wait
+            status = "success"
+            try:
+                queue_send(from_peer, auto_response)
+            except SchedulerFull as e:
+                logger.warning(f"Dropping auto-response: {e}")
+                status = "failed"
+
             # Store our auto-response
-            store_message(from_peer, INSTANCE_NAME, auto_response, auto_reply=True)
-
-            # Create task to send auto-response - don't wait
-            proxy_url = f"http://localhost:{PROXY_PORT}/"
-            headers = {
-                'Host': from_peer,
-                'Content-Type': 'application/json'
-            }
-
-            create_task(
-                httpx.AsyncClient().post(
-                    proxy_url,
-                    headers=headers,
-                    json={
-                        "message": auto_response,
-                        "from": INSTANCE_NAME,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                )
-            )
+            await store_message(from_peer, INSTANCE_NAME, auto_response, status=status, auto_reply=True)
 
         # 3. Return success
         return jsonify({
@@ -242,33 +522,80 @@ async def receive_message():
             "timestamp": datetime.utcnow().isoformat()
         })
 
+    except JournalUnavailable as e:
+        logger.error(f"Error receiving message: {e}")
+        return jsonify({"status": "failed", "error": str(e)}), 503
+
     except Exception as e:
         logger.error(f"Error receiving message: {str(e)}")
         return jsonify({"status": "failed", "error": str(e)}), 500
 
+@app.route("/message_partial", methods=["POST"])
+async def receive_partial():
+    """Relay a streamed partial AI reply to connected UIs without storing it"""
+    data = await request.get_json()
+    if not data or not all([data.get("stream_id"), data.get("from")]):
+        return jsonify({"status": "failed", "error": "Missing required fields"}), 400
+
+    event = {
+        "peer_id": data["from"],
+        "sender": data["from"],
+        "stream_id": data["stream_id"],
+        "delta": data.get("delta", ""),
+        "seq": data.get("seq", 0),
+        "done": bool(data.get("done"))
+    }
+    broadcaster.publish('partial', event)
+    return jsonify({"status": "success"})
+
 @app.route('/message_updates')
 async def message_updates():
-    """SSE endpoint for real-time message updates"""
+    """SSE endpoint for real-time message updates.
+
+    Each stored message is sent in full as a default `message` event with the
+    message id as its SSE id; streamed AI text arrives as `partial` events and
+    a lagging client gets `resync`. A client that reconnects with a
+    `Last-Event-ID` header (or `last_event_id` query parameter) is first sent
+    the messages it missed.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+
     async def event_stream():
-        message_count = len(messages_table)
+        # Subscribe before reading the gap so nothing stored in between is lost
+        updates = broadcaster.subscribe()
+        seen = 0
         try:
+            if last_event_id is not None:
+                seen = last_event_id
+                missed = broadcaster.missed(last_event_id)
+                if len(missed) > SSE_REPLAY_LIMIT or last_event_id > message_store.max_id():
+                    # Too far behind, or from before the history was reset
+                    broadcaster.counters['resyncs'] += 1
+                    yield "event: resync\ndata: {}\n\n"
+                else:
+                    for message in missed:
+                        seen = message['id']
+                        yield f"id: {message['id']}\ndata: {json.dumps(message)}\n\n"
             while True:
-                current_count = len(messages_table)
-                if current_count > message_count:
-                    message_count = current_count
-                    messages = messages_table.all()
-                    if messages:
-                        latest = messages[-1]
-                        data = json.dumps({
-                            'peer_id': latest['peer_id'],
-                            'timestamp': datetime.utcnow().isoformat()
-                        })
-                        yield f"data: {data}\n\n"
-                await asyncio.sleep(0.5)
+                try:
+                    event, data = await asyncio.wait_for(updates.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Lets the server notice tabs that went away while idle
+                    yield ": keepalive\n\n"
+                    continue
+                if event == 'message':
+                    if data['id'] <= seen:
+                        continue
+                    yield f"id: {data['id']}\ndata: {json.dumps(data)}\n\n"
+                else:
+                    yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
         except asyncio.CancelledError:
             logger.info("SSE connection closed by client")
         except Exception as e:
             logger.error(f"Error in SSE stream: {str(e)}")
+        finally:
+            broadcaster.unsubscribe(updates)
 
     response = await make_response(
         event_stream(),
@@ -282,12 +609,31 @@ async def message_updates():
     )
     return response
 
+@app.route("/export_chat/<peer_id>")
+async def export_chat(peer_id):
+    """Stream a whole conversation, archived part included, as gzipped JSON lines"""
+    async def chunks():
+        for chunk in archived_store.export(peer_id):
+            yield chunk
+            await asyncio.sleep(0)
+
+    filename = quote(f"chat_{INSTANCE_NAME}_{peer_id}.jsonl.gz", safe='')
+    return await make_response(
+        chunks(),
+        {
+            'Content-Type': 'application/gzip',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{filename}"
+        }
+    )
+
 @app.route("/clear_chat/<peer_id>", methods=["POST"])
 async def clear_chat(peer_id):
     """Clear chat history with specific peer"""
     try:
-        Message = Query()
-        messages_table.remove(Message.peer_id == peer_id)
+        message_store.clear(peer_id)
+        broadcaster.forget(peer_id)
+        if search_index:
+            search_index.clear(peer_id)
         return jsonify({
             "status": "success",
             "message": f"Chat history with {peer_id} cleared."
@@ -302,7 +648,10 @@ async def clear_chat(peer_id):
 async def clear_all_chats():
     """Clear all chat history"""
     try:
-        messages_table.truncate()
+        message_store.clear_all()
+        broadcaster.forget()
+        if search_index:
+            search_index.clear_all()
         return jsonify({
             "status": "success",
             "message": "All chat history cleared."
@@ -318,6 +667,8 @@ def run_peer():
     config = Config()
     config.bind = [f"0.0.0.0:{PEER_PORT}"]
     config.h2_enabled = True
+    # Outlive the proxy's pooled keep-alive connections so they are never reused after we close them
+    config.keep_alive_timeout = 75.0
 
     logger.info(f"Starting peer {INSTANCE_NAME} on 0.0.0.0:{PEER_PORT}")
     try:
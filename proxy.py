@@ -1,17 +1,25 @@
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
-from quart import Quart, request, jsonify
+from quart import Quart, request, jsonify, websocket
 import asyncio
 import logging
 import httpx
 import json
 import argparse
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import uuid
 import os
-from typing import Dict, Optional, Callable
+import time
+import hashlib
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Callable, AsyncIterator
 import ssl
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
+from scheduler import SendScheduler, SchedulerFull
+from link import LinkManager
 
 class InstanceFormatter(logging.Formatter):
     """Custom formatter that includes instance name in logs"""
@@ -49,9 +57,40 @@ instance_name = None
 proxy_port = None
 client_port = None
 peers: Dict = {}
-http_client = None
+upstream_pools = None
 proxy_id = str(uuid.uuid4())
 controller_url = None
+endpoint_revision = 0
+# Successful registrations so far; lets concurrent "Unknown proxy" answers re-register only once
+registrations = 0
+registration_lock = asyncio.Lock()
+send_scheduler = None
+batch_scheduler = None
+inbound_scheduler = None
+proxy_links = None
+
+# Tunables; any of these keys can be overridden in the proxy config file
+proxy_settings: Dict = {
+    'send_queue_size': 100,     # queued sends per destination before rejecting with 503
+    'send_workers': 4,          # concurrent sends per destination
+    'shutdown_deadline': 10.0,  # seconds to drain queued sends on shutdown
+    'response_cache_size': 1000,        # cached AI replies (0 disables the cache)
+    'response_cache_ttl': 3600.0,       # default TTL when an endpoint's cache block has none
+    'response_cache_path': None,        # JSON file to persist the cache across restarts
+    'response_cache_save_interval': 60.0,
+    'coalesce_requests': True,          # share one upstream call between identical in-flight requests
+    'batch_window_ms': 5.0,             # max wait before flushing a proxy-to-proxy batch (0 disables batching)
+    'batch_max_size': 32,               # messages per proxy-to-proxy batch
+    'batch_retries': 5,                 # attempts to resend a batch the remote proxy rejected with 503
+    'proxy_links': True,                # carry proxy-to-proxy traffic over persistent WebSocket links
+    'link_queue_size': 1000,            # batches queued per link before falling back to HTTP
+    'link_ping_interval': 20.0,         # seconds between keep-alive pings on an idle link
+    'link_backoff_max': 30.0,           # cap on the reconnect backoff for a link
+    'api_retry_attempts': 5,            # retries of an AI request answered with 429/5xx before giving up
+    'api_retry_base_delay': 1.0,        # first retry backoff in seconds, doubled per attempt with jitter
+    'api_retry_max_delay': 60.0,        # cap on the retry backoff (a provider's retry_after still wins)
+    'endpoint_watch_timeout': 30.0      # seconds the controller holds an endpoint watch open without a change
+}
 
 
 # Request transformation functions
@@ -98,8 +137,8 @@ def transform_gemini_chat_request(data: dict, endpoint_config: dict) -> dict:
 
 
 # Response transformation functions
-def transform_openai_chat_response(response_data: dict) -> dict:
-    """Transform OpenAI/Mistral API response to chat format"""
+def transform_openai_chat_response(response_data: dict, peer_id: str) -> dict:
+    """Transform OpenAI/Mistral API response to chat format, sent as coming from the endpoint `peer_id`"""
     try:
         # Check for API error responses
         if 'error' in response_data:
@@ -130,7 +169,7 @@ def transform_openai_chat_response(response_data: dict) -> dict:
         return {
             "status": "success",
             "message": message,
-            "from": "BOT",
+            "from": peer_id,
             "timestamp": datetime.utcnow().isoformat(),
             "auto": True
         }
@@ -145,14 +184,14 @@ def transform_openai_chat_response(response_data: dict) -> dict:
         }
 
 
-def transform_anthropic_chat_response(response_data: dict) -> dict:
-    """Transform Anthropic API response to chat format"""
+def transform_anthropic_chat_response(response_data: dict, peer_id: str) -> dict:
+    """Transform Anthropic API response to chat format, sent as coming from the endpoint `peer_id`"""
     try:
         message = response_data['content'][0]['text']
         return {
             "status": "success",
             "message": message,
-            "from": "ANTHROPIC",
+            "from": peer_id,
             "timestamp": datetime.utcnow().isoformat(),
             "auto": True
         }
@@ -165,14 +204,14 @@ def transform_anthropic_chat_response(response_data: dict) -> dict:
         }
 
 
-def transform_gemini_chat_response(response_data: dict) -> dict:
-    """Transform Google Gemini API response to chat format"""
+def transform_gemini_chat_response(response_data: dict, peer_id: str) -> dict:
+    """Transform Google Gemini API response to chat format, sent as coming from the endpoint `peer_id`"""
     try:
         message = response_data['candidates'][0]['content']['parts'][0]['text']
         return {
             "status": "success",
             "message": message,
-            "from": "GEMINI",
+            "from": peer_id,
             "timestamp": datetime.utcnow().isoformat(),
             "auto": True
         }
@@ -199,17 +238,388 @@ RESPONSE_TRANSFORM_FUNCTIONS = {
 }
 
 
-async def setup_client():
-    """Initialize global HTTP/2 client"""
-    global http_client
-    limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)
-    http_client = httpx.AsyncClient(
-        http2=True,
-        verify=True,  # Changed to True for API communication
-        limits=limits,
-        timeout=10.0
-    )
-    return http_client
+# Streaming delta functions: extract the incremental text from one SSE event
+def openai_chat_stream_delta(event: dict) -> Optional[str]:
+    """Extract text from an OpenAI/Mistral chat.completion.chunk event"""
+    choices = event.get('choices') or []
+    if not choices:
+        return None
+    return (choices[0].get('delta') or {}).get('content')
+
+
+def anthropic_chat_stream_delta(event: dict) -> Optional[str]:
+    """Extract text from an Anthropic content_block_delta event"""
+    if event.get('type') == 'error':
+        logger.error(f"Anthropic stream error: {event.get('error')}")
+        return None
+    if event.get('type') != 'content_block_delta':
+        return None
+    return (event.get('delta') or {}).get('text')
+
+
+def gemini_chat_stream_delta(event: dict) -> Optional[str]:
+    """Extract text from a Gemini streamGenerateContent chunk"""
+    candidates = event.get('candidates') or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    return ''.join(part.get('text', '') for part in parts) or None
+
+
+STREAM_DELTA_FUNCTIONS = {
+    'openai_chat': openai_chat_stream_delta,
+    'anthropic_chat': anthropic_chat_stream_delta,
+    'gemini_chat': gemini_chat_stream_delta
+}
+
+
+# Connection pool defaults applied to every upstream
+DEFAULT_POOL_LIMITS = httpx.Limits(
+    max_keepalive_connections=10,
+    max_connections=20,
+    keepalive_expiry=60.0
+)
+DEFAULT_TIMEOUT = 10.0
+SERVER_KEEP_ALIVE_TIMEOUT = 75.0
+# Endpoint fields that decide which pool an endpoint uses, or that pool's settings
+POOL_FIELDS = ('pool', 'host', 'port', 'is_api')
+
+
+class UpstreamPools:
+    """One long-lived HTTP client (connection pool) per upstream origin.
+
+    All forwarding paths (local peer, peer proxies, AI hosts, controller) go
+    through here so TCP connections and TLS sessions are reused across messages.
+    Pool settings pushed by the controller are applied with configure(); a pool
+    whose settings change is replaced and the old one is closed once its
+    in-flight requests finish.
+    """
+
+    def __init__(self, limits: httpx.Limits = DEFAULT_POOL_LIMITS, timeout: float = DEFAULT_TIMEOUT):
+        self.limits = limits
+        self.timeout = timeout
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.settings: Dict[str, dict] = {}
+        self.counters: Dict[str, dict] = {}
+        self.in_flight: Dict[httpx.AsyncClient, int] = {}
+        self.retiring: set = set()
+        # Close tasks of idle retired pools, held until they finish
+        self.closing: set = set()
+
+    @staticmethod
+    def origin(url: str) -> str:
+        """Normalize a URL to the scheme://host:port key its pool is stored under"""
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return f"{parts.scheme}://{parts.hostname}:{port}"
+
+    @staticmethod
+    def connection_counts(client: httpx.AsyncClient) -> tuple[int, int]:
+        """Return (open, idle) connection counts for a client's pool.
+
+        httpx has no public API for this, so it reads the httpcore pool behind
+        the client (tested with httpx 0.28 / httpcore 1.0) and raises if that
+        is not there, rather than reporting zeros. Only stats() calls it, so a
+        change in httpx costs the counts, never a request.
+        """
+        try:
+            connections = [c for c in client._transport._pool.connections if not c.is_closed()]
+            return len(connections), sum(1 for c in connections if c.is_idle())
+        except AttributeError as e:
+            raise RuntimeError(f"Cannot read connection pool state from httpx {httpx.__version__}: {e}") from e
+
+    @staticmethod
+    def traced(kwargs: dict) -> dict:
+        """Add an httpcore trace hook to a request; the returned dict records whether it opened a connection"""
+        opened = {'connected': False}
+
+        async def trace(event: str, info: dict):
+            if event == 'connection.connect_tcp.started':
+                opened['connected'] = True
+
+        kwargs['extensions'] = {**kwargs.get('extensions', {}), 'trace': trace}
+        return opened
+
+    def limits_for(self, key: str) -> httpx.Limits:
+        """Build the connection limits for an origin from its pushed settings"""
+        settings = self.settings.get(key, {})
+        return httpx.Limits(
+            max_connections=settings.get('max_connections', self.limits.max_connections),
+            max_keepalive_connections=settings.get('max_keepalive_connections',
+                                                   self.limits.max_keepalive_connections),
+            keepalive_expiry=settings.get('keepalive_expiry', self.limits.keepalive_expiry)
+        )
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        """Return the pooled client for a URL's origin, creating it on first use"""
+        key = self.origin(url)
+        client = self.clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                http2=self.settings.get(key, {}).get('http2', True),
+                verify=True,
+                limits=self.limits_for(key),
+                timeout=self.timeout
+            )
+            self.clients[key] = client
+            self.counters.setdefault(key, {'hits': 0, 'misses': 0, 'requests': 0, 'errors': 0})
+            logger.info(f"Opened connection pool for {key}")
+        return client
+
+    def configure(self, settings_by_origin: Dict[str, dict]):
+        """Apply per-origin pool settings, replacing pools whose settings changed"""
+        for key in set(self.settings) | set(settings_by_origin):
+            settings = settings_by_origin.get(key, {})
+            if self.settings.get(key, {}) == settings:
+                continue
+            if settings:
+                self.settings[key] = settings
+            else:
+                self.settings.pop(key, None)
+            client = self.clients.pop(key, None)
+            if client:
+                logger.info(f"Resizing connection pool for {key}: {settings or 'defaults'}")
+                self.retire(client)
+
+    def retire(self, client: httpx.AsyncClient):
+        """Close a replaced pool now if idle, otherwise after its last in-flight request"""
+        if self.in_flight.get(client, 0):
+            self.retiring.add(client)
+        else:
+            task = asyncio.create_task(client.aclose())
+            self.closing.add(task)
+            task.add_done_callback(self.closed)
+
+    def closed(self, task: asyncio.Task):
+        self.closing.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Error closing a retired connection pool: {task.exception()}")
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request on the upstream's pool, counting keep-alive hits and misses"""
+        client = self.client_for(url)
+        counters = self.counters[self.origin(url)]
+        opened = self.traced(kwargs)
+        counters['requests'] += 1
+        self.in_flight[client] = self.in_flight.get(client, 0) + 1
+        try:
+            return await client.request(method, url, **kwargs)
+        except Exception:
+            counters['errors'] += 1
+            raise
+        finally:
+            # A request that did not open a TCP connection reused a kept-alive one
+            counters['misses' if opened['connected'] else 'hits'] += 1
+            self.in_flight[client] -= 1
+            if not self.in_flight[client]:
+                del self.in_flight[client]
+                if client in self.retiring:
+                    self.retiring.discard(client)
+                    await client.aclose()
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Streaming variant of request(); the connection is held until the block exits"""
+        client = self.client_for(url)
+        counters = self.counters[self.origin(url)]
+        opened = self.traced(kwargs)
+        counters['requests'] += 1
+        self.in_flight[client] = self.in_flight.get(client, 0) + 1
+        try:
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+        except Exception:
+            counters['errors'] += 1
+            raise
+        finally:
+            counters['misses' if opened['connected'] else 'hits'] += 1
+            self.in_flight[client] -= 1
+            if not self.in_flight[client]:
+                del self.in_flight[client]
+                if client in self.retiring:
+                    self.retiring.discard(client)
+                    await client.aclose()
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        """Per-pool hit/miss counters, limits and open connection counts (None if httpx hides them)"""
+        result = {}
+        pool_state_error = None
+        for key, client in self.clients.items():
+            try:
+                open_connections, idle_connections = self.connection_counts(client)
+            except RuntimeError as e:
+                open_connections = idle_connections = None
+                pool_state_error = str(e)
+            limits = self.limits_for(key)
+            result[key] = {
+                **self.counters[key],
+                'open_connections': open_connections,
+                'idle_connections': idle_connections,
+                'in_flight': self.in_flight.get(client, 0),
+                'max_connections': limits.max_connections,
+                'max_keepalive_connections': limits.max_keepalive_connections,
+                'http2': self.settings.get(key, {}).get('http2', True)
+            }
+        stats = {'pools': result, 'retiring': len(self.retiring)}
+        if pool_state_error:
+            stats['pool_state_error'] = pool_state_error
+        return stats
+
+    async def aclose(self):
+        """Close every pool"""
+        for client in list(self.clients.values()) + list(self.retiring):
+            await client.aclose()
+        if self.closing:
+            await asyncio.gather(*self.closing, return_exceptions=True)
+        self.clients.clear()
+        self.retiring.clear()
+
+
+async def setup_pools():
+    """Initialize the global upstream connection pools"""
+    global upstream_pools
+    upstream_pools = UpstreamPools()
+    return upstream_pools
+
+
+# Per-endpoint concurrency limits, rebuilt when an endpoint's max_concurrency changes
+endpoint_semaphores: Dict[str, tuple[int, asyncio.Semaphore]] = {}
+
+
+def endpoint_url(peer_info: dict) -> str:
+    """Base URL of an endpoint: HTTPS for AI APIs, plain HTTP for peer proxies"""
+    if peer_info.get('is_api'):
+        return f"https://{peer_info['host']}:{peer_info.get('port', 443)}"
+    return f"http://{peer_info['host']}:{peer_info['port']}"
+
+
+def endpoint_timeout(peer_info: dict) -> httpx.Timeout:
+    """Build the request timeout from an endpoint's `timeout` setting.
+
+    Accepts a number (applies to every phase) or a dict with connect/read/write/pool keys.
+    """
+    timeout = peer_info.get('timeout', DEFAULT_TIMEOUT)
+    if isinstance(timeout, dict):
+        default = timeout.get('default', DEFAULT_TIMEOUT)
+        return httpx.Timeout(
+            default,
+            connect=timeout.get('connect', default),
+            read=timeout.get('read', default),
+            write=timeout.get('write', default),
+            pool=timeout.get('pool', default)
+        )
+    return httpx.Timeout(timeout)
+
+
+def endpoint_semaphore(peer_id: str, peer_info: dict) -> Optional[asyncio.Semaphore]:
+    """Return the concurrency limiter for an endpoint, or None if unlimited"""
+    limit = peer_info.get('max_concurrency')
+    if not limit:
+        endpoint_semaphores.pop(peer_id, None)
+        return None
+    current = endpoint_semaphores.get(peer_id)
+    if current is None or current[0] != limit:
+        # In-flight holders release the old semaphore; new callers use the resized one
+        current = (limit, asyncio.Semaphore(limit))
+        endpoint_semaphores[peer_id] = current
+    return current[1]
+
+
+class TokenBucket:
+    """Token-bucket rate limiter; acquire() waits for a token rather than failing"""
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.counters = {'acquired': 0, 'throttled': 0, 'wait_ms_total': 0.0}
+
+    def config(self) -> tuple:
+        return (self.rate * 60, self.burst)
+
+    async def acquire(self):
+        started = time.monotonic()
+        throttled = False
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.counters['acquired'] += 1
+                if throttled:
+                    self.counters['wait_ms_total'] += (now - started) * 1000
+                return
+            if not throttled:
+                throttled = True
+                self.counters['throttled'] += 1
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def stats(self) -> dict:
+        throttled = self.counters['throttled']
+        return {
+            'requests_per_minute': self.rate * 60,
+            'burst': self.burst,
+            'tokens': round(self.tokens, 2),
+            'acquired': self.counters['acquired'],
+            'throttled': throttled,
+            'wait_ms_avg': round(self.counters['wait_ms_total'] / throttled, 1) if throttled else None
+        }
+
+
+# Per-endpoint rate limiters, rebuilt when an endpoint's rate_limit block changes
+endpoint_limiters: Dict[str, TokenBucket] = {}
+
+
+def endpoint_rate_limiter(peer_id: str, peer_info: dict) -> Optional[TokenBucket]:
+    """Return the token bucket for an endpoint's `rate_limit` block, or None if unlimited"""
+    policy = peer_info.get('rate_limit')
+    if not policy or not policy.get('requests_per_minute'):
+        endpoint_limiters.pop(peer_id, None)
+        return None
+    config = (policy['requests_per_minute'], max(1, policy.get('burst', 1)))
+    limiter = endpoint_limiters.get(peer_id)
+    if limiter is None or limiter.config() != config:
+        limiter = TokenBucket(*config)
+        endpoint_limiters[peer_id] = limiter
+    return limiter
+
+
+def apply_endpoint_settings(endpoints: Dict):
+    """Push per-endpoint pool settings from the controller config into the pools"""
+    settings_by_origin = {}
+    for pid in sorted(endpoints):
+        info = endpoints[pid]
+        if not isinstance(info, dict) or 'host' not in info or 'pool' not in info:
+            continue
+        key = UpstreamPools.origin(endpoint_url(info))
+        if key in settings_by_origin and settings_by_origin[key] != info['pool']:
+            logger.warning(f"Conflicting pool settings for {key}; keeping the first one")
+            continue
+        settings_by_origin[key] = info['pool']
+    if upstream_pools:
+        upstream_pools.configure(settings_by_origin)
+    for pid in list(endpoint_semaphores):
+        if pid not in endpoints:
+            del endpoint_semaphores[pid]
+    for pid in list(endpoint_limiters):
+        if pid not in endpoints:
+            del endpoint_limiters[pid]
+
+
+def set_peers(new_peers: Dict):
+    """Replace the endpoint table and apply its connection settings"""
+    global peers
+    peers = new_peers
+    apply_endpoint_settings(peers)
+    rebuild_routes()
 
 
 def load_config(config_path: str):
@@ -225,199 +635,1030 @@ def load_config(config_path: str):
     proxy_port = config['proxy_port']
     client_port = config['client_port']
     controller_url = config.get('controller_url', 'http://localhost:8000')
+    proxy_settings.update({key: config[key] for key in proxy_settings if key in config})
 
     logger.info(f"Loaded config for {instance_name}")
     logger.info(f"Proxy port: {proxy_port}")
     logger.info(f"Client port: {client_port}")
     logger.info(f"Controller URL: {controller_url}")
+    logger.info(f"Settings: {proxy_settings}")
 
 
 async def register_with_controller():
     """Register this proxy with the controller"""
+    global registrations
     try:
-        async with httpx.AsyncClient() as client:
-            logger.info(f"Registering {instance_name} with controller (proxy_id: {proxy_id})")
-            response = await client.post(
-                f"{controller_url}/api/register",
-                json={
-                    "proxy_id": proxy_id,
-                    "instance_name": instance_name,
-                    "host": "127.0.0.1",
-                    "port": proxy_port
-                }
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                logger.info(f"Registration response: {json.dumps(data, indent=2)}")
+        logger.info(f"Registering {instance_name} with controller (proxy_id: {proxy_id})")
+        response = await upstream_pools.post(
+            f"{controller_url}/api/register",
+            json={
+                "proxy_id": proxy_id,
+                "instance_name": instance_name,
+                "host": "127.0.0.1",
+                "port": proxy_port
+            }
+        )
 
-                if 'endpoints' in data:
-                    global peers
-                    peers = data['endpoints']
-                    logger.info(f"Initial endpoints configuration: {json.dumps(peers, indent=2)}")
-                else:
-                    logger.error("No endpoints received in registration response")
+        if response.status_code == 200:
+            data = response.json()
 
-                logger.info("Successfully registered with controller")
+            if 'endpoints' in data:
+                apply_endpoints(data['endpoints'], data.get('revision', 0))
             else:
-                logger.error(f"Failed to register with controller: {response.text}")
+                logger.error("No endpoints received in registration response")
+
+            registrations += 1
+            logger.info("Successfully registered with controller")
+        else:
+            logger.error(f"Failed to register with controller: {response.text}")
 
     except Exception as e:
         logger.error(f"Error registering with controller: {e}")
         raise
 
 
+async def reregister(seen: int):
+    """Register again after the controller answered "Unknown proxy" to a request.
+
+    `seen` is the registration count when that request was sent; if another
+    task has registered since, nothing is done.
+    """
+    async with registration_lock:
+        if registrations == seen:
+            logger.warning("Controller does not know this proxy; registering again")
+            await register_with_controller()
+
+
+def unknown_proxy(response: httpx.Response) -> bool:
+    return response.status_code == 404 and 'Unknown proxy' in response.text
+
+
 async def send_heartbeat():
     """Send periodic heartbeat to controller"""
     while True:
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{controller_url}/api/heartbeat",
-                    json={"proxy_id": proxy_id}
-                )
-                if response.status_code != 200:
-                    logger.warning(f"Heartbeat failed: {response.text}")
+            seen = registrations
+            response = await upstream_pools.post(
+                f"{controller_url}/api/heartbeat",
+                json={"proxy_id": proxy_id}
+            )
+            if unknown_proxy(response):
+                await reregister(seen)
+            elif response.status_code != 200:
+                logger.warning(f"Heartbeat failed: {response.text}")
             await asyncio.sleep(30)
         except Exception as e:
             logger.error(f"Error sending heartbeat: {e}")
             await asyncio.sleep(30)
 
 
-# Add at the top of the file with other globals:
-#TODO: cached_peers seems unnecessary
-cached_peers: Dict = {}
+class Route:
+    """A peer or API endpoint with everything needed to forward to it resolved up front"""
+    __slots__ = ('peer_id', 'info', 'is_local', 'is_api', 'url', 'headers', 'timeout',
+                 'transform_request', 'transform_response', 'stream_delta', 'resolutions')
+
+    def __init__(self, peer_id: str, info: dict, is_local: bool = False):
+        self.peer_id = peer_id
+        self.info = info
+        self.is_local = is_local
+        self.is_api = bool(info.get('is_api')) and not is_local
+        self.timeout = endpoint_timeout(info)
+        self.transform_request = TRANSFORM_FUNCTIONS.get(info.get('transform_request'))
+        self.transform_response = RESPONSE_TRANSFORM_FUNCTIONS.get(info.get('transform_response'))
+        self.stream_delta = None
+        self.resolutions = 0
+
+        if is_local:
+            self.url = f"http://127.0.0.1:{client_port}/message"
+            self.headers = {'Content-Type': 'application/json'}
+        elif self.is_api:
+            path = info.get('path', '/')
+            params = dict(info.get('params') or {})
+            if info.get('model_config', {}).get('stream'):
+                self.stream_delta = STREAM_DELTA_FUNCTIONS.get(info.get('transform_response'))
+            if self.stream_delta and info.get('transform_request') == 'gemini_chat':
+                # Gemini streams from a separate method and only emits SSE when asked to
+                path = path.replace(':generateContent', ':streamGenerateContent')
+                params['alt'] = 'sse'
+            self.url = f"{endpoint_url(info)}{path}"
+            if params:
+                self.url = f"{self.url}?{urlencode(params)}"
+            self.headers = info.get('headers', {})
+        else:
+            self.url = f"{endpoint_url(info)}/"
+            self.headers = {
+                'Host': peer_id,
+                'Content-Type': 'application/json'
+            }
+
+
+# Routing index rebuilt whenever peers is replaced: exact ids and case-folded ids
+routes: Dict[str, Route] = {}
+folded_routes: Dict[str, Route] = {}
+unresolved_lookups = 0
 
 
-def get_peer_info(peer_id: str) -> tuple[Optional[str], Optional[dict]]:
-    """Look up peer info case-insensitively. If peer not found and this proxy is running for that instance, return localhost info"""
+def rebuild_routes():
+    """Precompute the routing index for the current peers table"""
+    global routes, folded_routes
+    new_routes = {}
+    new_folded = {}
+    local_key = instance_name.casefold() if instance_name else None
+
+    for pid, info in peers.items():
+        route = Route(pid, info, is_local=pid.casefold() == local_key)
+        new_routes[pid] = route
+        # First peer wins on case-insensitive collisions, as the old linear scan did
+        new_folded.setdefault(pid.casefold(), route)
+
+    # Messages for this proxy's own instance go to the local peer.py
+    if local_key and local_key not in new_folded:
+        local_route = Route(instance_name, {'host': '127.0.0.1', 'port': client_port}, is_local=True)
+        new_routes[instance_name] = local_route
+        new_folded[local_key] = local_route
+
+    # Carry resolution counters over for routes that survive the update
+    for pid, route in new_routes.items():
+        previous = routes.get(pid)
+        if previous:
+            route.resolutions = previous.resolutions
+
+    routes, folded_routes = new_routes, new_folded
+    logger.info(f"Rebuilt routing index with {len(routes)} routes")
+
+
+def update_routes(changed: set):
+    """Rebuild only the routes of the given peer ids after an in-place change to peers"""
+    local_key = instance_name.casefold() if instance_name else None
+    if local_key and any(pid.casefold() == local_key for pid in changed):
+        # The local instance's route depends on whether a peer claims its name
+        rebuild_routes()
+        return
+
+    for pid in changed:
+        previous = routes.pop(pid, None)
+        key = pid.casefold()
+        if pid in peers:
+            route = Route(pid, peers[pid])
+            if previous:
+                route.resolutions = previous.resolutions
+            routes[pid] = route
+            if folded_routes.get(key, previous) is previous:
+                folded_routes[key] = route
+        elif previous is not None and folded_routes.get(key) is previous:
+            # The first remaining peer with the same folded id takes over
+            successor = next((routes[other] for other in peers if other in routes and other.casefold() == key), None)
+            if successor:
+                folded_routes[key] = successor
+            else:
+                del folded_routes[key]
+    logger.info(f"Updated {len(changed)} of {len(routes)} routes")
+
+
+def resolve_route(peer_id: str) -> Optional[Route]:
+    """Look up a route by exact id, falling back to a case-insensitive match"""
+    global unresolved_lookups
     if not peer_id:
         logger.error("No peer_id provided")
+        return None
+
+    route = routes.get(peer_id) or folded_routes.get(peer_id.casefold())
+    if route is None:
+        unresolved_lookups += 1
+        logger.error(f"No peer found matching: {peer_id}")
+        return None
+
+    route.resolutions += 1
+    return route
+
+
+def get_peer_info(peer_id: str) -> tuple[Optional[str], Optional[dict]]:
+    """Look up peer info case-insensitively. If peer not found and this proxy is running for that instance, return localhost info"""
+    route = resolve_route(peer_id)
+    if route is None:
         return None, None
+    return route.peer_id, route.info
 
-    peer_id_lower = peer_id.lower()
-    logger.info(f"Looking up peer: {peer_id} (lowercase: {peer_id_lower})")
-    logger.info(f"Available peers: {list(peers.keys())}")
 
-    # Check exact match first
-    if peer_id in peers:
-        logger.info(f"Found exact match for peer: {peer_id}")
-        return peer_id, peers[peer_id]
+def route_stats() -> dict:
+    """Per-route resolution counters"""
+    return {
+        'routes': {pid: route.resolutions for pid, route in routes.items()},
+        'unresolved': unresolved_lookups
+    }
 
-    # Check case-insensitive match
-    for pid, info in peers.items():
-        if pid.lower() == peer_id_lower:
-            logger.info(f"Found case-insensitive match: {pid}")
-            return pid, info
-
-    # If peer not found and it matches this proxy's instance, return localhost info
-    if peer_id_lower == instance_name.lower():
-        logger.info(f"Message is for this instance ({instance_name}), using localhost")
-        return instance_name, {
-            'host': '127.0.0.1',
-            'port': client_port
+
+def apply_endpoints(endpoints: Dict, revision: int):
+    """Install a new endpoint table from the controller and log what changed"""
+    global endpoint_revision
+    old_peers = set(peers)
+    set_peers(dict(endpoints))
+    endpoint_revision = revision
+
+    added = set(peers) - old_peers
+    removed = old_peers - set(peers)
+    logger.info(f"Applied endpoints revision {revision}: {list(peers.keys())}")
+    if added:
+        logger.info(f"Added peers: {added}")
+    if removed:
+        logger.info(f"Removed peers: {removed}")
+
+
+def apply_merge_patch(target: dict, patch: dict) -> dict:
+    """Apply a JSON merge patch (RFC 7386) to a copy of target; None removes a key"""
+    result = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = apply_merge_patch(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def apply_changes(changes: list, revision: int):
+    """Apply endpoint diffs from the controller to the endpoint table in place.
+
+    Patched endpoints get new info dicts, so requests already holding the old
+    route finish with the settings they started with. If a patch names an
+    endpoint this proxy does not have, the revision is reset so that the
+    next watch fetches a full snapshot.
+    """
+    global endpoint_revision
+    changed = set()
+    touches_pools = False
+    for change in changes:
+        for pid in change.get('removed', []):
+            info = peers.pop(pid, None)
+            touches_pools = touches_pools or (isinstance(info, dict) and 'pool' in info)
+            endpoint_semaphores.pop(pid, None)
+            endpoint_limiters.pop(pid, None)
+            changed.add(pid)
+        for pid, info in change.get('added', {}).items():
+            previous = peers.get(pid)
+            touches_pools = touches_pools or 'pool' in info or (isinstance(previous, dict) and 'pool' in previous)
+            peers[pid] = info
+            changed.add(pid)
+        for pid, patch in change.get('patched', {}).items():
+            if not isinstance(peers.get(pid), dict):
+                logger.warning(f"Endpoint patch for unknown peer {pid}; requesting a full snapshot")
+                if touches_pools:
+                    apply_endpoint_settings(peers)
+                update_routes(changed)
+                endpoint_revision = 0
+                return
+            touches_pools = touches_pools or any(field in patch for field in POOL_FIELDS)
+            peers[pid] = apply_merge_patch(peers[pid], patch)
+            changed.add(pid)
+
+    if touches_pools:
+        apply_endpoint_settings(peers)
+    update_routes(changed)
+    endpoint_revision = revision
+    logger.info(f"Applied endpoint changes up to revision {revision}: {sorted(changed)}")
+
+
+async def watch_endpoints():
+    """Apply endpoint changes from the controller as soon as they are made.
+
+    Long-polls /api/watchendpoints with the revision this proxy holds. The
+    controller answers once a newer revision exists, with the changes since
+    ours or a full snapshot if it no longer has them, or with 304 when the
+    watch times out, and the next watch starts at once. If the controller
+    no longer knows this proxy, it registers again. Errors back off with
+    jitter, up to a minute.
+    """
+    watch_timeout = proxy_settings['endpoint_watch_timeout']
+    backoff = 1.0
+
+    while True:
+        try:
+            seen = registrations
+            response = await upstream_pools.get(
+                f"{controller_url}/api/watchendpoints",
+                params={"proxy_id": proxy_id, "revision": endpoint_revision, "timeout": watch_timeout},
+                timeout=httpx.Timeout(DEFAULT_TIMEOUT, read=watch_timeout + DEFAULT_TIMEOUT)
+            )
+            if response.status_code == 304:
+                backoff = 1.0
+                continue
+            if response.status_code == 200:
+                data = response.json()
+                if 'changes' in data:
+                    apply_changes(data['changes'], data.get('revision', 0))
+                    backoff = 1.0
+                    continue
+                if data.get('endpoints'):
+                    apply_endpoints(data['endpoints'], data.get('revision', 0))
+                    backoff = 1.0
+                    continue
+                logger.error("Received empty endpoints from controller")
+            elif unknown_proxy(response):
+                await reregister(seen)
+                if registrations != seen:
+                    backoff = 1.0
+                    continue
+            else:
+                logger.error(f"Failed to watch endpoints: {response.text}")
+        except Exception as e:
+            logger.error(f"Error watching endpoints: {e}")
+
+        await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+        backoff = min(backoff * 2, 60.0)
+
+
+def local_peer_url(path: str = '/message') -> str:
+    """URL of an endpoint on this instance's peer.py"""
+    return f"http://127.0.0.1:{client_port}{path}"
+
+
+async def deliver_to_local_peer(message: dict):
+    """Send a chat message (e.g. a bot reply) to this instance's peer.py"""
+    headers = {'Content-Type': 'application/json'}
+    await upstream_pools.post(local_peer_url(), json=message, headers=headers)
+
+
+class RetryableAPIError(Exception):
+    """An AI endpoint asked us to come back later (429, 5xx or a rate_limit error body)"""
+
+    def __init__(self, peer_id: str, status: Optional[int], retry_after: Optional[float] = None):
+        super().__init__(f"API request to {peer_id} failed ({status}), retryable")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_retryable(route: Route, response: httpx.Response):
+    """Raise RetryableAPIError for responses worth re-issuing later"""
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableAPIError(route.peer_id, response.status_code,
+                                parse_retry_after(response.headers.get('Retry-After')))
+
+
+def api_error_reply(route: Route, message: str) -> dict:
+    """Chat-format reply telling the user an AI request failed"""
+    return {
+        "status": "error",
+        "message": message,
+        "from": route.peer_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "auto": True
+    }
+
+
+# Streaming counters; time-to-first-token is measured from request start to first delta
+stream_stats = {
+    'streams': 0,
+    'completed': 0,
+    'errors': 0,
+    'first_tokens': 0,
+    'ttft_ms_total': 0.0,
+    'ttft_ms_last': None
+}
+
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[dict]:
+    """Yield each JSON `data:` payload of a server-sent event stream"""
+    data_lines = []
+    async for line in response.aiter_lines():
+        if line.startswith('data:'):
+            data_lines.append(line[5:].lstrip())
+            continue
+        if line or not data_lines:
+            continue
+        payload = '\n'.join(data_lines)
+        data_lines = []
+        if payload == '[DONE]':
+            return
+        try:
+            yield json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping malformed stream event: {payload[:200]}")
+
+
+async def stream_api_response(route: Route, payload: dict):
+    """Consume a provider's SSE stream, relaying deltas to the local peer as they arrive.
+
+    Partial text goes to peer.py's /message_partial (not stored); the complete reply
+    is delivered once to /message when the stream ends and also returned. A
+    stream that breaks off returns an error reply carrying the text received
+    so far as `partial`; it is never passed off as a finished answer.
+    """
+    stream_id = str(uuid.uuid4())
+    started = time.monotonic()
+    chunks = []
+    stream_stats['streams'] += 1
+
+    async def relay(delta: str, done: bool = False):
+        try:
+            await upstream_pools.post(local_peer_url('/message_partial'), json={
+                "stream_id": stream_id,
+                "from": route.peer_id,
+                "delta": delta,
+                "seq": len(chunks),
+                "done": done
+            })
+        except Exception as e:
+            logger.warning(f"Failed to relay partial response: {e}")
+
+    try:
+        async with upstream_pools.stream('POST', route.url, json=payload, headers=route.headers,
+                                         timeout=route.timeout) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                logger.error(f"Streaming API request failed ({response.status_code}): {body[:500]}")
+                stream_stats['errors'] += 1
+                check_retryable(route, response)
+                return
+            async for event in iter_sse_events(response):
+                delta = route.stream_delta(event)
+                if not delta:
+                    continue
+                if not chunks:
+                    ttft_ms = (time.monotonic() - started) * 1000
+                    stream_stats['first_tokens'] += 1
+                    stream_stats['ttft_ms_last'] = round(ttft_ms, 1)
+                    stream_stats['ttft_ms_total'] += ttft_ms
+                chunks.append(delta)
+                await relay(delta)
+    except RetryableAPIError:
+        raise
+    except Exception as e:
+        stream_stats['errors'] += 1
+        logger.error(f"Streaming API request failed: {e}")
+        if not chunks:
+            return
+        await relay('', done=True)
+        return {
+            **api_error_reply(route, f"Reply from {route.peer_id} was cut off: {e}"),
+            "partial": ''.join(chunks)
         }
 
-    logger.error(f"No peer found matching: {peer_id}")
-    return None, None
-async def update_endpoints():
-    """Periodically fetch updated endpoints from controller"""
-    global peers
-    retries = 0
-    max_retries = 3
+    # Store the finished message once, then let the UI drop its partial bubble
+    reply = {
+        "status": "success",
+        "message": ''.join(chunks),
+        "from": route.peer_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "auto": True
+    }
+    await deliver_to_local_peer({**reply, "stream_id": stream_id})
+    await relay('', done=True)
+    stream_stats['completed'] += 1
+    return reply
 
+
+def streaming_stats() -> dict:
+    """Stream counters with the mean time-to-first-token"""
+    first_tokens = stream_stats['first_tokens']
+    return {
+        'streams': stream_stats['streams'],
+        'completed': stream_stats['completed'],
+        'errors': stream_stats['errors'],
+        'ttft_ms_last': stream_stats['ttft_ms_last'],
+        'ttft_ms_avg': round(stream_stats['ttft_ms_total'] / first_tokens, 1) if first_tokens else None
+    }
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of AI replies with per-entry expiry.
+
+    Entries expire on wall-clock time so a cache saved with save() stays valid
+    across a proxy restart.
+    """
+
+    def __init__(self, max_entries: int, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries: OrderedDict = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'bypassed': 0, 'evictions': 0, 'expirations': 0}
+        self.dirty = False
+
+    @staticmethod
+    def key(endpoint: str, model_config: dict, payload) -> str:
+        """Hash the endpoint, normalized model config and transformed request body"""
+        normalized = json.dumps([endpoint, model_config, payload], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            self.dirty = True
+            self.counters['expirations'] += 1
+            self.counters['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return value
+
+    def put(self, key: str, value: dict, ttl: float):
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+        self.dirty = True
+
+    def load(self):
+        """Warm the cache from its file, skipping entries that expired while down"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Failed to load response cache from {self.path}: {e}")
+            return
+        now = time.time()
+        for key, expires_at, value in saved[-self.max_entries:]:
+            if expires_at > now:
+                self.entries[key] = (expires_at, value)
+        logger.info(f"Loaded {len(self.entries)} cached responses from {self.path}")
+
+    def save(self):
+        """Write the cache to its file (oldest first, so load() keeps LRU order)"""
+        if not self.path or not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump([[key, expires_at, value] for key, (expires_at, value) in self.entries.items()], f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def stats(self) -> dict:
+        return {**self.counters, 'entries': len(self.entries), 'capacity': self.max_entries}
+
+
+response_cache: Optional[ResponseCache] = None
+
+
+def cache_policy(route: Route) -> Optional[float]:
+    """Return the TTL to cache an endpoint's replies with, or None to bypass the cache.
+
+    Endpoints opt in with a `cache` block; sampled replies (temperature > 0) are
+    only cached when the block also sets `nondeterministic`.
+    """
+    policy = route.info.get('cache')
+    if not response_cache or not policy or not policy.get('enabled', True):
+        return None
+    temperature = route.info.get('model_config', {}).get('temperature') or 0
+    if temperature > 0 and not policy.get('nondeterministic'):
+        return None
+    return policy.get('ttl', proxy_settings['response_cache_ttl'])
+
+
+async def call_api(route: Route, payload) -> Optional[dict]:
+    """Call an AI endpoint and return its reply in chat format.
+
+    Raises RetryableAPIError when the endpoint is rate limiting or failing.
+    """
+    if route.stream_delta:
+        return await stream_api_response(route, payload)
+
+    response = await upstream_pools.post(route.url, json=payload, headers=route.headers, timeout=route.timeout)
+    if response.status_code != 200:
+        logger.error(f"API request to {route.peer_id} failed ({response.status_code}): {response.text[:500]}")
+        check_retryable(route, response)
+        return None
+    response_data = response.json()
+    if route.transform_response:
+        response_data = route.transform_response(response_data, route.peer_id)
+    if response_data.get('error_type') == 'rate_limit':
+        raise RetryableAPIError(route.peer_id, response.status_code, response_data.get('retry_after'))
+    return response_data
+
+
+class SingleFlight:
+    """Tracks in-flight upstream calls so identical requests can share one result"""
+
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Future] = {}
+        self.counters = {'leaders': 0, 'coalesced': 0}
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """Return the future of an identical in-flight call, if there is one"""
+        future = self.calls.get(key)
+        if future is not None:
+            self.counters['coalesced'] += 1
+        return future
+
+    def start(self, key: str) -> asyncio.Future:
+        """Register a new call; later identical requests will join it"""
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        self.counters['leaders'] += 1
+        return future
+
+    def finish(self, key: str, result):
+        """Publish a call's result (None on failure) to everyone who joined it"""
+        future = self.calls.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def finish_all(self, result=None):
+        """Finish every outstanding call, e.g. when its leader was dropped on shutdown"""
+        if self.calls:
+            logger.warning(f"Finishing {len(self.calls)} in-flight calls without a reply")
+        for key in list(self.calls):
+            self.finish(key, result)
+
+    def stats(self) -> dict:
+        return {**self.counters, 'in_flight': len(self.calls)}
+
+
+api_flights = SingleFlight()
+
+
+async def process_api_request(route: Route, payload, key: str) -> Optional[dict]:
+    """Answer an AI request from the cache or the endpoint and deliver it to the local peer"""
+    ttl = cache_policy(route)
+    if ttl is None:
+        if response_cache:
+            response_cache.counters['bypassed'] += 1
+    else:
+        cached = response_cache.get(key)
+        if cached:
+            # Entries saved before replies were named after their endpoint may carry another sender
+            cached = {**cached, "from": route.peer_id, "timestamp": datetime.utcnow().isoformat()}
+            await deliver_to_local_peer(cached)
+            return cached
+
+    limiter = endpoint_rate_limiter(route.peer_id, route.info)
+    if limiter:
+        await limiter.acquire()
+    semaphore = endpoint_semaphore(route.peer_id, route.info)
+    if semaphore is None:
+        reply = await call_api(route, payload)
+    else:
+        async with semaphore:
+            reply = await call_api(route, payload)
+    if reply is None:
+        reply = api_error_reply(route, f"Request to {route.peer_id} failed")
+    elif reply.get('status') != 'success':
+        # Transformers report API errors without a sender; peer.py needs one to store them
+        reply = {**api_error_reply(route, reply.get('message') or 'Request failed'), **reply}
+
+    # Only finished answers are cached; a stream that broke off carries `partial` and is never reused
+    if ttl is not None and reply.get('status') == 'success' and 'partial' not in reply:
+        response_cache.put(key, reply, ttl)
+    # Streamed replies have already been delivered as the stream finished
+    if not route.stream_delta or reply.get('status') != 'success':
+        await deliver_to_local_peer(reply)
+    return reply
+
+
+class RetryQueue:
+    """AI requests waiting to be re-issued after a 429/5xx.
+
+    Each attempt waits a jittered exponential backoff, or the provider's
+    retry_after if that is longer, and is then resubmitted to the endpoint's
+    send queue. A request's single-flight group stays open across retries.
+    """
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timers: set = set()
+        self.pending: Dict[str, int] = {}
+        self.counters: Dict[str, dict] = {}
+
+    def delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return max(random.uniform(backoff / 2, backoff), retry_after or 0)
+
+    def schedule(self, route: Route, payload, key: str, attempt: int, error: RetryableAPIError) -> bool:
+        """Arrange another attempt; False once the request has used up its retries"""
+        counters = self.counters.setdefault(route.peer_id, {
+            'rate_limited': 0, 'server_errors': 0, 'retried': 0, 'gave_up': 0
+        })
+        counters['rate_limited' if error.status in (200, 429) else 'server_errors'] += 1
+        if attempt > self.max_attempts:
+            counters['gave_up'] += 1
+            return False
+        delay = self.delay(attempt, error.retry_after)
+        logger.warning(f"{error}; retry {attempt}/{self.max_attempts} in {delay:.1f}s")
+        self._arm(delay, route, payload, key, attempt)
+        return True
+
+    def _arm(self, delay: float, route: Route, payload, key: str, attempt: int):
+        self.pending[route.peer_id] = self.pending.get(route.peer_id, 0) + 1
+        handle = None
+
+        def fire():
+            self.timers.discard(handle)
+            self.pending[route.peer_id] -= 1
+            self._resubmit(route, payload, key, attempt)
+
+        handle = asyncio.get_running_loop().call_later(delay, fire)
+        self.timers.add(handle)
+
+    def _resubmit(self, route: Route, payload, key: str, attempt: int):
+        async def retry_api_request():
+            await run_api_request(route, payload, key, attempt)
+
+        try:
+            send_scheduler.submit(route.peer_id, retry_api_request)
+            self.counters[route.peer_id]['retried'] += 1
+        except SchedulerFull as e:
+            # Keep waiting rather than lose the reply
+            self._arm(e.retry_after, route, payload, key, attempt)
+
+    def stats(self) -> dict:
+        return {
+            'pending': sum(self.pending.values()),
+            'endpoints': {
+                peer_id: {**counters, 'pending': self.pending.get(peer_id, 0)}
+                for peer_id, counters in self.counters.items()
+            }
+        }
+
+    def cancel(self):
+        if self.timers:
+            logger.warning(f"Dropping {len(self.timers)} AI requests waiting to be retried")
+        for handle in self.timers:
+            handle.cancel()
+        self.timers.clear()
+
+
+api_retries: Optional[RetryQueue] = None
+
+
+async def run_api_request(route: Route, payload, key: str, attempt: int = 0):
+    """Run one attempt of an AI request, scheduling a retry on 429/5xx.
+
+    The single-flight group for `key` is finished (and its followers served)
+    only once the request succeeds or gives up.
+    """
+    reply = None
+    retrying = False
+    try:
+        reply = await process_api_request(route, payload, key)
+    except RetryableAPIError as e:
+        retrying = api_retries.schedule(route, payload, key, attempt + 1, e)
+        if not retrying:
+            logger.error(f"Giving up on API request to {route.peer_id} after {attempt} retries")
+            reply = api_error_reply(route, f"{route.peer_id} is busy; please try again in a moment.")
+            await deliver_to_local_peer(reply)
+    finally:
+        if not retrying:
+            api_flights.finish(key, reply)
+
+
+def follow_api_flight(route: Route, flight: asyncio.Future):
+    """Deliver a coalesced request's copy of the shared reply once the leading call finishes"""
+    def on_done(future: asyncio.Future):
+        reply = None if future.cancelled() else future.result()
+        if reply is None:
+            logger.warning(f"Coalesced request to {route.peer_id} got no reply")
+            return
+
+        async def deliver():
+            await deliver_to_local_peer({**reply, "timestamp": datetime.utcnow().isoformat()})
+
+        try:
+            send_scheduler.submit(route.peer_id, deliver)
+        except SchedulerFull as e:
+            logger.error(f"Dropping coalesced reply: {e}")
+
+    flight.add_done_callback(on_done)
+
+
+def submit_api_request(route: Route, payload) -> bool:
+    """Queue an AI request, attaching it to an identical in-flight one when possible.
+
+    Returns True if the request was coalesced; raises SchedulerFull when the
+    endpoint's queue is full.
+    """
+    key = ResponseCache.key(route.peer_id, route.info.get('model_config', {}), payload)
+    if proxy_settings['coalesce_requests']:
+        flight = api_flights.join(key)
+        if flight is not None:
+            follow_api_flight(route, flight)
+            return True
+        api_flights.start(key)
+
+    async def send_api_request():
+        await run_api_request(route, payload, key)
+
+    try:
+        send_scheduler.submit(route.peer_id, send_api_request)
+    except SchedulerFull:
+        api_flights.finish(key, None)
+        raise
+    return False
+
+
+async def save_response_cache():
+    """Periodically persist the response cache"""
     while True:
+        await asyncio.sleep(proxy_settings['response_cache_save_interval'])
         try:
-            async with httpx.AsyncClient() as client:
-                logger.info(f"Fetching endpoints for {instance_name} (proxy_id: {proxy_id})")
-                response = await client.get(
-                    f"{controller_url}/api/getendpoints",
-                    params={"proxy_id": proxy_id}
-                )
-
-                if response.status_code == 200:
-                    data = response.json()
-                    logger.info(f"Received data from controller: {json.dumps(data, indent=2)}")
-
-                    if not data.get('endpoints'):
-                        logger.error("Received empty endpoints from controller")
-                        await asyncio.sleep(60)
-                        continue
-
-                    # Store current peers for comparison
-                    old_peers = set(peers.keys()) if peers else set()
-                    new_endpoints = data['endpoints']
-
-                    logger.info(f"Current peers before update: {old_peers}")
-                    logger.info(f"New endpoints received: {list(new_endpoints.keys())}")
-
-                    # Update peers dictionary (keeping entire configuration)
-                    peers = new_endpoints.copy()
-
-                    # Log changes
-                    new_peer_set = set(peers.keys())
-                    added = new_peer_set - old_peers
-                    removed = old_peers - new_peer_set
-
-                    #logger.info(f"Updated endpoints for {instance_name}. Current peers: {list(peers.keys())}")
-
-                    logger.info(f"Peers configuration after update: {json.dumps(peers, indent=2)}")
-                    if added:
-                        logger.info(f"Added peers: {added}")
-                    if removed:
-                        logger.info(f"Removed peers: {removed}")
-
-                    retries = 0
-                else:
-                    logger.error(f"Failed to get endpoints: {response.text}")
-                    if retries < max_retries:
-                        retries += 1
-                        await asyncio.sleep(5)
-                        continue
-
-            await asyncio.sleep(60)
+            response_cache.save()
         except Exception as e:
-            logger.error(f"Error updating endpoints: {e}")
-            if retries < max_retries:
-                retries += 1
-                await asyncio.sleep(5)
-                continue
-            await asyncio.sleep(60)
-            retries = 0
+            logger.error(f"Error saving response cache: {e}")
+
+
+async def post_batch(destination: str, batch: list, timeout: httpx.Timeout):
+    """POST a batch to a remote proxy's /_batch route, backing off while it answers 503"""
+    body = {'source': instance_name, 'messages': batch}
+    for attempt in range(proxy_settings['batch_retries']):
+        response = await upstream_pools.post(f"{destination}/_batch", json=body, timeout=timeout)
+        if response.status_code != 503:
+            break
+        # The remote proxy's inbound queue is full; back off as it asks
+        await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+    response.raise_for_status()
+
+
+class ProxyBatcher:
+    """Gathers messages bound for the same remote proxy into batched POSTs.
+
+    A batch is flushed when it reaches `max_size` messages or `window` seconds
+    after its first message, and sent to the remote proxy's /_batch route.
+    Batches go through a single-worker scheduler per destination, and the
+    receiver delivers them through a single-worker queue per source, so
+    messages arrive in the order they were sent.
+    """
+
+    def __init__(self, window: float, max_size: int, scheduler: SendScheduler):
+        self.window = window
+        self.max_size = max_size
+        self.scheduler = scheduler
+        self.buffers: Dict[str, list] = {}
+        self.timeouts: Dict[str, httpx.Timeout] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.counters = {'messages': 0, 'batches': 0, 'max_batch_size': 0}
+
+    def add(self, route: Route, data):
+        """Buffer a message for its route's proxy; raises SchedulerFull when backed up"""
+        destination = UpstreamPools.origin(route.url)
+        if self.scheduler.is_full(destination):
+            raise SchedulerFull(destination, self.scheduler.retry_after(destination))
+
+        buffer = self.buffers.setdefault(destination, [])
+        buffer.append({'target': route.peer_id, 'data': data})
+        self.timeouts[destination] = route.timeout
+        self.counters['messages'] += 1
+
+        if len(buffer) >= self.max_size:
+            self.flush(destination)
+        elif destination not in self.timers:
+            self.timers[destination] = asyncio.get_running_loop().call_later(self.window, self.flush, destination)
+
+    def flush(self, destination: str):
+        """Hand a destination's buffered messages to the scheduler as one batch"""
+        timer = self.timers.pop(destination, None)
+        if timer:
+            timer.cancel()
+        batch = self.buffers.pop(destination, None)
+        if not batch:
+            return
+        timeout = self.timeouts[destination]
+
+        async def send_batch():
+            # Checked in the scheduler's worker so batches stay in order when the link comes up
+            if proxy_links and proxy_links.send(destination, batch):
+                return
+            await post_batch(destination, batch, timeout)
+
+        try:
+            self.scheduler.submit(destination, send_batch)
+        except SchedulerFull as e:
+            # These messages were already accepted; keep them and retry rather than drop
+            logger.warning(f"Batch queue for {destination} full, retrying in {e.retry_after}s")
+            self.buffers[destination] = batch + self.buffers.get(destination, [])
+            self.timers[destination] = asyncio.get_running_loop().call_later(e.retry_after, self.flush, destination)
+            return
+
+        self.counters['batches'] += 1
+        self.counters['max_batch_size'] = max(self.counters['max_batch_size'], len(batch))
+
+    def flush_all(self):
+        for destination in list(self.buffers):
+            self.flush(destination)
+
+    def stats(self) -> dict:
+        batches = self.counters['batches']
+        return {
+            **self.counters,
+            'window_ms': self.window * 1000,
+            'max_size': self.max_size,
+            'avg_batch_size': round(self.counters['messages'] / batches, 1) if batches else None,
+            'buffered': sum(len(buffer) for buffer in self.buffers.values()),
+            'queues': self.scheduler.stats()
+        }
+
+
+proxy_batcher: Optional[ProxyBatcher] = None
+
+
 @app.before_serving
 async def startup():
-    """Initialize HTTP/2 client and start background tasks"""
-    global http_client
-    http_client = await setup_client()
+    """Initialize upstream connection pools and start background tasks"""
+    global send_scheduler, batch_scheduler, inbound_scheduler, proxy_batcher, proxy_links, response_cache, api_retries
+    await setup_pools()
+    rebuild_routes()
+    send_scheduler = SendScheduler(
+        'proxy',
+        queue_size=proxy_settings['send_queue_size'],
+        workers=proxy_settings['send_workers']
+    )
+    api_retries = RetryQueue(
+        proxy_settings['api_retry_attempts'],
+        proxy_settings['api_retry_base_delay'],
+        proxy_settings['api_retry_max_delay']
+    )
+    # Batches received from other proxies are delivered in order, one source at a time
+    inbound_scheduler = SendScheduler('inbound', queue_size=proxy_settings['send_queue_size'], workers=1)
+    # One worker per destination keeps batches to a proxy in order
+    batch_scheduler = SendScheduler('batch', queue_size=proxy_settings['send_queue_size'], workers=1)
+    if proxy_settings['batch_window_ms'] > 0:
+        proxy_batcher = ProxyBatcher(
+            proxy_settings['batch_window_ms'] / 1000,
+            proxy_settings['batch_max_size'],
+            batch_scheduler
+        )
+    if proxy_settings['proxy_links']:
+        proxy_links = LinkManager(
+            instance_name,
+            receive=receive_link_batch,
+            undelivered=resend_link_batch,
+            queue_size=proxy_settings['link_queue_size'],
+            ping_interval=proxy_settings['link_ping_interval'],
+            backoff_max=proxy_settings['link_backoff_max']
+        )
+    if proxy_settings['response_cache_size'] > 0:
+        response_cache = ResponseCache(
+            proxy_settings['response_cache_size'],
+            path=proxy_settings['response_cache_path']
+        )
+        response_cache.load()
+        if response_cache.path:
+            app.cache_task = asyncio.create_task(save_response_cache())
 
     # Register with controller
     await register_with_controller()
 
     # Start background tasks
     app.heartbeat_task = asyncio.create_task(send_heartbeat())
-    app.endpoints_task = asyncio.create_task(update_endpoints())
+    app.endpoints_task = asyncio.create_task(watch_endpoints())
 
 
 @app.after_serving
 async def shutdown():
     """Clean up resources"""
-    global http_client
-    if http_client:
-        await http_client.aclose()
-
-    if hasattr(app, 'heartbeat_task'):
-        app.heartbeat_task.cancel()
-    if hasattr(app, 'endpoints_task'):
-        app.endpoints_task.cancel()
-    try:
-        if hasattr(app, 'heartbeat_task'):
-            await app.heartbeat_task
-        if hasattr(app, 'endpoints_task'):
-            await app.endpoints_task
-    except asyncio.CancelledError:
-        pass
-
-
+    background_tasks = [
+        getattr(app, task_name) for task_name in ('heartbeat_task', 'endpoints_task', 'cache_task')
+        if hasattr(app, task_name)
+    ]
+    for task in background_tasks:
+        task.cancel()
+    for task in background_tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    # Drain queued sends before the pools they use are closed
+    if proxy_batcher:
+        proxy_batcher.flush_all()
+    if api_retries:
+        api_retries.cancel()
+    if proxy_links:
+        # Batches a closing link had not confirmed are resent over HTTP below
+        await proxy_links.close()
+    if batch_scheduler:
+        await batch_scheduler.shutdown(proxy_settings['shutdown_deadline'])
+    if inbound_scheduler:
+        await inbound_scheduler.shutdown(proxy_settings['shutdown_deadline'])
+    if send_scheduler:
+        await send_scheduler.shutdown(proxy_settings['shutdown_deadline'])
+    # Leaders dropped by the scheduler or waiting on a cancelled retry never finish their flights
+    api_flights.finish_all(None)
+    if response_cache:
+        response_cache.save()
+    if upstream_pools:
+        await upstream_pools.aclose()
 
 
 @app.route('/peers', methods=['GET'])
@@ -429,29 +1670,176 @@ async def get_peers():
     })
 
 
+@app.route('/stats', methods=['GET'])
+async def get_stats():
+    """Return connection pool, routing, streaming, queue, rate limit, retry, cache, coalescing, batching and link statistics"""
+    return jsonify({
+        "instance": instance_name,
+        **(upstream_pools.stats() if upstream_pools else {}),
+        "routing": route_stats(),
+        "streaming": streaming_stats(),
+        "scheduler": send_scheduler.stats() if send_scheduler else {},
+        "rate_limits": {peer_id: limiter.stats() for peer_id, limiter in endpoint_limiters.items()},
+        "retries": api_retries.stats() if api_retries else {},
+        "cache": response_cache.stats() if response_cache else {},
+        "single_flight": api_flights.stats(),
+        "batching": proxy_batcher.stats() if proxy_batcher else {"enabled": False},
+        "links": proxy_links.stats() if proxy_links else {"enabled": False},
+        "inbound_batches": inbound_scheduler.stats() if inbound_scheduler else {}
+    })
+
+
 async def forward_to_peer(message_data: dict, target_peer: str):
     """Forward a message to a peer's local service"""
     try:
-        peer_id, peer_info = get_peer_info(target_peer)
-        if not peer_id or not peer_info:
+        route = resolve_route(target_peer)
+        if route is None:
             logger.error(f"Cannot forward: unknown peer {target_peer}")
             return
 
         # Add /message to the peer URL
-        peer_url = f"http://{peer_info['host']}:{peer_info['port']}/message"  # Changed from just /
+        peer_url = f"{endpoint_url(route.info)}/message"
         headers = {
             'Host': target_peer,
             'Content-Type': 'application/json'
         }
 
-        async with httpx.AsyncClient() as client:
-            await client.post(peer_url, json=message_data, headers=headers)
-            logger.info(f"Forwarded message to {target_peer}")
+        await upstream_pools.post(peer_url, json=message_data, headers=headers, timeout=route.timeout)
+        logger.info(f"Forwarded message to {target_peer}")
 
     except Exception as e:
         logger.error(f"Failed to forward to peer: {e}")
 
 
+async def dispatch_message(target_peer: str, data) -> tuple[dict, int]:
+    """Route one message to the local peer, an AI API or a remote proxy.
+
+    Returns the response body and status code; raises SchedulerFull when the
+    destination's send queue is full.
+    """
+    route = resolve_route(target_peer)
+    if route is None:
+        return {"status": "error", "message": f"Unknown peer: {target_peer}"}, 404
+
+    # Case 1: Message is for this instance's peer.py
+    if route.is_local:
+        await upstream_pools.post(route.url, json=data, headers=route.headers, timeout=route.timeout)
+        return {"status": "success", "message": "Message delivered to local peer"}, 200
+
+    # Case 2: Message is for a bot API
+    if route.is_api:
+        if route.transform_request:
+            transformed_data = route.transform_request(data, route.info)
+        else:
+            transformed_data = data
+
+        if submit_api_request(route, transformed_data):
+            return {"status": "success", "message": "Request joined an identical in-flight API call"}, 200
+        return {"status": "success", "message": "Request sent to API"}, 200
+
+    # Case 3: Message is for another peer's proxy
+    proxy_url = route.url
+    logger.info(f"Forwarding to peer proxy at: {proxy_url}")
+
+    if proxy_batcher:
+        proxy_batcher.add(route, data)
+        return {"status": "success", "message": f"Message queued for peer proxy at {proxy_url}"}, 200
+
+    if proxy_links and proxy_links.send(UpstreamPools.origin(proxy_url), [{'target': route.peer_id, 'data': data}]):
+        return {"status": "success", "message": f"Message sent over link to peer proxy at {proxy_url}"}, 200
+
+    async def send_to_peer_proxy():
+        response = await upstream_pools.post(proxy_url, json=data, headers=route.headers, timeout=route.timeout)
+        response.raise_for_status()
+
+    send_scheduler.submit(route.peer_id, send_to_peer_proxy)
+    return {"status": "success", "message": f"Message sent to peer proxy at {proxy_url}"}, 200
+
+
+def inbound_origin(source: str, fallback: str) -> str:
+    """Name inbound traffic after the peer proxy `source` resolves to, or `fallback` for anyone else.
+
+    `source` is whatever the caller claims; resolving it bounds the inbound
+    queues and links to the proxies we know, plus one shared fallback.
+    """
+    route = resolve_route(source) if source else None
+    if route and not route.is_local and not route.is_api:
+        return UpstreamPools.origin(route.url)
+    return fallback
+
+
+async def deliver_batch(messages: list):
+    """Dispatch the messages of one batch in order"""
+    for item in messages:
+        try:
+            _, status = await dispatch_message(item.get('target', ''), item.get('data'))
+            if status != 200:
+                logger.error(f"Batched message for {item.get('target')} not delivered ({status})")
+        except SchedulerFull as e:
+            logger.error(f"Dropping batched message: {e}")
+        except Exception as e:
+            logger.error(f"Error dispatching batched message: {e}")
+
+
+@app.route('/_batch', methods=['POST'])
+async def receive_batch():
+    """Accept a batch from a peer proxy and queue its messages for in-order delivery"""
+    body = await request.get_json()
+    messages = body.get('messages') if isinstance(body, dict) else None
+    if not isinstance(messages, list):
+        return jsonify({"status": "error", "message": "Expected a list of messages"}), 400
+
+    async def deliver():
+        await deliver_batch(messages)
+
+    try:
+        inbound_scheduler.submit(inbound_origin(body.get('source'), 'batch'), deliver)
+    except SchedulerFull as e:
+        logger.warning(f"Rejecting batch: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    return jsonify({"status": "success", "queued": len(messages)})
+
+
+async def receive_link_batch(source: str, messages: list):
+    """Queue a batch that arrived over a link, waiting for room rather than rejecting it"""
+    async def deliver():
+        await deliver_batch(messages)
+
+    while True:
+        try:
+            inbound_scheduler.submit(source, deliver)
+            return
+        except SchedulerFull as e:
+            # Not reading further frames meanwhile pushes back on the sending proxy
+            await asyncio.sleep(e.retry_after)
+
+
+def resend_link_batch(destination: str, messages: list):
+    """Resend a batch a dropped link could not confirm through /_batch"""
+    async def resend():
+        await post_batch(destination, messages, httpx.Timeout(DEFAULT_TIMEOUT))
+
+    try:
+        batch_scheduler.submit(destination, resend)
+    except SchedulerFull as e:
+        logger.error(f"Dropping {len(messages)} messages for {destination}: {e}")
+
+
+@app.websocket('/_link')
+async def accept_link():
+    """Serve a persistent link opened by a peer proxy.
+
+    Accepted links only carry batches to this proxy; replies go over links
+    this proxy dials itself, since `source` is whatever the caller claims.
+    """
+    if proxy_links is None:
+        await websocket.close(1013)
+        return
+    await websocket.accept()
+    await proxy_links.accept(inbound_origin(websocket.args.get('source', ''), 'link'), websocket)
+
+
 @app.route('/', methods=['GET', 'POST'], defaults={'path': ''})
 @app.route('/<path:path>', methods=['GET', 'POST'])
 async def handle_request(path):
@@ -462,67 +1850,12 @@ async def handle_request(path):
 
         logger.info(f"Handling request for {target_peer}")
 
-        actual_peer_id, peer_info = get_peer_info(target_peer)
-        if not actual_peer_id or not peer_info:
-            return jsonify({"status": "error", "message": f"Unknown peer: {target_peer}"}), 404
-
-        # Case 1: Message is for this instance's peer.py
-        if target_peer.lower() == instance_name.lower():
-            peer_url = f"http://127.0.0.1:{client_port}/message"
-            headers = {'Content-Type': 'application/json'}
-            async with httpx.AsyncClient() as client:
-                await client.post(peer_url, json=data, headers=headers)
-            return jsonify({"status": "success", "message": "Message delivered to local peer"})
-
-        # Case 2: Message is for a bot API
-        if peer_info.get('is_api'):
-            transform_type = peer_info.get('transform_request')
-            if transform_type and transform_type in TRANSFORM_FUNCTIONS:
-                transformed_data = TRANSFORM_FUNCTIONS[transform_type](data, peer_info)
-            else:
-                transformed_data = data
-
-            url = f"https://{peer_info['host']}{peer_info.get('path', '/')}"
-            api_headers = peer_info.get('headers', {})
-
-            async def send_api_request():
-                try:
-                    async with httpx.AsyncClient() as client:
-                        response = await client.post(url, json=transformed_data, headers=api_headers)
-                        if response.status_code == 200:
-                            response_data = response.json()
-                            if peer_info.get('transform_response'):
-                                response_data = RESPONSE_TRANSFORM_FUNCTIONS[peer_info['transform_response']](
-                                    response_data)
-                            # Send bot response to our local peer.py
-                            peer_url = f"http://127.0.0.1:{client_port}/message"
-                            headers = {'Content-Type': 'application/json'}
-                            await client.post(peer_url, json=response_data, headers=headers)
-                except Exception as e:
-                    logger.error(f"API request failed: {e}")
-
-            asyncio.create_task(send_api_request())
-            return jsonify({"status": "success", "message": "Request sent to API"})
-
-        # Case 3: Message is for another peer's proxy
-        proxy_url = f"http://{peer_info['host']}:{peer_info['port']}/"
-        logger.info(f"Forwarding to peer proxy at: {proxy_url}")
-
-        headers = {
-            'Host': target_peer,
-            'Content-Type': 'application/json'
-        }
-
-        async def send_to_peer_proxy():
-            try:
-                async with httpx.AsyncClient() as client:
-                    await client.post(proxy_url, json=data, headers=headers)
-            except Exception as e:
-                logger.error(f"Failed to send to peer proxy: {e}")
-
-        asyncio.create_task(send_to_peer_proxy())
-        return jsonify({"status": "success", "message": f"Message sent to peer proxy at {proxy_url}"})
+        body, status = await dispatch_message(target_peer, data)
+        return jsonify(body), status
 
+    except SchedulerFull as e:
+        logger.warning(f"Rejecting request: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.error(f"Error handling request: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -534,6 +1867,8 @@ def run_proxy(config_path: str):
     config = Config()
     config.bind = [f"0.0.0.0:{proxy_port}"]
     config.h2_enabled = True
+    # Outlive the pools' keepalive_expiry so peers never reuse a connection we just closed
+    config.keep_alive_timeout = SERVER_KEEP_ALIVE_TIMEOUT
 
     logger.info(f"Starting proxy for {instance_name} on port {proxy_port}")
     asyncio.run(serve(app, config))
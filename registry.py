@@ -0,0 +1,81 @@
+import json
+import logging
+import sqlite3
+from typing import Dict, Tuple
+
+logger = logging.getLogger('registry')
+
+
+class ProxyRegistry:
+    """The controller's registered proxies and their endpoint sets, kept in SQLite.
+
+    One row per proxy holds its registration and its current endpoints, with
+    any customizations applied, under the revision they were given. The
+    controller-wide revision counter is kept too, so revisions handed out
+    after a restart stay newer than any a proxy already holds.
+
+    Heartbeats are not written; a reloaded proxy counts as just seen.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS proxies (
+                proxy_id TEXT PRIMARY KEY,
+                instance_name TEXT NOT NULL,
+                host TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                endpoints TEXT NOT NULL,
+                revision INTEGER NOT NULL
+            )
+        """)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), revision INTEGER NOT NULL)")
+
+    def load(self) -> Tuple[Dict[str, dict], int]:
+        """All stored proxies by id, and the revision counter"""
+        proxies = {}
+        for proxy_id, instance_name, host, port, endpoints, revision in self.db.execute(
+            "SELECT proxy_id, instance_name, host, port, endpoints, revision FROM proxies"
+        ):
+            proxies[proxy_id] = {
+                'instance_name': instance_name,
+                'host': host,
+                'port': port,
+                'endpoints': json.loads(endpoints),
+                'revision': revision
+            }
+        row = self.db.execute("SELECT revision FROM meta").fetchone()
+        revision = max([row[0] if row else 0, *(info['revision'] for info in proxies.values())])
+        return proxies, revision
+
+    def save(self, proxy_id: str, proxy_info: dict, revision: int):
+        """Write a proxy's registration and endpoints along with the revision counter"""
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "INSERT OR REPLACE INTO proxies (proxy_id, instance_name, host, port, endpoints, revision) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    proxy_id, proxy_info['instance_name'], proxy_info['host'], proxy_info['port'],
+                    json.dumps(proxy_info['endpoints'], separators=(',', ':')), proxy_info['revision']
+                )
+            )
+            self._save_revision(revision)
+
+    def delete(self, proxy_id: str, revision: int):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM proxies WHERE proxy_id = ?", (proxy_id,))
+            self._save_revision(revision)
+
+    def _save_revision(self, revision: int):
+        self.db.execute(
+            "INSERT INTO meta (id, revision) VALUES (0, ?) ON CONFLICT (id) DO UPDATE SET revision = excluded.revision",
+            (revision,)
+        )
+
+    def close(self):
+        self.db.close()
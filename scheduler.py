@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Dict
+
+logger = logging.getLogger('scheduler')
+
+
+class SchedulerFull(Exception):
+    """Raised when a destination's send queue cannot take more work"""
+
+    def __init__(self, destination: str, retry_after: int):
+        super().__init__(f"Send queue for {destination} is full")
+        self.destination = destination
+        self.retry_after = retry_after
+
+
+class SendScheduler:
+    """Bounded per-destination send queues drained by a fixed number of workers.
+
+    Fire-and-forget sends are submitted as job factories (callables returning a
+    coroutine). Each destination gets its own queue so one slow upstream cannot
+    starve the others; a full queue raises SchedulerFull instead of growing
+    without limit. Job failures are logged and counted rather than lost.
+
+    A destination whose queue has stayed empty for `idle_timeout` seconds is
+    removed with its workers and counters, so destinations that come and go
+    do not keep tasks alive for good. The next submit starts it afresh.
+    """
+
+    def __init__(self, name: str, queue_size: int = 100, workers: int = 4, idle_timeout: float = 300.0):
+        self.name = name
+        self.queue_size = queue_size
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.tasks: Dict[str, list] = {}
+        self.counters: Dict[str, dict] = {}
+        # Jobs running per destination; an idle destination has none
+        self.running: Dict[str, int] = {}
+        self.accepting = True
+
+    def _start(self, destination: str) -> asyncio.Queue:
+        """Create a destination's queue and worker tasks on first use"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.queues[destination] = queue
+        self.counters[destination] = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'max_depth': 0,
+            'drain_ms_total': 0.0,
+            'drain_ms_last': None,
+            'service_ms_total': 0.0
+        }
+        self.running[destination] = 0
+        self.tasks[destination] = [
+            asyncio.create_task(self._worker(destination, queue))
+            for _ in range(self.workers)
+        ]
+        return queue
+
+    def retry_after(self, destination: str) -> int:
+        """Estimate seconds until a full queue has room, from its mean service time"""
+        counters = self.counters.get(destination)
+        if not counters or not counters['completed'] + counters['failed']:
+            return 1
+        done = counters['completed'] + counters['failed']
+        service_s = counters['service_ms_total'] / done / 1000
+        depth = self.queues[destination].qsize()
+        return max(1, math.ceil(depth * service_s / self.workers))
+
+    def is_full(self, destination: str) -> bool:
+        """True if a destination's queue has no room for another send"""
+        queue = self.queues.get(destination)
+        return not self.accepting or (queue is not None and queue.full())
+
+    def submit(self, destination: str, job: Callable[[], Awaitable]):
+        """Queue a send for a destination; raises SchedulerFull when the queue is full"""
+        if not self.accepting:
+            raise SchedulerFull(destination, retry_after=1)
+
+        queue = self.queues.get(destination) or self._start(destination)
+        counters = self.counters[destination]
+        try:
+            queue.put_nowait((job, time.monotonic()))
+        except asyncio.QueueFull:
+            counters['rejected'] += 1
+            raise SchedulerFull(destination, self.retry_after(destination))
+
+        counters['submitted'] += 1
+        counters['max_depth'] = max(counters['max_depth'], queue.qsize())
+
+    async def _worker(self, destination: str, queue: asyncio.Queue):
+        counters = self.counters[destination]
+        while True:
+            try:
+                job, enqueued = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if self._reap(destination, queue):
+                    return
+                continue
+            started = time.monotonic()
+            self.running[destination] += 1
+            try:
+                await job()
+                counters['completed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                counters['failed'] += 1
+                logger.error(f"[{self.name}] Send to {destination} failed: {e}")
+            finally:
+                self.running[destination] -= 1
+                finished = time.monotonic()
+                counters['service_ms_total'] += (finished - started) * 1000
+                drain_ms = (finished - enqueued) * 1000
+                counters['drain_ms_total'] += drain_ms
+                counters['drain_ms_last'] = round(drain_ms, 1)
+                queue.task_done()
+
+    def _reap(self, destination: str, queue: asyncio.Queue) -> bool:
+        """Remove an idle destination and stop its other workers; False if it still has work"""
+        if self.queues.get(destination) is not queue or not queue.empty() or self.running[destination]:
+            return False
+        current = asyncio.current_task()
+        for task in self.tasks.pop(destination):
+            if task is not current:
+                task.cancel()
+        del self.queues[destination]
+        del self.counters[destination]
+        del self.running[destination]
+        return True
+
+    def stats(self) -> dict:
+        """Queue depth, outcome counters and drain time per destination"""
+        result = {}
+        for destination, queue in self.queues.items():
+            counters = self.counters[destination]
+            done = counters['completed'] + counters['failed']
+            result[destination] = {
+                'depth': queue.qsize(),
+                'capacity': self.queue_size,
+                'workers': self.workers,
+                'submitted': counters['submitted'],
+                'completed': counters['completed'],
+                'failed': counters['failed'],
+                'rejected': counters['rejected'],
+                'max_depth': counters['max_depth'],
+                'drain_ms_last': counters['drain_ms_last'],
+                'drain_ms_avg': round(counters['drain_ms_total'] / done, 1) if done else None
+            }
+        return result
+
+    async def shutdown(self, deadline: float = 10.0):
+        """Stop accepting work, drain queued sends for up to `deadline` seconds, then cancel"""
+        self.accepting = False
+        pending = sum(queue.qsize() for queue in self.queues.values())
+        if pending:
+            logger.info(f"[{self.name}] Draining {pending} queued sends")
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self.queues.values())),
+                timeout=deadline
+            )
+        except asyncio.TimeoutError:
+            dropped = sum(queue.qsize() for queue in self.queues.values())
+            logger.warning(f"[{self.name}] Shutdown deadline reached, dropping {dropped} queued sends")
+
+        tasks = [task for worker_tasks in self.tasks.values() for task in worker_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
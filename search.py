@@ -0,0 +1,247 @@
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from storage import MessageStore
+
+logger = logging.getLogger('search')
+
+# A query word, optionally ending in `*` to match it as a prefix
+QUERY_TERM = re.compile(r'(\w+)(\*?)')
+
+
+def fts5_available() -> bool:
+    """Whether Python's SQLite was built with the FTS5 extension"""
+    try:
+        sqlite3.connect(':memory:').execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def phrase(text: str) -> str:
+    """Quote text as an FTS5 phrase, so none of it is read as query syntax"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+class SearchIndex:
+    """Full-text index over chat messages, kept in its own SQLite FTS5 database.
+
+    Rows are keyed by message id and carry the whole message, so results need
+    no lookups in the store. The index is fed every stored message and is not
+    trimmed by retention, which keeps archived conversations searchable;
+    clearing a chat removes it here too.
+
+    Adds are buffered and written `batch_size` at a time, or before the next
+    search. Whatever a crash loses is indexed again by catch_up() at startup.
+
+    Ranking a word found in a large share of the history would cost time in
+    proportion to the history, so only the newest `candidates` matches are
+    ranked, or as many as a page reaching further back needs. Queries
+    matching fewer messages are ranked exactly; search_page() reports when
+    a query was not.
+    """
+
+    COLUMNS = ('id', 'peer_id', 'sender', 'message', 'status', 'timestamp', 'auto_reply')
+
+    def __init__(self, path: str, batch_size: int = 100, candidates: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.candidates = candidates
+        self.pending: List[dict] = []
+        self._open()
+        self.counters = {
+            'indexed': 0,
+            'batches': 0,
+            'searches': 0,
+            'truncated': 0,
+            'search_ms_total': 0.0,
+            'search_ms_last': None
+        }
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'"
+        ).fetchone()
+        if not exists:
+            # peer_id and sender are indexed too, so filters on them narrow the match
+            # instead of scanning it; only the message text counts towards the rank
+            self.db.execute("""
+                CREATE VIRTUAL TABLE messages USING fts5(
+                    message, peer_id, sender,
+                    status UNINDEXED, timestamp UNINDEXED, auto_reply UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """)
+            self.db.execute("INSERT INTO messages (messages, rank) VALUES ('rank', 'bm25(1.0, 0.0, 0.0)')")
+
+    def add(self, message: dict):
+        """Index a stored message (it must carry its id)"""
+        self.pending.append(message)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        with self.db:
+            self.db.execute("BEGIN")
+            # A message id handed out again after a crash replaces the lost message's row
+            self.db.executemany("DELETE FROM messages WHERE rowid = ?", ((message['id'],) for message in batch))
+            self.db.executemany(
+                "INSERT INTO messages (rowid, message, peer_id, sender, status, timestamp, auto_reply) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        message['id'], message['message'], message['peer_id'], message['sender'],
+                        message.get('status', 'success'), message['timestamp'], int(bool(message.get('auto_reply')))
+                    )
+                    for message in batch
+                )
+            )
+        self.counters['indexed'] += len(batch)
+        self.counters['batches'] += 1
+
+    def max_id(self) -> int:
+        """Id of the newest indexed message (0 when empty)"""
+        self.flush()
+        row = self.db.execute("SELECT MAX(rowid) FROM messages").fetchone()
+        return row[0] or 0
+
+    def resume(self, store_max_id: int) -> int:
+        """Drop messages the store lost in a crash; returns the newest id still indexed"""
+        self.flush()
+        self.db.execute("DELETE FROM messages WHERE rowid > ?", (store_max_id,))
+        return self.max_id()
+
+    def catch_up(self, store: MessageStore, after: int, upto: int, chunk: int = 1000) -> Iterator[int]:
+        """Index stored messages with ids in (after, upto], yielding after each chunk"""
+        total = 0
+        while after < upto:
+            messages = [message for message in store.since(after, chunk) if message['id'] <= upto]
+            if not messages:
+                break
+            for message in messages:
+                self.add(message)
+            self.flush()
+            after = messages[-1]['id']
+            total += len(messages)
+            yield len(messages)
+        if total:
+            logger.info(f"Indexed {total} stored messages for search")
+
+    def _filters(self, query: str, peer_id: Optional[str], sender: Optional[str], since: Optional[str],
+                 until: Optional[str], auto_reply: Optional[bool]) -> Optional[Tuple[str, list]]:
+        """The WHERE clause and parameters for a query, or None if it has no words"""
+        terms = [phrase(word) + star for word, star in QUERY_TERM.findall(query)]
+        if not terms:
+            return None
+        match = f"message : ({' '.join(terms)})"
+        conditions = ["messages MATCH ?"]
+        params: list = []
+        for column, value in (('peer_id', peer_id), ('sender', sender)):
+            if value is None:
+                continue
+            # Narrow by the column's tokens, then compare exactly
+            if QUERY_TERM.search(value):
+                match += f" AND {column} : {phrase(value)}"
+            conditions.append(f"{column} = ?")
+            params.append(value)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(until)
+        if auto_reply is not None:
+            conditions.append("auto_reply = ?")
+            params.append(int(auto_reply))
+        return ' AND '.join(conditions), [match, *params]
+
+    def search(self, query: str, peer_id: Optional[str] = None, sender: Optional[str] = None,
+               since: Optional[str] = None, until: Optional[str] = None, auto_reply: Optional[bool] = None,
+               limit: int = 20, offset: int = 0) -> List[dict]:
+        """Messages matching every word of `query`, best match first; see search_page()"""
+        return self.search_page(query, peer_id, sender, since, until, auto_reply, limit, offset)['results']
+
+    def search_page(self, query: str, peer_id: Optional[str] = None, sender: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None, auto_reply: Optional[bool] = None,
+                    limit: int = 20, offset: int = 0) -> dict:
+        """A page of messages matching every word of `query`, best match first.
+
+        A word ending in `*` matches as a prefix. `since` and `until` are ISO
+        timestamps bounding the messages to [since, until). Returns
+        `results`, and `truncated`, which is true when older matches were
+        left out of the ranking.
+        """
+        filters = self._filters(query, peer_id, sender, since, until, auto_reply)
+        if filters is None:
+            return {'results': [], 'truncated': False}
+        where, params = filters
+        self.flush()
+        started = time.perf_counter()
+        # Rank enough of the newest matches to fill the page asked for
+        ranked = max(self.candidates, offset + limit)
+        # Matches stream out newest first without being ranked; only the candidates get a bm25 score
+        rows = self.db.execute(
+            f"SELECT id, peer_id, sender, message, status, timestamp, auto_reply FROM ("
+            f"SELECT rowid AS id, peer_id, sender, message, status, timestamp, auto_reply, rank FROM messages "
+            f"WHERE {where} ORDER BY rowid DESC LIMIT ?"
+            f") ORDER BY rank, id DESC LIMIT ? OFFSET ?",
+            (*params, ranked, limit, offset)
+        ).fetchall()
+        truncated = self.db.execute(
+            f"SELECT 1 FROM messages WHERE {where} ORDER BY rowid DESC LIMIT 1 OFFSET ?", (*params, ranked)
+        ).fetchone() is not None
+        search_ms = (time.perf_counter() - started) * 1000
+        self.counters['searches'] += 1
+        self.counters['truncated'] += truncated
+        self.counters['search_ms_total'] += search_ms
+        self.counters['search_ms_last'] = round(search_ms, 2)
+        results = []
+        for row in rows:
+            message = dict(zip(self.COLUMNS, row))
+            message['auto_reply'] = bool(message['auto_reply'])
+            results.append(message)
+        return {'results': results, 'truncated': truncated}
+
+    def clear(self, peer_id: str):
+        self.pending = [message for message in self.pending if message['peer_id'] != peer_id]
+        if QUERY_TERM.search(peer_id):
+            self.db.execute(
+                "DELETE FROM messages WHERE rowid IN "
+                "(SELECT rowid FROM messages WHERE messages MATCH ? AND peer_id = ?)",
+                (f"peer_id : {phrase(peer_id)}", peer_id)
+            )
+        else:
+            self.db.execute("DELETE FROM messages WHERE peer_id = ?", (peer_id,))
+
+    def clear_all(self):
+        # Deleting an FTS5 table's rows costs time per row; starting a new file does not
+        self.pending = []
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        self._open()
+
+    def stats(self) -> dict:
+        searches = self.counters['searches']
+        counters = {key: value for key, value in self.counters.items() if key != 'search_ms_total'}
+        return {
+            **counters,
+            'pending': len(self.pending),
+            'batch_size': self.batch_size,
+            'search_ms_avg': round(self.counters['search_ms_total'] / searches, 2) if searches else None
+        }
+
+    def close(self):
+        self.flush()
+        self.db.close()
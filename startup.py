@@ -104,7 +104,8 @@ class ProcessManager:
             'instance_name': instance_name,
             'proxy_port': config['proxy_port'],
             'client_port': config['client_port'],
-            'controller_url': CONTROLLER_URL
+            'controller_url': CONTROLLER_URL,
+            'response_cache_path': f'response_cache_{instance_name}.json'
         }
 
         config_path = f'proxy_config_{instance_name}.json'
@@ -0,0 +1,1617 @@
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger('storage')
+
+# Fields every stored chat message carries, in addition to its integer `id`
+MESSAGE_FIELDS = ('peer_id', 'sender', 'message', 'status', 'timestamp', 'auto_reply')
+
+# A page cursor: a message id, an ISO timestamp, or a resolved (timestamp, id) position
+Cursor = Union[int, str, Tuple[str, int], None]
+
+
+def write_json(path: str, data):
+    """Replace a JSON file atomically, so a crash leaves the old or the new version"""
+    with open(f"{path}.tmp", 'w') as f:
+        # dumps() uses the C encoder; dump() streams through the Python one
+        f.write(json.dumps(data, separators=(',', ':')))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+class MessageStore(ABC):
+    """Chat history backend used by peer.py.
+
+    Messages are dicts with MESSAGE_FIELDS; backends add an increasing `id`.
+    """
+
+    @abstractmethod
+    def append(self, message: dict) -> dict:
+        """Store one message and return it with its id"""
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        """Store many messages in one go, keeping any `id` they already carry; returns how many"""
+        count = 0
+        for message in messages:
+            self.append(message)
+            count += 1
+        return count
+
+    @abstractmethod
+    def history(self, peer_id: str) -> List[dict]:
+        """All messages exchanged with a peer, oldest first"""
+
+    @abstractmethod
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        """Up to `limit` messages with a peer strictly between the cursors, oldest first.
+
+        Messages are ordered by (timestamp, id). With no `after`, the page is the
+        newest messages before `before` (or the newest overall); with `after`
+        only, it is the oldest messages after it.
+        """
+
+    @abstractmethod
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        """Up to `limit` messages with ids above `message_id`, across all peers, in id order"""
+
+    @abstractmethod
+    def get(self, message_id: int) -> Optional[dict]:
+        """The message with this id, or None"""
+
+    def position(self, cursor: Cursor) -> Optional[Tuple[str, int]]:
+        """Resolve a cursor to the (timestamp, id) it sorts at"""
+        if cursor is None:
+            return None
+        if isinstance(cursor, tuple):
+            return cursor
+        if isinstance(cursor, int):
+            message = self.get(cursor)
+            return (message['timestamp'], cursor) if message else None
+        # A bare timestamp sorts before every message carrying that timestamp
+        return (cursor, 0)
+
+    @abstractmethod
+    def max_id(self) -> int:
+        """Id of the newest message (0 when empty); grows with every append"""
+
+    @abstractmethod
+    def count(self, peer_id: Optional[str] = None) -> int:
+        """Number of stored messages, in total or with one peer"""
+
+    @abstractmethod
+    def peer_ids(self) -> List[str]:
+        """Every peer with at least one stored message"""
+
+    @abstractmethod
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        """Remove a peer's messages at or before a (timestamp, id) position"""
+
+    @abstractmethod
+    def clear(self, peer_id: str):
+        """Remove every message exchanged with a peer"""
+
+    @abstractmethod
+    def clear_all(self):
+        """Remove every message"""
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(MessageStore):
+    """SQLite in WAL mode, indexed on (peer_id, timestamp).
+
+    Each append is a small indexed insert, so its cost does not grow with the
+    size of the history the way rewriting a JSON file does.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Under WAL, NORMAL only syncs at checkpoints; a crash can lose the last
+        # few messages but never corrupts the database
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                peer_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                auto_reply INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_peer_timestamp ON messages (peer_id, timestamp)"
+        )
+
+    # Column order of SELECT_COLUMNS, used to build dicts without sqlite3.Row overhead
+    COLUMNS = ('id',) + MESSAGE_FIELDS
+    SELECT_COLUMNS = ', '.join(COLUMNS)
+
+    @classmethod
+    def _row(cls, row: tuple) -> dict:
+        message = dict(zip(cls.COLUMNS, row))
+        message['auto_reply'] = bool(message['auto_reply'])
+        return message
+
+    @staticmethod
+    def _values(message: dict) -> tuple:
+        return (
+            message['peer_id'],
+            message['sender'],
+            message['message'],
+            message.get('status', 'success'),
+            message['timestamp'],
+            int(bool(message.get('auto_reply')))
+        )
+
+    def append(self, message: dict) -> dict:
+        cursor = self.db.execute(
+            "INSERT INTO messages (peer_id, sender, message, status, timestamp, auto_reply) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            self._values(message)
+        )
+        return {'id': cursor.lastrowid, **message}
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        # A NULL id lets SQLite assign one; explicit ids also advance sqlite_sequence
+        with self.db:
+            self.db.execute("BEGIN")
+            cursor = self.db.executemany(
+                "INSERT INTO messages (id, peer_id, sender, message, status, timestamp, auto_reply) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((message.get('id'),) + self._values(message) for message in messages)
+            )
+        return cursor.rowcount
+
+    def history(self, peer_id: str) -> List[dict]:
+        rows = self.db.execute(
+            f"SELECT {self.SELECT_COLUMNS} FROM messages WHERE peer_id = ? ORDER BY timestamp, id",
+            (peer_id,)
+        )
+        return [self._row(row) for row in rows]
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        conditions = ["peer_id = ?"]
+        params: list = [peer_id]
+        for cursor, operator in ((before, '<'), (after, '>')):
+            if cursor is None:
+                continue
+            position = self.position(cursor)
+            if position is None:
+                return []
+            conditions.append(f"(timestamp, id) {operator} (?, ?)")
+            params.extend(position)
+        # Walk the (peer_id, timestamp) index from the end nearest the cursor
+        newest_first = after is None
+        order = "DESC" if newest_first else "ASC"
+        rows = self.db.execute(
+            f"SELECT {self.SELECT_COLUMNS} FROM messages WHERE {' AND '.join(conditions)} "
+            f"ORDER BY timestamp {order}, id {order} LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+        if newest_first:
+            rows.reverse()
+        return [self._row(row) for row in rows]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        rows = self.db.execute(
+            f"SELECT {self.SELECT_COLUMNS} FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (message_id, limit)
+        )
+        return [self._row(row) for row in rows]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        row = self.db.execute(f"SELECT {self.SELECT_COLUMNS} FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def max_id(self) -> int:
+        # sqlite_sequence keeps counting after deletes, unlike MAX(id)
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        return row[0] if row else 0
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is None:
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM messages WHERE peer_id = ?", (peer_id,)).fetchone()[0]
+
+    def peer_ids(self) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT DISTINCT peer_id FROM messages")]
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        self.db.execute("DELETE FROM messages WHERE peer_id = ? AND (timestamp, id) <= (?, ?)", (peer_id, *upto))
+
+    def clear(self, peer_id: str):
+        self.db.execute("DELETE FROM messages WHERE peer_id = ?", (peer_id,))
+
+    def clear_all(self):
+        self.db.execute("DELETE FROM messages")
+
+    def close(self):
+        self.db.close()
+
+
+class TinyDBStore(MessageStore):
+    """The original JSON-file store; rewrites the whole file on every insert"""
+
+    def __init__(self, path: str):
+        from tinydb import TinyDB
+        self.path = path
+        self.db = TinyDB(path)
+        self.table = self.db.table('messages')
+
+    def _message(self, document) -> dict:
+        return {'id': document.doc_id, **document}
+
+    def append(self, message: dict) -> dict:
+        return {'id': self.table.insert(dict(message)), **message}
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        from tinydb.table import Document
+        documents = []
+        for message in messages:
+            fields = {key: value for key, value in message.items() if key != 'id'}
+            documents.append(Document(fields, doc_id=message['id']) if message.get('id') else fields)
+        return len(self.table.insert_multiple(documents))
+
+    def history(self, peer_id: str) -> List[dict]:
+        from tinydb import Query
+        messages = [self._message(doc) for doc in self.table.search(Query().peer_id == peer_id)]
+        messages.sort(key=lambda x: x.get('timestamp', '0'))
+        return messages
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        bounds = [self.position(before), self.position(after)]
+        if (before is not None and bounds[0] is None) or (after is not None and bounds[1] is None):
+            return []
+        messages = [
+            message for message in self.history(peer_id)
+            if (bounds[0] is None or (message['timestamp'], message['id']) < bounds[0])
+            and (bounds[1] is None or (message['timestamp'], message['id']) > bounds[1])
+        ]
+        messages.sort(key=lambda x: (x['timestamp'], x['id']))
+        return messages[:limit] if after is not None else messages[-limit:]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        documents = sorted(
+            (doc for doc in self.table.all() if doc.doc_id > message_id),
+            key=lambda doc: doc.doc_id
+        )
+        return [self._message(doc) for doc in documents[:limit]]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        document = self.table.get(doc_id=message_id)
+        return self._message(document) if document else None
+
+    def max_id(self) -> int:
+        # TinyDB reuses no ids while the table has rows, but restarts at 1 after truncate
+        return max((doc.doc_id for doc in self.table.all()), default=0)
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is None:
+            return len(self.table)
+        from tinydb import Query
+        return self.table.count(Query().peer_id == peer_id)
+
+    def peer_ids(self) -> List[str]:
+        return sorted({doc.get('peer_id') for doc in self.table.all() if doc.get('peer_id')})
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        from tinydb import Query
+        doc_ids = [
+            doc.doc_id for doc in self.table.search(Query().peer_id == peer_id)
+            if (doc.get('timestamp', ''), doc.doc_id) <= tuple(upto)
+        ]
+        self.table.remove(doc_ids=doc_ids)
+
+    def clear(self, peer_id: str):
+        from tinydb import Query
+        self.table.remove(Query().peer_id == peer_id)
+
+    def clear_all(self):
+        self.table.truncate()
+
+    def close(self):
+        self.db.close()
+
+
+class LogStore(MessageStore):
+    """Append-only message log split into segment files, with a sparse index.
+
+    Records are length-prefixed: a 4-byte length, a CRC32 and a JSON payload,
+    either a message or a `clear` tombstone carrying the highest id it
+    removes. Appends only ever write to the end of the active segment. Once
+    it grows past `segment_bytes` it is sealed: the (timestamp, id, offset)
+    of each live message, grouped by peer, is written to a `.idx` file next
+    to it and a checkpoint is saved.
+
+    The checkpoint is the sparse part of the index. For each peer it lists
+    which sealed segments hold its messages and their (timestamp, id) range,
+    so a page only loads the `.idx` of the segments it touches and reads its
+    records through mmap. Startup loads the checkpoint and rescans only the
+    segments written after it, normally just the active one, so restart
+    time does not grow with the history. A torn record at the end of the
+    active segment (from a crash mid-write) is cut off.
+
+    Cleared and trimmed messages are skipped on read but stay on disk until
+    compact() deletes segments with nothing live left and rewrites mostly
+    dead ones.
+    Ids are expected to grow in append order, as the journal assigns them.
+    """
+
+    HEADER = struct.Struct('<II')
+    CHECKPOINT = 'checkpoint.json'
+
+    def __init__(self, path: str, segment_bytes: int = 8 * 1024 * 1024, cached_indexes: int = 16):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.cached_indexes = cached_indexes
+        os.makedirs(path, exist_ok=True)
+        # Sealed segments: number -> {first_id, last_id, records, live, size}
+        self.segments: Dict[int, dict] = {}
+        # Per peer, sealed segment number -> [first key, last key, message count]
+        self.peers: Dict[str, Dict[int, list]] = {}
+        self.cleared: Dict[str, int] = {}
+        self.cleared_all = 0
+        # Per peer, the (timestamp, id) position and the last id at the time of its newest trim
+        self.trimmed: Dict[str, tuple] = {}
+        self.last_id = 0
+        self.indexes: OrderedDict = OrderedDict()
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.active_fd: Optional[int] = None
+        self.active_number: Optional[int] = None
+        self.closed_active: Optional[dict] = None
+        self._load_checkpoint()
+
+        on_disk = sorted(
+            int(name[:-4]) for name in os.listdir(path) if name.endswith('.log') and name[:-4].isdigit()
+        )
+        for number in [number for number in self.segments if number not in on_disk]:
+            # Deleted by compaction after the last checkpoint
+            self._drop_segment(number)
+        tail = [number for number in on_disk if number not in self.segments]
+        if not tail:
+            tail = [max(on_disk, default=0) + 1]
+        for number in tail[:-1]:
+            self._open_active(number)
+            self._seal()
+        self._open_active(tail[-1])
+        if len(tail) > 1:
+            logger.info(f"Rebuilt the index of {len(tail) - 1} log segments in {path}")
+
+    # -- files -------------------------------------------------------------
+
+    def _file(self, number: int, extension: str) -> str:
+        return os.path.join(self.path, f"{number:08d}.{extension}")
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.path, self.CHECKPOINT)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            checkpoint = json.load(f)
+        self.last_id = checkpoint['last_id']
+        self.cleared = checkpoint['cleared']
+        self.cleared_all = checkpoint['cleared_all']
+        self.trimmed = {peer_id: (tuple(upto), last_id) for peer_id, (upto, last_id) in checkpoint.get('trimmed', {}).items()}
+        self.segments = {int(number): meta for number, meta in checkpoint['segments'].items()}
+        self.peers = {
+            peer_id: {int(number): [tuple(first), tuple(last), count] for number, (first, last, count) in ranges.items()}
+            for peer_id, ranges in checkpoint['peers'].items()
+        }
+        self.closed_active = checkpoint.get('closed_active')
+
+    def _save_checkpoint(self):
+        write_json(os.path.join(self.path, self.CHECKPOINT), {
+            'last_id': self.last_id,
+            'cleared': self.cleared,
+            'cleared_all': self.cleared_all,
+            'trimmed': self.trimmed,
+            'segments': self.segments,
+            'peers': self.peers,
+            'closed_active': self.closed_active
+        })
+
+    def _scan(self, number: int):
+        """Every intact (offset, record) of a segment file, and where the intact part ends"""
+        with open(self._file(number, 'log'), 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, offset)
+            end = offset + self.HEADER.size + length
+            payload = data[offset + self.HEADER.size:end]
+            if end > len(data) or zlib.crc32(payload) != crc:
+                break
+            records.append((offset, json.loads(payload)))
+            offset = end
+        return records, offset
+
+    def _map(self, number: int) -> mmap.mmap:
+        data = self.maps.get(number)
+        if data is None:
+            with open(self._file(number, 'log'), 'rb') as f:
+                data = self.maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def _unmap(self, number: int):
+        data = self.maps.pop(number, None)
+        if data is not None:
+            data.close()
+
+    def _read(self, number: int, offset: int) -> dict:
+        if number == self.active_number:
+            length, _ = self.HEADER.unpack(os.pread(self.active_fd, self.HEADER.size, offset))
+            payload = os.pread(self.active_fd, length, offset + self.HEADER.size)
+        else:
+            data = self._map(number)
+            length, _ = self.HEADER.unpack_from(data, offset)
+            payload = data[offset + self.HEADER.size:offset + self.HEADER.size + length]
+        return json.loads(payload)
+
+    def _encode(self, record: dict) -> bytes:
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    # -- active segment ----------------------------------------------------
+
+    def _open_active(self, number: int):
+        """Make a segment the active one, replaying whatever it already holds"""
+        self.active_number = number
+        self.active_index: Dict[str, list] = {}
+        self.active_ids: Dict[int, int] = {}
+        self.active_records = 0
+        path = self._file(number, 'log')
+        end = 0
+        if self.closed_active and self.closed_active['number'] == number and os.path.exists(path) \
+                and os.path.getsize(path) == self.closed_active['size'] and os.path.exists(self._file(number, 'idx')):
+            # Cleanly closed: its index was saved, so skip the rescan
+            with open(self._file(number, 'idx')) as f:
+                for peer_id, entries in json.load(f).items():
+                    self.active_index[peer_id] = [tuple(entry) for entry in entries]
+                    self.active_ids.update((entry[1], entry[2]) for entry in entries)
+            self.active_records = self.closed_active['records']
+            end = self.closed_active['size']
+        elif os.path.exists(path):
+            records, end = self._scan(number)
+            for offset, record in records:
+                self._apply(offset, record)
+            if end < os.path.getsize(path):
+                logger.warning(f"Truncating torn record at {path}:{end}")
+                os.truncate(path, end)
+        self.active_fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.active_size = end
+        if self.closed_active:
+            # The saved index goes stale once the segment is written to again
+            self.closed_active = None
+            self._save_checkpoint()
+
+    def _apply(self, offset: int, record: dict):
+        if record.get('tombstone') == 'trim':
+            self._trim(record['peer_id'], tuple(record['upto']), record['last_id'])
+            return
+        if 'tombstone' in record:
+            self.last_id = max(self.last_id, record['upto'])
+            self._forget(record.get('peer_id'), record['upto'])
+            return
+        self.last_id = max(self.last_id, record['id'])
+        self.active_records += 1
+        if not self._live(record):
+            return
+        entry = (record['timestamp'], record['id'], offset)
+        entries = self.active_index.setdefault(record['peer_id'], [])
+        if entries and entries[-1] > entry:
+            bisect.insort(entries, entry)
+        else:
+            entries.append(entry)
+        self.active_ids[record['id']] = offset
+
+    def _forget(self, peer_id: Optional[str], upto: int):
+        """Drop cleared messages from the index; a None peer means every conversation"""
+        if peer_id is None:
+            self.cleared_all = max(self.cleared_all, upto)
+            self.cleared = {}
+            self.trimmed = {}
+            peer_ids = set(self.peers) | set(self.active_index)
+        else:
+            self.cleared[peer_id] = max(self.cleared.get(peer_id, 0), upto)
+            self.trimmed.pop(peer_id, None)
+            peer_ids = {peer_id}
+        for peer in peer_ids:
+            for number, (_, _, count) in self.peers.pop(peer, {}).items():
+                if number in self.segments:
+                    self.segments[number]['live'] -= count
+            for _, message_id, _ in self.active_index.pop(peer, []):
+                self.active_ids.pop(message_id, None)
+
+    def _trim(self, peer_id: str, upto: tuple, last_id: int):
+        """Drop a peer's messages at or before `upto` that existed when the trim was written"""
+        previous = self.trimmed.get(peer_id)
+        if previous:
+            # Trims only move forward; merging keeps everything earlier trims removed
+            upto, last_id = max(upto, previous[0]), max(last_id, previous[1])
+        self.trimmed[peer_id] = (upto, last_id)
+        ranges = self.peers.get(peer_id, {})
+        for number, (first, last, count) in list(ranges.items()):
+            if first > upto:
+                continue
+            kept = [entry for entry in self._entries(number, peer_id) if self._kept(peer_id, *entry[:2])]
+            if number in self.segments:
+                self.segments[number]['live'] -= count - len(kept)
+            if kept:
+                ranges[number] = [kept[0][:2], kept[-1][:2], len(kept)]
+            else:
+                del ranges[number]
+        if not ranges:
+            self.peers.pop(peer_id, None)
+        entries = self.active_index.get(peer_id)
+        if entries:
+            kept = [entry for entry in entries if self._kept(peer_id, *entry[:2])]
+            for _, message_id, _ in set(entries) - set(kept):
+                self.active_ids.pop(message_id, None)
+            if kept:
+                self.active_index[peer_id] = kept
+            else:
+                del self.active_index[peer_id]
+
+    def _kept(self, peer_id: str, timestamp: str, message_id: int) -> bool:
+        if message_id <= max(self.cleared_all, self.cleared.get(peer_id, 0)):
+            return False
+        trimmed = self.trimmed.get(peer_id)
+        return trimmed is None or message_id > trimmed[1] or (timestamp, message_id) > trimmed[0]
+
+    def _live(self, record: dict) -> bool:
+        return self._kept(record['peer_id'], record['timestamp'], record['id'])
+
+    def _seal(self):
+        """Close the active segment, index it and record it in the checkpoint"""
+        number = self.active_number
+        os.fsync(self.active_fd)
+        os.close(self.active_fd)
+        self.active_fd = None
+        write_json(self._file(number, 'idx'), self.active_index)
+        ids = sorted(self.active_ids)
+        self.segments[number] = {
+            'first_id': ids[0] if ids else 0,
+            'last_id': ids[-1] if ids else 0,
+            'records': self.active_records,
+            'live': len(ids),
+            'size': self.active_size
+        }
+        for peer_id, entries in self.active_index.items():
+            self.peers.setdefault(peer_id, {})[number] = [entries[0][:2], entries[-1][:2], len(entries)]
+        self._cache_index(number, self.active_index)
+        self.active_number = None
+        self._save_checkpoint()
+
+    def _write(self, records: List[dict]):
+        """Append records, rolling to a new segment whenever the active one is full"""
+        buffer = bytearray()
+        placed = []
+        for record in records:
+            data = self._encode(record)
+            written = self.active_size + len(buffer)
+            if written and written + len(data) > self.segment_bytes:
+                self._commit(buffer, placed)
+                buffer, placed = bytearray(), []
+                number = self.active_number
+                self._seal()
+                self._open_active(number + 1)
+                written = 0
+            placed.append((written, record))
+            buffer += data
+        self._commit(buffer, placed)
+
+    def _commit(self, buffer: bytearray, placed: list):
+        view = memoryview(buffer)
+        while view:
+            view = view[os.write(self.active_fd, view):]
+        self.active_size += len(buffer)
+        for offset, record in placed:
+            self._apply(offset, record)
+
+    # -- sealed segment indexes ----------------------------------------------
+
+    def _cache_index(self, number: int, peers: Dict[str, list]) -> dict:
+        index = {
+            'peers': peers,
+            'ids': sorted((entry[1], entry[2]) for entries in peers.values() for entry in entries)
+        }
+        self.indexes[number] = index
+        while len(self.indexes) > self.cached_indexes:
+            self.indexes.popitem(last=False)
+        return index
+
+    def _index(self, number: int) -> dict:
+        index = self.indexes.get(number)
+        if index is not None:
+            self.indexes.move_to_end(number)
+            return index
+        path = self._file(number, 'idx')
+        if os.path.exists(path):
+            with open(path) as f:
+                peers = {peer_id: [tuple(entry) for entry in entries] for peer_id, entries in json.load(f).items()}
+        else:
+            # Lost during compaction; the segment itself has everything needed
+            peers = {}
+            for offset, record in self._scan(number)[0]:
+                if 'tombstone' not in record and self._live(record):
+                    peers.setdefault(record['peer_id'], []).append((record['timestamp'], record['id'], offset))
+            for entries in peers.values():
+                entries.sort()
+            write_json(path, peers)
+        return self._cache_index(number, peers)
+
+    def _entries(self, number: int, peer_id: str) -> list:
+        if number == self.active_number:
+            return self.active_index.get(peer_id, [])
+        return self._index(number)['peers'].get(peer_id, [])
+
+    def _ids(self, number: int) -> list:
+        if number == self.active_number:
+            return sorted(self.active_ids.items())
+        return self._index(number)['ids']
+
+    def _ranges(self, peer_id: str) -> list:
+        """(segment, first key, last key) of every segment holding a peer's messages, oldest first"""
+        ranges = [(number, first, last) for number, (first, last, _) in sorted(self.peers.get(peer_id, {}).items())]
+        entries = self.active_index.get(peer_id)
+        if entries:
+            ranges.append((self.active_number, entries[0][:2], entries[-1][:2]))
+        return ranges
+
+    def _drop_segment(self, number: int):
+        self._unmap(number)
+        self.indexes.pop(number, None)
+        self.segments.pop(number, None)
+        for peer_id in list(self.peers):
+            self.peers[peer_id].pop(number, None)
+            if not self.peers[peer_id]:
+                del self.peers[peer_id]
+
+    # -- MessageStore --------------------------------------------------------
+
+    def _record(self, message: dict, message_id: int) -> dict:
+        return {
+            'id': message_id,
+            'peer_id': message['peer_id'],
+            'sender': message['sender'],
+            'message': message['message'],
+            'status': message.get('status', 'success'),
+            'timestamp': message['timestamp'],
+            'auto_reply': bool(message.get('auto_reply'))
+        }
+
+    def append(self, message: dict) -> dict:
+        message_id = self.last_id + 1
+        self._write([self._record(message, message_id)])
+        return {'id': message_id, **message}
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        records = []
+        last_id = self.last_id
+        for message in messages:
+            last_id = message.get('id') or last_id + 1
+            records.append(self._record(message, last_id))
+        self._write(records)
+        return len(records)
+
+    def history(self, peer_id: str) -> List[dict]:
+        count = self.count(peer_id)
+        return self.page(peer_id, limit=count) if count else []
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        upper, lower = self.position(before), self.position(after)
+        if (before is not None and upper is None) or (after is not None and lower is None):
+            return []
+        newest_first = after is None
+        trimmed = self.trimmed.get(peer_id)
+        ranges = self._ranges(peer_id)
+        if newest_first:
+            ranges.reverse()
+        selected = []
+        for number, first, last in ranges:
+            if (upper is not None and first >= upper) or (lower is not None and last <= lower):
+                continue
+            # Once the page is full, only segments reaching past its far end can change it.
+            # Segments of one peer normally cover disjoint ranges, so this ends the walk.
+            if len(selected) >= limit and (last < selected[0][0][:2] if newest_first else first > selected[-1][0][:2]):
+                continue
+            entries = self._entries(number, peer_id)
+            # A sealed index still lists what a later trim removed, all of it before `first`
+            start = bisect.bisect_left(entries, first, key=lambda entry: entry[:2])
+            if lower is not None:
+                start = max(start, bisect.bisect_right(entries, lower, key=lambda entry: entry[:2]))
+            end = len(entries) if upper is None else bisect.bisect_left(entries, upper, key=lambda entry: entry[:2])
+            if trimmed is not None and first <= trimmed[0]:
+                # Trimmed and kept messages interleave in this segment
+                matches = [entry for entry in entries[start:end] if self._kept(peer_id, *entry[:2])]
+                matches = matches[-limit:] if newest_first else matches[:limit]
+            else:
+                matches = entries[max(start, end - limit):end] if newest_first else entries[start:min(end, start + limit)]
+            selected.extend((entry, number) for entry in matches)
+            selected.sort()
+            selected = selected[-limit:] if newest_first else selected[:limit]
+        return [self._read(number, offset) for (_, _, offset), number in selected]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        messages = []
+        numbers = [number for number, meta in sorted(self.segments.items()) if meta['last_id'] > message_id]
+        for number in numbers + [self.active_number]:
+            ids = self._ids(number)
+            for _, offset in ids[bisect.bisect_right(ids, message_id, key=lambda item: item[0]):]:
+                record = self._read(number, offset)
+                if self._live(record):
+                    messages.append(record)
+                    if len(messages) >= limit:
+                        return messages
+        return messages
+
+    def get(self, message_id: int) -> Optional[dict]:
+        offset = self.active_ids.get(message_id)
+        if offset is not None:
+            return self._read(self.active_number, offset)
+        for number, meta in self.segments.items():
+            if meta['first_id'] <= message_id <= meta['last_id']:
+                ids = self._index(number)['ids']
+                position = bisect.bisect_left(ids, message_id, key=lambda item: item[0])
+                if position < len(ids) and ids[position][0] == message_id:
+                    record = self._read(number, ids[position][1])
+                    return record if self._live(record) else None
+        return None
+
+    def max_id(self) -> int:
+        return self.last_id
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is not None:
+            sealed = sum(count for _, _, count in self.peers.get(peer_id, {}).values())
+            return sealed + len(self.active_index.get(peer_id, []))
+        sealed = sum(count for ranges in self.peers.values() for _, _, count in ranges.values())
+        return sealed + len(self.active_ids)
+
+    def peer_ids(self) -> List[str]:
+        return sorted(set(self.peers) | {peer_id for peer_id, entries in self.active_index.items() if entries})
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        self._write([{'tombstone': 'trim', 'peer_id': peer_id, 'upto': list(upto), 'last_id': self.last_id}])
+
+    def clear(self, peer_id: str):
+        self._write([{'tombstone': 'clear', 'peer_id': peer_id, 'upto': self.last_id}])
+
+    def clear_all(self):
+        self._write([{'tombstone': 'clear', 'peer_id': None, 'upto': self.last_id}])
+
+    def compact(self, max_dead_ratio: float = 0.5) -> int:
+        """Reclaim one sealed segment whose share of cleared messages exceeds the ratio; returns bytes freed"""
+        for number, meta in sorted(self.segments.items()):
+            if meta['live'] > 0 and meta['records'] - meta['live'] <= meta['records'] * max_dead_ratio:
+                continue
+            if meta['live'] <= 0:
+                self._drop_segment(number)
+                for extension in ('log', 'idx'):
+                    if os.path.exists(self._file(number, extension)):
+                        os.remove(self._file(number, extension))
+                self._save_checkpoint()
+                logger.info(f"Deleted log segment {number} ({meta['size']} bytes, nothing live)")
+                return meta['size']
+
+            index = self._index(number)
+            data = self._map(number)
+            compacted = bytearray()
+            peers = {}
+            for peer_id, entries in index['peers'].items():
+                if peer_id not in self.peers:
+                    continue
+                for timestamp, message_id, offset in entries:
+                    if not self._kept(peer_id, timestamp, message_id):
+                        continue
+                    length, _ = self.HEADER.unpack_from(data, offset)
+                    peers.setdefault(peer_id, []).append((timestamp, message_id, len(compacted)))
+                    compacted += data[offset:offset + self.HEADER.size + length]
+            path = self._file(number, 'log')
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(compacted)
+                f.flush()
+                os.fsync(f.fileno())
+            # Without an .idx the segment is rescanned on next use, so no crash
+            # point pairs the new log with the old offsets
+            freed = len(data) - len(compacted)
+            if os.path.exists(self._file(number, 'idx')):
+                os.remove(self._file(number, 'idx'))
+            self._unmap(number)
+            os.replace(f"{path}.tmp", path)
+            write_json(self._file(number, 'idx'), peers)
+            self._cache_index(number, peers)
+            meta.update(records=meta['live'], size=len(compacted))
+            self._save_checkpoint()
+            logger.info(f"Compacted log segment {number}, freed {freed} bytes")
+            return freed
+        return 0
+
+    def stats(self) -> dict:
+        records = sum(meta['records'] for meta in self.segments.values()) + self.active_records
+        live = sum(meta['live'] for meta in self.segments.values()) + len(self.active_ids)
+        return {
+            'segments': len(self.segments) + 1,
+            'bytes': sum(meta['size'] for meta in self.segments.values()) + self.active_size,
+            'records': records,
+            'dead': records - live
+        }
+
+    def close(self):
+        if self.active_fd is not None:
+            os.fsync(self.active_fd)
+            os.close(self.active_fd)
+            self.active_fd = None
+            write_json(self._file(self.active_number, 'idx'), self.active_index)
+            self.closed_active = {
+                'number': self.active_number,
+                'size': self.active_size,
+                'records': self.active_records
+            }
+            self._save_checkpoint()
+        for number in list(self.maps):
+            self._unmap(number)
+
+
+class PartitionedStore(MessageStore):
+    """SQLite with one table per conversation.
+
+    Clearing a chat drops its table, so it costs the same however much else
+    is stored, and paging or exporting a conversation reads only its table.
+    All tables live in one database file per generation. Clearing every chat
+    starts the next generation's empty file and deletes the old one, which
+    does not depend on the size of the history either.
+
+    Message ids are global and assigned here. `current.json` names the live
+    generation and the last id handed out before it began. Each generation's
+    `meta` table keeps the last id past dropped tables.
+    """
+
+    POINTER = 'current.json'
+    # Tables hold every message field but peer_id, which the table stands for
+    SELECT_COLUMNS = 'id, sender, message, status, timestamp, auto_reply'
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.generation = 1
+        self.last_id = 0
+        pointer = os.path.join(path, self.POINTER)
+        if os.path.exists(pointer):
+            with open(pointer) as f:
+                current = json.load(f)
+            self.generation = current['generation']
+            self.last_id = current['last_id']
+        # A clear_all interrupted before its old file was deleted leaves it behind
+        for name in os.listdir(path):
+            stem = name.split('.')[0]
+            if stem.isdigit() and int(stem) != self.generation:
+                os.remove(os.path.join(path, name))
+        self._open()
+
+    def _file(self, generation: int) -> str:
+        return os.path.join(self.path, f"{generation:08d}.db")
+
+    def _open(self):
+        self.db = sqlite3.connect(self._file(self.generation), isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (number INTEGER PRIMARY KEY, peer_id TEXT NOT NULL UNIQUE)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_id'").fetchone()
+        self.last_id = max(self.last_id, row[0] if row else 0)
+        self._load()
+
+    def _load(self):
+        """Read the conversation tables and the id range each one holds"""
+        self.tables: Dict[str, str] = {
+            peer_id: f"c{number}" for number, peer_id in self.db.execute("SELECT number, peer_id FROM conversations")
+        }
+        self.ranges: Dict[str, Tuple[int, int]] = {}
+        for peer_id in self.tables:
+            self._update_range(peer_id)
+
+    def _update_range(self, peer_id: str):
+        first, last = self.db.execute(f"SELECT MIN(id), MAX(id) FROM {self.tables[peer_id]}").fetchone()
+        if first is None:
+            self.ranges.pop(peer_id, None)
+        else:
+            self.ranges[peer_id] = (first, last)
+
+    def _table(self, peer_id: str) -> str:
+        """The peer's table, created on first use"""
+        table = self.tables.get(peer_id)
+        if table is None:
+            number = self.db.execute("INSERT INTO conversations (peer_id) VALUES (?)", (peer_id,)).lastrowid
+            table = self.tables[peer_id] = f"c{number}"
+            self.db.execute(f"""
+                CREATE TABLE {table} (
+                    id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    auto_reply INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self.db.execute(f"CREATE INDEX {table}_timestamp ON {table} (timestamp)")
+        return table
+
+    @staticmethod
+    def _row(peer_id: str, row: tuple) -> dict:
+        return {
+            'id': row[0],
+            'peer_id': peer_id,
+            'sender': row[1],
+            'message': row[2],
+            'status': row[3],
+            'timestamp': row[4],
+            'auto_reply': bool(row[5])
+        }
+
+    def append(self, message: dict) -> dict:
+        stored = {'id': self.last_id + 1, **message}
+        self.insert_many([stored])
+        return stored
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        batches: Dict[str, list] = {}
+        last_id = self.last_id
+        for message in messages:
+            message_id = message.get('id') or last_id + 1
+            last_id = max(last_id, message_id)
+            batches.setdefault(message['peer_id'], []).append((
+                message_id,
+                message['sender'],
+                message['message'],
+                message.get('status', 'success'),
+                message['timestamp'],
+                int(bool(message.get('auto_reply')))
+            ))
+        try:
+            with self.db:
+                self.db.execute("BEGIN")
+                for peer_id, rows in batches.items():
+                    self.db.executemany(f"INSERT INTO {self._table(peer_id)} VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_id', ?)", (last_id,))
+        except Exception:
+            # Tables created inside the rolled back transaction are gone again
+            self._load()
+            raise
+        self.last_id = last_id
+        for peer_id, rows in batches.items():
+            first = min(row[0] for row in rows)
+            last = max(row[0] for row in rows)
+            known = self.ranges.get(peer_id)
+            self.ranges[peer_id] = (min(first, known[0]), max(last, known[1])) if known else (first, last)
+        return sum(len(rows) for rows in batches.values())
+
+    def history(self, peer_id: str) -> List[dict]:
+        table = self.tables.get(peer_id)
+        if table is None:
+            return []
+        rows = self.db.execute(f"SELECT {self.SELECT_COLUMNS} FROM {table} ORDER BY timestamp, id")
+        return [self._row(peer_id, row) for row in rows]
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        table = self.tables.get(peer_id)
+        if table is None:
+            return []
+        conditions = []
+        params: list = []
+        for cursor, operator in ((before, '<'), (after, '>')):
+            if cursor is None:
+                continue
+            if isinstance(cursor, int):
+                # Look in this conversation's table first; an id from another
+                # conversation still sorts at its own (timestamp, id)
+                row = self.db.execute(f"SELECT timestamp FROM {table} WHERE id = ?", (cursor,)).fetchone()
+                position = (row[0], cursor) if row else self.position(cursor)
+            else:
+                position = self.position(cursor)
+            if position is None:
+                return []
+            conditions.append(f"(timestamp, id) {operator} (?, ?)")
+            params.extend(position)
+        newest_first = after is None
+        order = "DESC" if newest_first else "ASC"
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self.db.execute(
+            f"SELECT {self.SELECT_COLUMNS} FROM {table} {where}ORDER BY timestamp {order}, id {order} LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+        if newest_first:
+            rows.reverse()
+        return [self._row(peer_id, row) for row in rows]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        # Ids are spread over every table, so read a window of ids from each
+        # table that overlaps it, widening the window past gaps left by clears
+        window = limit
+        while True:
+            upto = message_id + window
+            messages = []
+            for peer_id, (first, last) in self.ranges.items():
+                if last > message_id and first <= upto:
+                    rows = self.db.execute(
+                        f"SELECT {self.SELECT_COLUMNS} FROM {self.tables[peer_id]} WHERE id > ? AND id <= ?",
+                        (message_id, upto)
+                    )
+                    messages.extend(self._row(peer_id, row) for row in rows)
+            if len(messages) >= limit or upto >= self.last_id:
+                break
+            window *= 4
+        messages.sort(key=lambda message: message['id'])
+        return messages[:limit]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        for peer_id, (first, last) in self.ranges.items():
+            if first <= message_id <= last:
+                row = self.db.execute(
+                    f"SELECT {self.SELECT_COLUMNS} FROM {self.tables[peer_id]} WHERE id = ?", (message_id,)
+                ).fetchone()
+                if row:
+                    return self._row(peer_id, row)
+        return None
+
+    def max_id(self) -> int:
+        return self.last_id
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is None:
+            return sum(self.count(peer) for peer in self.ranges)
+        if peer_id not in self.ranges:
+            return 0
+        return self.db.execute(f"SELECT COUNT(*) FROM {self.tables[peer_id]}").fetchone()[0]
+
+    def peer_ids(self) -> List[str]:
+        return list(self.ranges)
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        table = self.tables.get(peer_id)
+        if table is not None:
+            self.db.execute(f"DELETE FROM {table} WHERE (timestamp, id) <= (?, ?)", tuple(upto))
+            self._update_range(peer_id)
+
+    def clear(self, peer_id: str):
+        table = self.tables.get(peer_id)
+        if table is None:
+            return
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(f"DROP TABLE {table}")
+            self.db.execute("DELETE FROM conversations WHERE peer_id = ?", (peer_id,))
+        del self.tables[peer_id]
+        self.ranges.pop(peer_id, None)
+
+    def clear_all(self):
+        self.db.close()
+        old = self._file(self.generation)
+        self.generation += 1
+        # Once the pointer names the new generation, the old file is garbage
+        write_json(os.path.join(self.path, self.POINTER), {'generation': self.generation, 'last_id': self.last_id})
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(old + suffix):
+                os.remove(old + suffix)
+        self._open()
+
+    def stats(self) -> dict:
+        return {
+            'generation': self.generation,
+            'conversations': len(self.ranges),
+            'bytes': sum(
+                os.path.getsize(self._file(self.generation) + suffix)
+                for suffix in ('', '-wal') if os.path.exists(self._file(self.generation) + suffix)
+            )
+        }
+
+    def close(self):
+        self.db.close()
+
+
+class JournalUnavailable(Exception):
+    """Raised when the write journal cannot take or commit messages because the backend keeps failing"""
+
+
+class WriteBehindStore(MessageStore):
+    """Group-commit journal in front of another store.
+
+    append() assigns the next id, keeps the message in memory and returns
+    without touching disk. A background task commits everything pending in
+    one transaction once `batch_size` messages are waiting or `flush_interval`
+    seconds after the first one arrived. Reads merge the pending messages
+    with the backend's, so callers see their writes at once.
+
+    Crash loss is bounded by the flush trigger: at most `flush_interval`
+    seconds (or `batch_size` messages) of appends that have not been
+    committed. Callers that cannot lose a message await committed().
+
+    A failed commit is retried with the messages kept pending. After
+    `max_attempts` failures in a row, committed() raises JournalUnavailable
+    instead of waiting, and once `max_pending` messages are waiting,
+    append() raises it too, so a backend that stays broken cannot make
+    memory grow or callers hang without limit.
+    """
+
+    def __init__(self, backend: MessageStore, batch_size: int = 100, flush_interval: float = 0.05, min_id: int = 0,
+                 max_pending: int = 10000, max_attempts: int = 5):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        # Failed commits since the last successful one, and the last error
+        self.failures = 0
+        self.error: Optional[Exception] = None
+        self.pending: OrderedDict = OrderedDict()
+        self.appended_at: Dict[int, float] = {}
+        # `min_id` keeps ids unique against messages stored elsewhere, e.g. archived
+        self.next_id = max(backend.max_id(), min_id) + 1
+        self.committed_id = self.next_id - 1
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.has_pending: Optional[asyncio.Event] = None
+        self.batch_full: Optional[asyncio.Event] = None
+        self.counters = {
+            'appended': 0,
+            'batches': 0,
+            'committed': 0,
+            'errors': 0,
+            'max_batch_size': 0,
+            'commit_ms_total': 0.0,
+            'commit_ms_last': None,
+            'delay_ms_max': 0.0
+        }
+
+    def start(self):
+        """Start the background committer; call from the running event loop"""
+        self.has_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        if self.pending:
+            self.has_pending.set()
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self.has_pending.wait()
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self.flush():
+                # Leave the batch pending and try again after another interval
+                await asyncio.sleep(self.flush_interval)
+
+    def flush(self) -> bool:
+        """Commit every pending message in one batch; False if the backend failed"""
+        if self.has_pending:
+            self.has_pending.clear()
+            self.batch_full.clear()
+        if not self.pending:
+            return True
+        batch = list(self.pending.values())
+        started = time.perf_counter()
+        try:
+            self.backend.insert_many(batch)
+        except Exception as e:
+            self.counters['errors'] += 1
+            self.failures += 1
+            self.error = e
+            logger.error(f"Failed to commit {len(batch)} messages (attempt {self.failures}): {e}")
+            if self.failures >= self.max_attempts:
+                self._fail_waiters()
+            if self.has_pending:
+                self.has_pending.set()
+            return False
+        self.failures = 0
+        self.error = None
+        commit_ms = (time.perf_counter() - started) * 1000
+        now = time.monotonic()
+
+        for message in batch:
+            del self.pending[message['id']]
+            appended_at = self.appended_at.pop(message['id'])
+            self.counters['delay_ms_max'] = max(self.counters['delay_ms_max'], (now - appended_at) * 1000)
+        self.committed_id = batch[-1]['id']
+        self.counters['batches'] += 1
+        self.counters['committed'] += len(batch)
+        self.counters['max_batch_size'] = max(self.counters['max_batch_size'], len(batch))
+        self.counters['commit_ms_total'] += commit_ms
+        self.counters['commit_ms_last'] = round(commit_ms, 2)
+        self._release(lambda message_id: message_id <= self.committed_id)
+        return True
+
+    def _release(self, done):
+        for message_id in [message_id for message_id in self.waiters if done(message_id)]:
+            future = self.waiters.pop(message_id)
+            if not future.done():
+                future.set_result(None)
+
+    def _unavailable(self) -> JournalUnavailable:
+        return JournalUnavailable(f"Chat history cannot be written after {self.failures} attempts: {self.error}")
+
+    def _fail_waiters(self):
+        """Tell everyone waiting for a commit that it keeps failing; their messages stay pending"""
+        waiters, self.waiters = self.waiters, {}
+        for future in waiters.values():
+            if not future.done():
+                future.set_exception(self._unavailable())
+
+    async def committed(self, message_id: int):
+        """Wait until a message has been written to the backend (or removed by a clear).
+
+        Raises JournalUnavailable if commits have failed `max_attempts` times in a row.
+        """
+        if message_id not in self.pending:
+            return
+        if self.failures >= self.max_attempts:
+            raise self._unavailable()
+        future = self.waiters.get(message_id)
+        if future is None:
+            future = self.waiters[message_id] = asyncio.get_running_loop().create_future()
+        await future
+
+    def append(self, message: dict) -> dict:
+        if len(self.pending) >= self.max_pending:
+            raise JournalUnavailable(
+                f"{len(self.pending)} messages are waiting to be written"
+                + (f"; last error: {self.error}" if self.error else "")
+            )
+        stored = {'id': self.next_id, **message}
+        self.next_id += 1
+        self.pending[stored['id']] = stored
+        self.appended_at[stored['id']] = time.monotonic()
+        self.counters['appended'] += 1
+        if self.has_pending:
+            self.has_pending.set()
+            if len(self.pending) >= self.batch_size:
+                self.batch_full.set()
+        return stored
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        self.flush()
+        count = self.backend.insert_many(messages)
+        self.next_id = max(self.next_id, self.backend.max_id() + 1)
+        return count
+
+    def _pending_for(self, peer_id: str) -> List[dict]:
+        return [message for message in self.pending.values() if message['peer_id'] == peer_id]
+
+    def history(self, peer_id: str) -> List[dict]:
+        messages = self.backend.history(peer_id) + self._pending_for(peer_id)
+        messages.sort(key=lambda x: (x['timestamp'], x['id']))
+        return messages
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        # Resolve cursors here, since they may name messages the backend has not seen yet
+        bounds = [self.position(before), self.position(after)]
+        if (before is not None and bounds[0] is None) or (after is not None and bounds[1] is None):
+            return []
+        messages = self.backend.page(peer_id, before=bounds[0], after=bounds[1], limit=limit)
+        messages += [
+            message for message in self._pending_for(peer_id)
+            if (bounds[0] is None or (message['timestamp'], message['id']) < bounds[0])
+            and (bounds[1] is None or (message['timestamp'], message['id']) > bounds[1])
+        ]
+        messages.sort(key=lambda x: (x['timestamp'], x['id']))
+        return messages[:limit] if after is not None else messages[-limit:]
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        messages = self.backend.since(message_id, limit)
+        messages += [message for message in self.pending.values() if message['id'] > message_id]
+        return messages[:limit]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        return self.pending.get(message_id) or self.backend.get(message_id)
+
+    def max_id(self) -> int:
+        return self.next_id - 1
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        if peer_id is None:
+            return self.backend.count() + len(self.pending)
+        return self.backend.count(peer_id) + len(self._pending_for(peer_id))
+
+    def peer_ids(self) -> List[str]:
+        return sorted(set(self.backend.peer_ids()) | {message['peer_id'] for message in self.pending.values()})
+
+    def _discard(self, messages: List[dict]):
+        """Drop pending messages that will never be committed, releasing their waiters"""
+        removed = {message['id'] for message in messages}
+        for message_id in removed:
+            del self.pending[message_id]
+            self.appended_at.pop(message_id, None)
+        self._release(lambda message_id: message_id in removed)
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        self._discard([message for message in self._pending_for(peer_id) if sort_key(message) <= upto])
+        self.backend.trim(peer_id, upto)
+
+    def clear(self, peer_id: str):
+        self._discard(self._pending_for(peer_id))
+        self.backend.clear(peer_id)
+
+    def clear_all(self):
+        self.pending.clear()
+        self.appended_at.clear()
+        self._release(lambda message_id: True)
+        self.backend.clear_all()
+
+    def stats(self) -> dict:
+        batches = self.counters['batches']
+        counters = {key: value for key, value in self.counters.items() if key != 'commit_ms_total'}
+        return {
+            **counters,
+            'delay_ms_max': round(self.counters['delay_ms_max'], 1),
+            'pending': len(self.pending),
+            'max_pending': self.max_pending,
+            'failing_attempts': self.failures,
+            'batch_size': self.batch_size,
+            'flush_interval_ms': self.flush_interval * 1000,
+            'avg_batch_size': round(self.counters['committed'] / batches, 1) if batches else None,
+            'commit_ms_avg': round(self.counters['commit_ms_total'] / batches, 2) if batches else None
+        }
+
+    async def aclose(self):
+        """Stop the committer and write out whatever is still pending"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+
+def sort_key(message: dict) -> Tuple[str, int]:
+    return (message['timestamp'], message['id'])
+
+
+class RecentMessagesCache(MessageStore):
+    """Keeps the newest messages of each conversation in memory in front of another store.
+
+    Each peer gets a sorted buffer of at most `per_peer` messages holding the
+    tail of that conversation; `complete` marks buffers that hold the whole
+    conversation. History pages that fall inside a buffer are served from
+    memory. The total held across peers is capped at `budget` messages by
+    dropping the least recently used conversations.
+    """
+
+    def __init__(self, backend: MessageStore, per_peer: int = 200, budget: int = 10000):
+        self.backend = backend
+        self.per_peer = per_peer
+        self.budget = budget
+        self.buffers: OrderedDict = OrderedDict()
+        self.complete: Dict[str, bool] = {}
+        self.size = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def warm(self):
+        """Fill buffers for stored conversations until the budget is used"""
+        for peer_id in self.backend.peer_ids():
+            if self.size + self.per_peer > self.budget:
+                break
+            self._fill(peer_id)
+        logger.info(f"Cached {self.size} recent messages for {len(self.buffers)} conversations")
+
+    def _fill(self, peer_id: str) -> list:
+        messages = self.backend.page(peer_id, limit=self.per_peer)
+        self._drop(peer_id)
+        self.buffers[peer_id] = messages
+        self.complete[peer_id] = len(messages) < self.per_peer
+        self.size += len(messages)
+        self._enforce_budget(keep=peer_id)
+        return messages
+
+    def _drop(self, peer_id: str):
+        buffer = self.buffers.pop(peer_id, None)
+        self.complete.pop(peer_id, None)
+        if buffer is not None:
+            self.size -= len(buffer)
+
+    def _enforce_budget(self, keep: str):
+        while self.size > self.budget and len(self.buffers) > 1:
+            oldest = next(iter(self.buffers))
+            if oldest == keep:
+                self.buffers.move_to_end(keep)
+                continue
+            self._drop(oldest)
+            self.counters['evictions'] += 1
+
+    def append(self, message: dict) -> dict:
+        stored = self.backend.append(message)
+        buffer = self.buffers.get(stored['peer_id'])
+        if buffer is not None:
+            key = sort_key(stored)
+            # Anything older than a full buffer's first message is outside the tail it holds
+            if len(buffer) < self.per_peer or key > sort_key(buffer[0]):
+                bisect.insort(buffer, stored, key=sort_key)
+                self.size += 1
+                if len(buffer) > self.per_peer:
+                    buffer.pop(0)
+                    self.size -= 1
+                    self.complete[stored['peer_id']] = False
+                self._enforce_budget(keep=stored['peer_id'])
+        return stored
+
+    def insert_many(self, messages: Iterable[dict]) -> int:
+        count = self.backend.insert_many(messages)
+        self.buffers.clear()
+        self.complete.clear()
+        self.size = 0
+        return count
+
+    def get(self, message_id: int) -> Optional[dict]:
+        for buffer in self.buffers.values():
+            if buffer and buffer[0]['id'] <= message_id <= buffer[-1]['id']:
+                for message in buffer:
+                    if message['id'] == message_id:
+                        return message
+        return self.backend.get(message_id)
+
+    def _from_buffer(self, peer_id: str, before, after, limit: int) -> Optional[List[dict]]:
+        """Serve a page from a peer's buffer, or None if it may reach past the buffer"""
+        buffer = self.buffers.get(peer_id)
+        if buffer is None:
+            return None
+        complete = self.complete[peer_id]
+        start = 0
+        if after is not None:
+            if not complete and (not buffer or after < sort_key(buffer[0])):
+                return None
+            start = bisect.bisect_right(buffer, after, key=sort_key)
+        end = len(buffer) if before is None else bisect.bisect_left(buffer, before, key=sort_key)
+        end = max(start, end)
+        if after is not None:
+            return buffer[start:min(end, start + limit)]
+        if end - start >= limit:
+            return buffer[end - limit:end]
+        return buffer[start:end] if complete else None
+
+    def page(self, peer_id: str, before: Cursor = None, after: Cursor = None, limit: int = 50) -> List[dict]:
+        bounds = [self.position(before), self.position(after)]
+        if (before is not None and bounds[0] is None) or (after is not None and bounds[1] is None):
+            return []
+        if peer_id not in self.buffers and before is None and after is None and limit <= self.per_peer:
+            # Opening a conversation: load its tail once and answer from it
+            self._fill(peer_id)
+        page = self._from_buffer(peer_id, bounds[0], bounds[1], limit)
+        if page is not None:
+            self.counters['hits'] += 1
+            self.buffers.move_to_end(peer_id)
+            return list(page)
+        self.counters['misses'] += 1
+        return self.backend.page(peer_id, before=bounds[0], after=bounds[1], limit=limit)
+
+    def history(self, peer_id: str) -> List[dict]:
+        return self.backend.history(peer_id)
+
+    def since(self, message_id: int, limit: int) -> List[dict]:
+        return self.backend.since(message_id, limit)
+
+    def max_id(self) -> int:
+        return self.backend.max_id()
+
+    def count(self, peer_id: Optional[str] = None) -> int:
+        return self.backend.count(peer_id)
+
+    def peer_ids(self) -> List[str]:
+        return self.backend.peer_ids()
+
+    def trim(self, peer_id: str, upto: Tuple[str, int]):
+        self.backend.trim(peer_id, upto)
+        self._drop(peer_id)
+
+    def clear(self, peer_id: str):
+        self.backend.clear(peer_id)
+        self._drop(peer_id)
+        self.buffers[peer_id] = []
+        self.complete[peer_id] = True
+
+    def clear_all(self):
+        self.backend.clear_all()
+        self.buffers.clear()
+        self.complete.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {
+            **self.counters,
+            'hit_rate': round(self.counters['hits'] / lookups, 3) if lookups else None,
+            'conversations': len(self.buffers),
+            'messages': self.size,
+            'per_peer': self.per_peer,
+            'budget': self.budget
+        }
+
+    def close(self):
+        self.backend.close()
+
+
+def migrate_tinydb(json_path: str, store: MessageStore) -> int:
+    """One-time import of a TinyDB chat history into an empty store.
+
+    The JSON file is renamed to `<name>.migrated` afterwards so it is not
+    imported twice. Returns the number of messages imported.
+    """
+    if not os.path.exists(json_path) or store.count():
+        return 0
+    from tinydb import TinyDB
+    legacy = TinyDB(json_path)
+    try:
+        documents = sorted(legacy.table('messages').all(), key=lambda doc: doc.doc_id)
+    finally:
+        legacy.close()
+    imported = store.insert_many(
+        {field: doc.get(field, 'success' if field == 'status' else None) for field in MESSAGE_FIELDS}
+        for doc in documents
+        if doc.get('peer_id') and doc.get('sender') and doc.get('message') and doc.get('timestamp')
+    )
+    os.replace(json_path, f"{json_path}.migrated")
+    logger.info(f"Migrated {imported} messages from {json_path}")
+    return imported
+
+
+def migrate_sqlite(db_path: str, store: MessageStore, chunk: int = 10000) -> int:
+    """One-time import of a single-table SQLite chat history into an empty store.
+
+    Message ids are kept. The database is renamed to `<name>.migrated`
+    afterwards. Returns the number of messages imported.
+    """
+    if not os.path.exists(db_path) or store.count():
+        return 0
+    legacy = SQLiteStore(db_path)
+    imported = 0
+    try:
+        last_id = 0
+        while True:
+            messages = legacy.since(last_id, chunk)
+            if not messages:
+                break
+            imported += store.insert_many(messages)
+            last_id = messages[-1]['id']
+    finally:
+        legacy.close()
+    os.replace(db_path, f"{db_path}.migrated")
+    logger.info(f"Migrated {imported} messages from {db_path}")
+    return imported
+
+
+def open_store(backend: str, instance_name: str) -> MessageStore:
+    """Open the chat history for an instance with the named backend (`partitioned`, `sqlite`, `log` or `tinydb`)"""
+    json_path = f'chat_history_{instance_name}.json'
+    if backend == 'tinydb':
+        return TinyDBStore(json_path)
+    if backend in ('partitioned', 'sqlite', 'log'):
+        if backend == 'partitioned':
+            store = PartitionedStore(f'chat_partitions_{instance_name}')
+            migrate_sqlite(f'chat_history_{instance_name}.db', store)
+        elif backend == 'sqlite':
+            store = SQLiteStore(f'chat_history_{instance_name}.db')
+        else:
+            store = LogStore(f'chat_log_{instance_name}')
+        migrate_tinydb(json_path, store)
+        return store
+    raise ValueError(f"Unknown message store backend: {backend}")
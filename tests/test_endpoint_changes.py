@@ -0,0 +1,220 @@
+"""Endpoint diffs from the controller must rebuild the controller's endpoint set on the proxy.
+
+Diffs are made by controller.diff_endpoints and applied by the proxy's own
+apply_changes, so both ends are tested together. The watch tests drive
+/api/watchendpoints through Quart's test client.
+"""
+import asyncio
+import copy
+import json
+import random
+
+import pytest
+
+import controller
+import proxy
+from controller import ChangeLog, diff_endpoints, merge_patch
+
+
+def random_value(rng, depth):
+    kind = rng.random()
+    if depth < 3 and kind < 0.35:
+        return random_config(rng, depth + 1)
+    if kind < 0.45:
+        return None
+    if kind < 0.55:
+        return [rng.randint(0, 3) for _ in range(rng.randint(0, 2))]
+    return rng.choice([0, 1, 'a', 'b', True, 2.5])
+
+
+def random_config(rng, depth=0):
+    return {key: random_value(rng, depth) for key in rng.sample('abcdef', rng.randint(0, 4))}
+
+
+def mutate(rng, config, depth=0):
+    config = copy.deepcopy(config)
+    for key in rng.sample('abcdef', rng.randint(1, 3)):
+        if key in config and rng.random() < 0.3:
+            del config[key]
+        elif isinstance(config.get(key), dict) and depth < 3 and rng.random() < 0.6:
+            config[key] = mutate(rng, config[key], depth + 1)
+        else:
+            config[key] = random_value(rng, depth)
+    return config
+
+
+def random_endpoints(rng, previous=None):
+    names = ['BOT', 'GPT', 'Claude', 'alice', 'bob']
+    endpoints = {}
+    for name in rng.sample(names, rng.randint(1, len(names))):
+        if previous and name in previous and rng.random() < 0.7:
+            endpoints[name] = mutate(rng, previous[name]) if rng.random() < 0.6 else copy.deepcopy(previous[name])
+        else:
+            endpoints[name] = {'host': f'{name.lower()}.example', 'port': rng.randint(1, 9), **random_config(rng)}
+    return endpoints
+
+
+def apply_on_proxy(endpoints, changes, revision):
+    proxy.peers.clear()
+    proxy.peers.update(copy.deepcopy(endpoints))
+    proxy.apply_changes(changes, revision)
+    return proxy.endpoint_revision, dict(proxy.peers)
+
+
+def test_merge_patch_removes_and_nests():
+    original = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': 4}
+    updated = {'a': 1, 'b': {'c': 5}, 'f': 6}
+    patch = merge_patch(original, updated)
+    assert patch == {'e': None, 'b': {'c': 5, 'd': None}, 'f': 6}
+    assert proxy.apply_merge_patch(original, patch) == updated
+    assert merge_patch(updated, updated) == {}
+
+
+def test_diff_then_patch_round_trip():
+    rng = random.Random(3)
+    endpoints = random_endpoints(rng)
+    for revision in range(1, 300):
+        target = random_endpoints(rng, endpoints)
+        change = diff_endpoints(endpoints, target)
+        assert apply_on_proxy(endpoints, [{'revision': revision, **change}], revision) == (revision, target)
+        endpoints = target
+
+
+def test_values_holding_none_are_sent_whole():
+    original = {'BOT': {'host': 'h', 'port': 1, 'model_config': {'stop': 'x'}}}
+    updated = {'BOT': {'host': 'h', 'port': 1, 'model_config': {'stop': None}}}
+    change = diff_endpoints(original, updated)
+    # A merge patch would read the null as "remove stop"
+    assert change == {'added': updated, 'removed': [], 'patched': {}}
+    assert apply_on_proxy(original, [{'revision': 2, **change}], 2)[1] == updated
+
+
+def test_change_log_replays_to_current():
+    rng = random.Random(5)
+    first = random_endpoints(rng)
+    log = ChangeLog(first, 1, size=1000)
+    sets = {1: first}
+    endpoints = first
+    for revision in range(2, 60):
+        endpoints = random_endpoints(rng, endpoints)
+        if log.record(endpoints, revision):
+            sets[revision] = copy.deepcopy(endpoints)
+    for revision, held in sets.items():
+        changes = log.since(revision)
+        assert changes is not None
+        assert apply_on_proxy(held, changes, log.revision) == (log.revision, endpoints)
+
+
+def test_change_log_ignores_unchanged_sets():
+    endpoints = {'BOT': {'host': 'h', 'port': 1}}
+    log = ChangeLog(endpoints, 4)
+    assert not log.record(copy.deepcopy(endpoints), 5)
+    assert log.revision == 4
+    assert log.since(4) == []
+
+
+def test_change_log_compaction_and_gaps():
+    log = ChangeLog({'BOT': {'port': 0}}, 10, size=3)
+    for n in range(1, 6):
+        assert log.record({'BOT': {'port': n}}, 10 + n)
+    # Only the last three changes are kept, so revisions before 12 cannot be served a diff
+    assert log.base == 12
+    assert [entry['revision'] for entry in log.since(12)] == [13, 14, 15]
+    assert log.since(11) is None
+    assert log.since(10) is None
+    # A revision newer than the log, e.g. handed out before a restart, gets a snapshot too
+    assert log.since(16) is None
+    assert log.since(15) == []
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(controller, 'REGISTRY_PATH', str(tmp_path / 'registry.db'))
+    for table in (controller.registered_proxies, controller.change_logs, controller.endpoint_bodies,
+                  controller.endpoint_watchers):
+        table.clear()
+    yield controller.app
+    for table in (controller.registered_proxies, controller.change_logs, controller.endpoint_bodies,
+                  controller.endpoint_watchers):
+        table.clear()
+
+
+def watch(client, revision, timeout=0.05):
+    return client.get('/api/watchendpoints', query_string={
+        'proxy_id': 'p1', 'revision': revision, 'timeout': timeout
+    })
+
+
+async def register(client):
+    await client.post('/api/register', json={'proxy_id': 'p1', 'instance_name': 'test', 'host': 'h', 'port': 1})
+    response = await client.get('/api/getendpoints', query_string={'proxy_id': 'p1'})
+    return await response.get_json()
+
+
+async def update(client, endpoints):
+    response = await client.post('/api/update_proxy_endpoints/p1', json={'endpoints': endpoints})
+    return (await response.get_json())['revision']
+
+
+def test_watch_times_out_with_304(app):
+    async def run():
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            snapshot = await register(client)
+            response = await watch(client, snapshot['revision'])
+            assert response.status_code == 304
+            unknown = await client.get('/api/watchendpoints', query_string={'proxy_id': 'nobody', 'timeout': 0.05})
+            assert unknown.status_code == 404
+
+    asyncio.run(run())
+
+
+def test_watch_wakes_with_the_change(app):
+    async def run():
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            snapshot = await register(client)
+            waiting = asyncio.ensure_future(watch(client, snapshot['revision'], timeout=5))
+            await asyncio.sleep(0.05)
+            assert not waiting.done()
+            revision = await update(client, {'GPT': {'host': 'api.example', 'port': 443, 'is_api': True}})
+            response = await asyncio.wait_for(waiting, 2)
+            body = await response.get_json()
+            assert body['revision'] == revision
+            assert apply_on_proxy(snapshot['endpoints'], body['changes'], body['revision']) == \
+                (revision, controller.registered_proxies['p1']['endpoints'])
+
+    asyncio.run(run())
+
+
+def test_watch_sends_a_snapshot_across_a_gap(app):
+    async def run():
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            snapshot = await register(client)
+            # Registration made a full-size log; swap in a short one so it compacts
+            controller.change_logs['p1'] = ChangeLog(snapshot['endpoints'], snapshot['revision'], size=3)
+            held = {}
+            for port in range(1, 6):
+                revision = await update(client, {'BOT': {'port': port}})
+                held[revision] = copy.deepcopy(controller.registered_proxies['p1']['endpoints'])
+            current = controller.registered_proxies['p1']
+
+            # Still in the log: a diff that rebuilds the current set
+            oldest_logged = sorted(held)[-3]
+            body = await (await watch(client, oldest_logged)).get_json()
+            assert 'changes' in body
+            assert apply_on_proxy(held[oldest_logged], body['changes'], body['revision'])[1] == current['endpoints']
+
+            # Older than the log, or no revision at all: a full snapshot with its ETag
+            for revision in (snapshot['revision'], min(held), 0):
+                response = await watch(client, revision)
+                body = json.loads(await response.get_data())
+                assert 'changes' not in body
+                assert body['endpoints'] == current['endpoints']
+                assert response.headers['ETag'] == f'"{current["revision"]}"'
+
+            # Nothing newer than the current revision to send yet
+            assert (await watch(client, current['revision'])).status_code == 304
+
+    asyncio.run(run())
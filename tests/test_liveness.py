@@ -0,0 +1,116 @@
+"""LivenessTracker must expire proxies in deadline order, and only once their latest deadline passes.
+
+The tracker reads time.monotonic, which is replaced with a clock the tests
+move by hand. Results are checked against the plain rule: a proxy expires
+when its most recent renewal plus its TTL is in the past.
+"""
+import random
+
+import pytest
+
+import liveness
+from liveness import LivenessTracker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(liveness.time, 'monotonic', clock)
+    return clock
+
+
+def test_expires_in_deadline_order(clock):
+    tracker = LivenessTracker(10, ttls={'slow': 30, 'fast': 2})
+    tracker.renew('c', 'default')
+    tracker.renew('a', 'slow')
+    tracker.renew('b', 'fast')
+    clock.now += 1
+    tracker.renew('d', 'default')
+    assert tracker.expire() == []
+    assert tracker.expire(1010.5) == ['b', 'c']
+    assert tracker.expire(1100) == ['d', 'a']
+    assert tracker.next_deadline() is None
+    assert tracker.counters['expired'] == 4
+
+
+def test_stale_entries_ignored_after_heartbeat(clock):
+    tracker = LivenessTracker(10)
+    tracker.renew('a', 'default')
+    tracker.renew('b', 'default')
+    clock.now += 8
+    tracker.renew('a', 'default')
+    # a's first entry is still at the top of the heap, but it no longer counts
+    assert tracker.heap[0] == (1010.0, 'a')
+    assert tracker.next_deadline() == 1010.0
+    clock.now += 3
+    assert tracker.expire() == ['b']
+    assert tracker.remaining('a') == pytest.approx(7)
+    assert tracker.expire(clock.now + 7) == ['a']
+
+
+def test_renew_reports_earliest_deadline(clock):
+    tracker = LivenessTracker(10, ttls={'fast': 2})
+    assert tracker.renew('a', 'default')
+    assert not tracker.renew('b', 'default')
+    assert tracker.renew('c', 'fast')
+    clock.now += 1
+    # Renewing the earliest proxy moves its deadline behind others
+    assert not tracker.renew('c', 'default')
+    assert tracker.next_deadline() == 1010.0
+
+
+def test_forget(clock):
+    tracker = LivenessTracker(10)
+    tracker.renew('a', 'default')
+    tracker.renew('b', 'default')
+    tracker.forget('a')
+    tracker.forget('missing')
+    assert tracker.counters['forgotten'] == 1
+    assert tracker.remaining('a') is None
+    assert tracker.expire(clock.now + 60) == ['b']
+    # Re-registration after being forgotten starts a fresh deadline
+    tracker.renew('a', 'default')
+    assert tracker.expire(clock.now + 5) == []
+    assert tracker.expire(clock.now + 10) == ['a']
+
+
+def test_heap_stays_bounded(clock):
+    tracker = LivenessTracker(10)
+    for n in range(5000):
+        clock.now += 0.01
+        tracker.renew(f'p{n % 20}', 'default')
+        assert len(tracker.heap) <= 2 * len(tracker.deadlines) + 64
+    assert tracker.counters['compactions'] > 0
+    assert len(tracker.deadlines) == 20
+
+
+def test_matches_latest_renewal(clock):
+    rng = random.Random(7)
+    ttls = {'fast': 1, 'slow': 20}
+    tracker = LivenessTracker(5, ttls=ttls)
+    deadlines = {}
+    for _ in range(3000):
+        clock.now += rng.random() * 0.5
+        action = rng.random()
+        proxy_id = f'p{rng.randrange(30)}'
+        if action < 0.7:
+            instance_name = rng.choice(['default', 'fast', 'slow'])
+            tracker.renew(proxy_id, instance_name)
+            deadlines[proxy_id] = clock.now + ttls.get(instance_name, 5)
+        elif action < 0.75:
+            tracker.forget(proxy_id)
+            deadlines.pop(proxy_id, None)
+        else:
+            due = sorted((deadline, pid) for pid, deadline in deadlines.items() if deadline <= clock.now)
+            assert tracker.expire() == [pid for _, pid in due]
+            for _, pid in due:
+                del deadlines[pid]
+        assert tracker.next_deadline() == min(deadlines.values(), default=None)
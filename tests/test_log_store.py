@@ -0,0 +1,162 @@
+"""LogStore must answer page, since and count exactly as SQLiteStore does.
+
+Both stores get the same writes, trims and clears; after each step every
+query is asked of both with cursors of every kind, including ids from
+other conversations and ids that no longer exist.
+"""
+import os
+import random
+
+import pytest
+
+from storage import LogStore, SQLiteStore
+
+PEERS = ('alice', 'bob', 'carol')
+
+
+class Stores:
+    """A LogStore with small segments and a SQLiteStore kept in step"""
+
+    def __init__(self, path):
+        self.path = path
+        self.log = LogStore(os.path.join(path, 'log'), segment_bytes=2048)
+        self.sqlite = SQLiteStore(os.path.join(path, 'messages.db'))
+        self.random = random.Random(7)
+        self.next_id = 1
+        self.seconds = 0
+
+    def write(self, count):
+        messages = []
+        for _ in range(count):
+            self.seconds += 1
+            # Some messages arrive late, with an older timestamp
+            seconds = self.seconds - self.random.choice((0, 0, 0, 5))
+            messages.append({
+                'id': self.next_id,
+                'peer_id': self.random.choice(PEERS),
+                'sender': 'me',
+                'message': f"message {self.next_id}",
+                'status': 'delivered',
+                'timestamp': f"2026-01-01T{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}",
+                'auto_reply': False
+            })
+            self.next_id += 1
+        self.log.insert_many(messages)
+        self.sqlite.insert_many(messages)
+
+    def both(self, operation, *args):
+        getattr(self.log, operation)(*args)
+        getattr(self.sqlite, operation)(*args)
+
+    def reopen(self):
+        self.log.close()
+        self.log = LogStore(os.path.join(self.path, 'log'), segment_bytes=2048)
+
+    def crash(self):
+        """Drop the LogStore without closing it, leaving a torn record at the end of its log"""
+        os.close(self.log.active_fd)
+        for data in self.log.maps.values():
+            data.close()
+        with open(self.log._file(self.log.active_number, 'log'), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00\x00\x00\x00\x00{"id":')
+        self.log = LogStore(os.path.join(self.path, 'log'), segment_bytes=2048)
+
+    def cursors(self, peer_id):
+        messages = self.sqlite.history(peer_id)
+        cursors = [None, 0, self.next_id + 10, '2026-01-01T00:00:30', ('2026-01-01T00:01:00', 0)]
+        cursors += [message['id'] for message in messages[::7]]
+        cursors += [(message['timestamp'], message['id']) for message in messages[3::11]]
+        # Ids from other conversations, and ones that were cleared
+        cursors += list(range(1, self.next_id, 13))
+        return cursors
+
+    def assert_same(self):
+        assert self.log.max_id() == self.sqlite.max_id()
+        assert self.log.count() == self.sqlite.count()
+        assert self.log.peer_ids() == self.sqlite.peer_ids()
+        for peer_id in PEERS:
+            assert self.log.count(peer_id) == self.sqlite.count(peer_id)
+            assert self.log.history(peer_id) == self.sqlite.history(peer_id)
+            cursors = self.cursors(peer_id)
+            for limit in (1, 5, 50):
+                for cursor in cursors:
+                    for bounds in ({'before': cursor}, {'after': cursor}):
+                        assert self.log.page(peer_id, limit=limit, **bounds) == \
+                            self.sqlite.page(peer_id, limit=limit, **bounds), (peer_id, limit, bounds)
+                for before, after in zip(cursors[::3], cursors[1::3]):
+                    assert self.log.page(peer_id, before=before, after=after, limit=limit) == \
+                        self.sqlite.page(peer_id, before=before, after=after, limit=limit), (peer_id, before, after)
+        for message_id in [0, *range(1, self.next_id + 2, 9)]:
+            for limit in (1, 10, 1000):
+                assert self.log.since(message_id, limit) == self.sqlite.since(message_id, limit), (message_id, limit)
+
+
+@pytest.fixture
+def stores(tmp_path):
+    stores = Stores(str(tmp_path))
+    yield stores
+    stores.log.close()
+    stores.sqlite.close()
+
+
+def test_writes(stores):
+    stores.write(300)
+    assert len(stores.log.segments) > 1
+    stores.assert_same()
+
+
+def test_clear(stores):
+    stores.write(200)
+    stores.both('clear', 'alice')
+    stores.assert_same()
+    stores.write(100)
+    stores.assert_same()
+    stores.both('clear_all')
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_trim(stores):
+    stores.write(200)
+    upto = tuple(stores.sqlite.history('bob')[20][key] for key in ('timestamp', 'id'))
+    stores.both('trim', 'bob', upto)
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_compaction(stores):
+    stores.write(300)
+    stores.both('clear', 'alice')
+    stores.both('clear', 'carol')
+    stores.write(100)
+    dead = stores.log.stats()['dead']
+    while stores.log.compact():
+        stores.assert_same()
+    assert stores.log.stats()['dead'] < dead
+    stores.assert_same()
+
+
+def test_reopen(stores):
+    stores.write(300)
+    stores.both('clear', 'bob')
+    stores.write(20)
+    stores.reopen()
+    stores.assert_same()
+    stores.log.compact()
+    stores.reopen()
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_unclean_close(stores):
+    stores.write(300)
+    stores.both('clear', 'carol')
+    stores.write(10)
+    stores.crash()
+    stores.assert_same()
+    stores.write(50)
+    stores.crash()
+    stores.assert_same()
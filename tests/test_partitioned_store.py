@@ -0,0 +1,177 @@
+"""PartitionedStore must answer page, since and count exactly as SQLiteStore does.
+
+Both stores get the same writes, trims and clears; after each step every
+query is asked of both with cursors of every kind, including ids from
+other conversations, which live in other tables, and ids that no longer
+exist.
+"""
+import os
+import random
+
+import pytest
+
+from storage import PartitionedStore, SQLiteStore
+
+PEERS = ('alice', 'bob', 'carol')
+
+
+class Stores:
+    """A PartitionedStore and a SQLiteStore kept in step"""
+
+    def __init__(self, path):
+        self.path = path
+        self.partitioned = PartitionedStore(os.path.join(path, 'partitions'))
+        self.sqlite = SQLiteStore(os.path.join(path, 'messages.db'))
+        self.random = random.Random(11)
+        self.next_id = 1
+        self.seconds = 0
+
+    def write(self, count):
+        messages = []
+        for _ in range(count):
+            self.seconds += 1
+            # Some messages arrive late, with an older timestamp
+            seconds = self.seconds - self.random.choice((0, 0, 0, 5))
+            messages.append({
+                'id': self.next_id,
+                'peer_id': self.random.choice(PEERS),
+                'sender': 'me',
+                'message': f"message {self.next_id}",
+                'status': 'delivered',
+                'timestamp': f"2026-01-01T{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}",
+                'auto_reply': self.next_id % 7 == 0
+            })
+            self.next_id += 1
+        self.partitioned.insert_many(messages)
+        self.sqlite.insert_many(messages)
+
+    def both(self, operation, *args):
+        getattr(self.partitioned, operation)(*args)
+        getattr(self.sqlite, operation)(*args)
+
+    def reopen(self):
+        self.partitioned.close()
+        self.partitioned = PartitionedStore(os.path.join(self.path, 'partitions'))
+
+    def cursors(self, peer_id):
+        messages = self.sqlite.history(peer_id)
+        cursors = [None, 0, self.next_id + 10, '2026-01-01T00:00:30', ('2026-01-01T00:01:00', 0)]
+        cursors += [message['id'] for message in messages[::7]]
+        cursors += [(message['timestamp'], message['id']) for message in messages[3::11]]
+        # Ids from other conversations, and ones that were cleared
+        cursors += list(range(1, self.next_id, 13))
+        return cursors
+
+    def assert_same(self):
+        assert self.partitioned.max_id() == self.sqlite.max_id()
+        assert self.partitioned.count() == self.sqlite.count()
+        assert sorted(self.partitioned.peer_ids()) == sorted(self.sqlite.peer_ids())
+        for peer_id in PEERS:
+            assert self.partitioned.count(peer_id) == self.sqlite.count(peer_id)
+            assert self.partitioned.history(peer_id) == self.sqlite.history(peer_id)
+            cursors = self.cursors(peer_id)
+            for limit in (1, 5, 50):
+                for cursor in cursors:
+                    for bounds in ({'before': cursor}, {'after': cursor}):
+                        assert self.partitioned.page(peer_id, limit=limit, **bounds) == \
+                            self.sqlite.page(peer_id, limit=limit, **bounds), (peer_id, limit, bounds)
+                for before, after in zip(cursors[::3], cursors[1::3]):
+                    assert self.partitioned.page(peer_id, before=before, after=after, limit=limit) == \
+                        self.sqlite.page(peer_id, before=before, after=after, limit=limit), (peer_id, before, after)
+        for message_id in [0, *range(1, self.next_id + 2, 9)]:
+            for limit in (1, 10, 1000):
+                assert self.partitioned.since(message_id, limit) == self.sqlite.since(message_id, limit), \
+                    (message_id, limit)
+            assert self.partitioned.get(message_id) == self.sqlite.get(message_id)
+
+
+@pytest.fixture
+def stores(tmp_path):
+    stores = Stores(str(tmp_path))
+    yield stores
+    stores.partitioned.close()
+    stores.sqlite.close()
+
+
+def test_writes(stores):
+    stores.write(300)
+    assert len(stores.partitioned.tables) == len(PEERS)
+    stores.assert_same()
+
+
+def test_cursor_from_another_conversation(stores):
+    stores.write(100)
+    alice = stores.sqlite.history('alice')
+    bob = stores.sqlite.history('bob')
+    cursor = bob[len(bob) // 2]['id']
+    assert cursor not in {message['id'] for message in alice}
+    for bounds in ({'before': cursor}, {'after': cursor}):
+        page = stores.partitioned.page('alice', limit=10, **bounds)
+        assert page
+        assert page == stores.sqlite.page('alice', limit=10, **bounds)
+
+
+def test_clear(stores):
+    stores.write(200)
+    stores.both('clear', 'alice')
+    assert 'alice' not in stores.partitioned.tables
+    stores.assert_same()
+    stores.write(100)
+    stores.assert_same()
+
+
+def test_clear_all(stores):
+    stores.write(200)
+    generation = stores.partitioned.generation
+    stores.both('clear_all')
+    assert stores.partitioned.generation == generation + 1
+    assert not os.path.exists(stores.partitioned._file(generation))
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_trim(stores):
+    stores.write(200)
+    upto = tuple(stores.sqlite.history('bob')[20][key] for key in ('timestamp', 'id'))
+    stores.both('trim', 'bob', upto)
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_reopen(stores):
+    stores.write(300)
+    stores.both('clear', 'bob')
+    stores.write(20)
+    stores.reopen()
+    stores.assert_same()
+    stores.both('clear_all')
+    stores.reopen()
+    stores.assert_same()
+    stores.write(50)
+    stores.assert_same()
+
+
+def test_ids_outlive_clears(stores):
+    stores.write(30)
+    last_id = stores.partitioned.max_id()
+    for peer_id in PEERS:
+        stores.partitioned.clear(peer_id)
+    stores.reopen()
+    assert stores.partitioned.append({
+        'peer_id': 'alice', 'sender': 'me', 'message': 'hi', 'timestamp': '2026-01-02T00:00:00'
+    })['id'] == last_id + 1
+    stores.partitioned.clear_all()
+    stores.reopen()
+    assert stores.partitioned.max_id() == last_id + 1
+
+
+def test_interrupted_clear_all_is_finished_on_open(stores):
+    stores.write(50)
+    leftover = stores.partitioned._file(stores.partitioned.generation + 5)
+    with open(leftover, 'wb') as f:
+        f.write(b'stale')
+    stores.reopen()
+    assert not os.path.exists(leftover)
+    stores.assert_same()
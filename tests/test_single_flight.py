@@ -0,0 +1,178 @@
+"""Identical AI requests in flight must share one upstream call, and every caller must get its outcome.
+
+Requests go through submit_api_request with a real SendScheduler and
+RetryQueue; only the upstream call and the delivery to peer.py are
+replaced, so the tests count upstream calls and see every reply a user
+would get.
+"""
+import asyncio
+
+import pytest
+
+import proxy
+from proxy import RetryableAPIError, RetryQueue, Route, SingleFlight
+from scheduler import SendScheduler
+
+PAYLOAD = {'messages': [{'role': 'user', 'content': 'hello'}]}
+
+
+class Upstream:
+    """Stands in for call_api: counts calls and answers from a script once the gate opens"""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.outcomes = []
+        self.delivered = []
+
+    async def call_api(self, route, payload):
+        self.calls += 1
+        await self.gate.wait()
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def deliver(self, message):
+        self.delivered.append(message)
+
+    async def delivered_count(self, count):
+        for _ in range(200):
+            if len(self.delivered) >= count:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.02)
+        assert len(self.delivered) == count
+        return self.delivered
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = Upstream()
+    monkeypatch.setattr(proxy, 'call_api', upstream.call_api)
+    monkeypatch.setattr(proxy, 'deliver_to_local_peer', upstream.deliver)
+    monkeypatch.setattr(proxy, 'api_flights', SingleFlight())
+    monkeypatch.setattr(proxy, 'api_retries', RetryQueue(2, 0.01, 0.02))
+    monkeypatch.setattr(proxy, 'response_cache', None)
+    monkeypatch.setattr(proxy, 'send_scheduler', None)
+    return upstream
+
+
+def route():
+    return Route('GPT', {'is_api': True, 'host': 'api.example', 'port': 443})
+
+
+def submit(count, payload=PAYLOAD):
+    """Submit the same request `count` times; True for each one that joined an earlier call"""
+    if proxy.send_scheduler is None:
+        proxy.send_scheduler = SendScheduler('proxy', workers=4)
+    return [proxy.submit_api_request(route(), payload) for _ in range(count)]
+
+
+def reply(message):
+    return {'status': 'success', 'message': message, 'from': 'GPT'}
+
+
+def test_identical_requests_make_one_call(upstream):
+    async def run():
+        upstream.outcomes = [reply('hi there')]
+        assert submit(5) == [False, True, True, True, True]
+        await asyncio.sleep(0.02)
+        assert upstream.calls == 1
+        assert proxy.api_flights.stats() == {'leaders': 1, 'coalesced': 4, 'in_flight': 1}
+        upstream.gate.set()
+        delivered = await upstream.delivered_count(5)
+        assert {message['message'] for message in delivered} == {'hi there'}
+        assert not proxy.api_flights.calls
+
+    asyncio.run(run())
+    assert upstream.calls == 1
+
+
+def test_different_requests_are_not_coalesced(upstream):
+    async def run():
+        upstream.outcomes = [reply('ok')]
+        upstream.gate.set()
+        assert submit(1) == [False]
+        assert submit(1, {'messages': [{'role': 'user', 'content': 'bye'}]}) == [False]
+        await upstream.delivered_count(2)
+
+    asyncio.run(run())
+    assert upstream.calls == 2
+
+
+def test_failure_reaches_every_waiter(upstream):
+    async def run():
+        # call_api answers None when the endpoint returned an error it will not retry
+        upstream.outcomes = [None]
+        submit(4)
+        await asyncio.sleep(0.02)
+        upstream.gate.set()
+        delivered = await upstream.delivered_count(4)
+        assert {(message['status'], message['message']) for message in delivered} == \
+            {('error', 'Request to GPT failed')}
+        assert not proxy.api_flights.calls
+
+    asyncio.run(run())
+    assert upstream.calls == 1
+
+
+def test_waiters_share_retries_and_the_final_error(upstream):
+    async def run():
+        upstream.outcomes = [RetryableAPIError('GPT', 429)]
+        submit(3)
+        upstream.gate.set()
+        # Still retrying: a new identical request joins the open flight instead of calling again
+        await asyncio.sleep(0.005)
+        assert submit(1) == [True]
+        delivered = await upstream.delivered_count(4)
+        assert {(message['status'], message['message']) for message in delivered} == \
+            {('error', 'GPT is busy; please try again in a moment.')}
+        assert not proxy.api_flights.calls
+        counters = proxy.api_retries.stats()['endpoints']['GPT']
+        assert counters['retried'] == 2 and counters['gave_up'] == 1 and counters['rate_limited'] == 3
+
+    asyncio.run(run())
+    # The first attempt and two retries
+    assert upstream.calls == 3
+
+
+def test_retry_success_reaches_every_waiter(upstream):
+    async def run():
+        upstream.outcomes = [RetryableAPIError('GPT', 503), reply('recovered')]
+        submit(3)
+        upstream.gate.set()
+        delivered = await upstream.delivered_count(3)
+        assert {message['message'] for message in delivered} == {'recovered'}
+
+    asyncio.run(run())
+    assert upstream.calls == 2
+
+
+def test_finish_all_releases_waiters_without_a_reply(upstream):
+    async def run():
+        upstream.outcomes = [reply('late')]
+        submit(3)
+        await asyncio.sleep(0.02)
+        proxy.api_flights.finish_all(None)
+        assert not proxy.api_flights.calls
+        await asyncio.sleep(0.02)
+        # Followers are told there is no reply; only the leader's own call still delivers
+        assert upstream.delivered == []
+        upstream.gate.set()
+        await upstream.delivered_count(1)
+
+    asyncio.run(run())
+
+
+def test_backoff_delay():
+    retries = RetryQueue(6, 1, 8)
+    for attempt in range(1, 8):
+        backoff = min(8, 2 ** (attempt - 1))
+        delays = [retries.delay(attempt, None) for _ in range(200)]
+        assert all(backoff / 2 <= delay <= backoff for delay in delays), attempt
+        # Jittered, not a fixed step
+        assert len(set(delays)) > 1
+    # A longer retry_after from the provider wins; a shorter one does not
+    assert retries.delay(1, 30) == 30
+    assert 4 <= retries.delay(4, 0.5) <= 8
@@ -0,0 +1,218 @@
+"""WriteBehindStore must read like the store it fronts, commit in order and give up loudly.
+
+Reads are compared with a SQLiteStore that got every message directly, with
+part of the journal's messages still pending. Commit failures use a backend
+that can be switched to raise.
+"""
+import asyncio
+
+import pytest
+
+from storage import JournalUnavailable, SQLiteStore, WriteBehindStore
+
+PEERS = ('alice', 'bob')
+
+
+class FlakyStore(SQLiteStore):
+    """SQLiteStore whose batch inserts fail while `broken` is set"""
+
+    broken = False
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.batches = []
+
+    def insert_many(self, messages):
+        if self.broken:
+            raise OSError("disk full")
+        messages = list(messages)
+        self.batches.append([message['id'] for message in messages])
+        return super().insert_many(messages)
+
+
+def message(n, peer_id=None):
+    return {
+        'peer_id': peer_id or PEERS[n % 2],
+        'sender': 'me',
+        'message': f"message {n}",
+        'status': 'delivered',
+        # Every fifth message arrives late, with an older timestamp
+        'timestamp': f"2026-01-01T00:{(n - 3 * (n % 5 == 0)) // 60:02d}:{(n - 3 * (n % 5 == 0)) % 60:02d}",
+        'auto_reply': False
+    }
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = FlakyStore(str(tmp_path / 'journal.db'))
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def reference(tmp_path):
+    reference = SQLiteStore(str(tmp_path / 'reference.db'))
+    yield reference
+    reference.close()
+
+
+def fill(journal, reference, first, count):
+    for n in range(first, first + count):
+        stored = journal.append(message(n))
+        reference.insert_many([stored])
+
+
+def test_reads_merge_pending_writes(backend, reference):
+    journal = WriteBehindStore(backend)
+    fill(journal, reference, 1, 60)
+    journal.flush()
+    fill(journal, reference, 61, 40)
+    assert len(journal.pending) == 40
+
+    assert journal.max_id() == reference.max_id()
+    assert journal.count() == reference.count()
+    assert journal.peer_ids() == reference.peer_ids()
+    for peer_id in PEERS:
+        assert journal.count(peer_id) == reference.count(peer_id)
+        assert journal.history(peer_id) == reference.history(peer_id)
+        history = reference.history(peer_id)
+        cursors = [None, 0, 500, *[m['id'] for m in history[::6]], *[(m['timestamp'], m['id']) for m in history[2::9]]]
+        for cursor in cursors:
+            for limit in (1, 7, 100):
+                for bounds in ({'before': cursor}, {'after': cursor}):
+                    assert journal.page(peer_id, limit=limit, **bounds) == \
+                        reference.page(peer_id, limit=limit, **bounds), (peer_id, limit, bounds)
+    for message_id in (0, 30, 59, 60, 61, 99, 100):
+        for limit in (1, 10, 1000):
+            assert journal.since(message_id, limit) == reference.since(message_id, limit)
+    for message_id in (1, 60, 61, 100, 101):
+        assert journal.get(message_id) == reference.get(message_id)
+
+
+def test_commits_in_id_order(backend):
+    async def run():
+        journal = WriteBehindStore(backend, batch_size=10, flush_interval=0.01)
+        journal.start()
+        for n in range(1, 36):
+            journal.append(message(n))
+            if n % 4 == 0:
+                await asyncio.sleep(0)
+        await journal.committed(35)
+        await journal.aclose()
+        return journal
+
+    journal = asyncio.run(run())
+    committed = [message_id for batch in backend.batches for message_id in batch]
+    assert committed == list(range(1, 36))
+    # Batches close at batch_size rather than taking everything at the end
+    assert len(backend.batches) > 1
+    assert not journal.pending
+    assert journal.committed_id == 35
+    assert [m['id'] for m in backend.since(0, 100)] == list(range(1, 36))
+
+
+def test_ids_continue_after_reopen(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = WriteBehindStore(SQLiteStore(path))
+    for n in range(1, 6):
+        journal.append(message(n))
+    journal.close()
+    journal = WriteBehindStore(SQLiteStore(path), min_id=20)
+    assert journal.append(message(6))['id'] == 21
+    journal.close()
+
+
+def test_failed_commits_stay_pending_and_retry(backend, reference):
+    async def run():
+        journal = WriteBehindStore(backend, flush_interval=0.01, max_attempts=1000)
+        journal.start()
+        backend.broken = True
+        fill(journal, reference, 1, 20)
+        waiter = asyncio.ensure_future(journal.committed(20))
+        await asyncio.sleep(0.05)
+        assert journal.counters['errors'] > 0
+        assert not waiter.done()
+        # Nothing is lost or reordered while commits fail
+        for peer_id in PEERS:
+            assert journal.history(peer_id) == reference.history(peer_id)
+        backend.broken = False
+        await asyncio.wait_for(waiter, 1)
+        assert journal.failures == 0
+        await journal.aclose()
+
+    asyncio.run(run())
+    assert backend.since(0, 100) == reference.since(0, 100)
+
+
+def test_waiters_fail_after_max_attempts(backend):
+    async def run():
+        journal = WriteBehindStore(backend, flush_interval=0.01, max_attempts=3)
+        journal.start()
+        backend.broken = True
+        stored = journal.append(message(1))
+        with pytest.raises(JournalUnavailable):
+            await asyncio.wait_for(journal.committed(stored['id']), 1)
+        assert journal.failures >= 3
+        # Later callers are told at once instead of waiting
+        later = journal.append(message(2))
+        with pytest.raises(JournalUnavailable):
+            await asyncio.wait_for(journal.committed(later['id']), 0.01)
+        # The messages are still retried, and commit once the backend recovers
+        backend.broken = False
+        for _ in range(100):
+            if not journal.pending:
+                break
+            await asyncio.sleep(0.01)
+        await journal.committed(later['id'])
+        await journal.aclose()
+
+    asyncio.run(run())
+    assert [m['id'] for m in backend.since(0, 10)] == [1, 2]
+
+
+def test_pending_is_bounded(backend):
+    journal = WriteBehindStore(backend, max_pending=5)
+    backend.broken = True
+    for n in range(1, 6):
+        journal.append(message(n))
+    assert not journal.flush()
+    with pytest.raises(JournalUnavailable, match="disk full"):
+        journal.append(message(6))
+    assert len(journal.pending) == 5
+    backend.broken = False
+    assert journal.flush()
+    assert journal.append(message(6))['id'] == 6
+
+
+def test_clear_releases_waiters(backend):
+    async def run():
+        journal = WriteBehindStore(backend)
+        journal.append(message(1, 'alice'))
+        journal.append(message(2, 'bob'))
+        waiters = [asyncio.ensure_future(journal.committed(message_id)) for message_id in (1, 2)]
+        await asyncio.sleep(0)
+        journal.clear('alice')
+        await asyncio.sleep(0)
+        assert waiters[0].done() and not waiters[1].done()
+        journal.clear_all()
+        await asyncio.wait_for(waiters[1], 1)
+        assert journal.count() == 0
+
+    asyncio.run(run())
+
+
+def test_aclose_commits_what_is_pending(tmp_path):
+    path = str(tmp_path / 'journal.db')
+
+    async def run():
+        journal = WriteBehindStore(SQLiteStore(path), batch_size=1000, flush_interval=60)
+        journal.start()
+        for n in range(1, 11):
+            journal.append(message(n))
+        await journal.aclose()
+        journal.backend.close()
+
+    asyncio.run(run())
+    store = SQLiteStore(path)
+    assert store.count() == 10
+    store.close()